@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Benchmarks the thermometer, logging and control paths of fermbot.thermo
+# against a synthetic 1-wire bus.  Run from the top of the repository with
+#
+#   python -m benchmarks.bench_thermo --save 0.2
+#   python -m benchmarks.bench_thermo --compare 0.2
+#
+# to record a release's results in benchmarks/results and later check for
+# regressions against them.
+
+import os, sys, time, json, shutil, tempfile, logging, platform, argparse
+import subprocess
+import fermbot.thermo
+from benchmarks.synthetic_bus import create_bus, default_root, read_latency
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "results")
+
+# A result is a regression when its best time is this much slower than the
+# baseline's
+DEFAULT_TOLERANCE = 0.25
+
+BENCH_LOGGING_APP_NAME = "fermbotThermoBench"
+
+class BenchDevice(fermbot.thermo.ControlledDevice):
+    """ControlledDevice that does no I/O"""
+    def _actuate(self, state):
+        return
+
+def time_call(function, repeat):
+    """Return the best and median wall clock seconds of repeat calls of
+    function"""
+    times = []
+    for run in range(repeat):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    times.sort()
+    return {"min": times[0], "median": times[len(times) // 2],
+            "repeat": repeat}
+
+# Measured in a fresh interpreter so nothing is already imported
+IMPORT_SCRIPT = ("import time; start_time = time.time(); import %s; "
+                 "print(time.time() - start_time)")
+
+def time_import(module, repeat):
+    """Return the best and median seconds taken to import module in a new
+    interpreter, excluding the interpreter's own start up"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = sorted(float(subprocess.check_output(
+                       [sys.executable, "-c", IMPORT_SCRIPT % module],
+                       cwd=root))
+                   for run in range(repeat))
+    return {"min": times[0], "median": times[len(times) // 2],
+            "repeat": repeat}
+
+def _readable(thermometer):
+    try:
+        thermometer.read()
+        return True
+    except fermbot.thermo.TempReadingError:
+        return False
+
+def _file_logger(work_dir):
+    logger = logging.getLogger(BENCH_LOGGING_APP_NAME)
+    logger.handlers = [logging.FileHandler(os.path.join(work_dir,
+                                                        "bench.log"))]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return fermbot.thermo.FileThermoLogger(BENCH_LOGGING_APP_NAME)
+
+def run_benchmarks(sensor_count=200, latency_secs=0.0, crc_failure_rate=0.0,
+                   repeat=5, root=None):
+    """Run every benchmark against a synthetic bus of sensor_count
+    thermometers created under root and return a dict of the results"""
+    work_dir = tempfile.mkdtemp(prefix="fermbot_bench_",
+                                dir=root or default_root())
+    try:
+        bus_path = create_bus(work_dir, sensor_count, crc_failure_rate)
+        thermometers = fermbot.thermo.get_thermometers(bus_path)
+        good_thermometers = [t for t in thermometers if _readable(t)]
+        readings = [t.read() for t in good_thermometers]
+
+        thermo_logger = _file_logger(work_dir)
+        sql_logger = fermbot.thermo.SQLThermoLogger(
+            os.path.join(work_dir, "chain.db"), batch_size=len(readings) + 1)
+        thermo_logger.add_logger(sql_logger)
+        batch_logger = fermbot.thermo.SQLThermoLogger(
+            os.path.join(work_dir, "batch.db"), batch_size=len(readings) + 1)
+        temp_controllers = fermbot.thermo.TempControllerSet(
+            [fermbot.thermo.TempController(BenchDevice(), thermometer,
+                                           fermbot.thermo.Decimal("65.0"),
+                                           fermbot.thermo.Decimal("1.0"))
+             for thermometer in good_thermometers])
+
+        def log_readings(logger):
+            for reading in readings:
+                logger.log_thermo(reading)
+            logger.flush()
+
+        def cycle():
+            cycle_readings = fermbot.thermo.read_thermometers(thermometers)
+            for reading in cycle_readings.itervalues():
+                if reading != None:
+                    thermo_logger.log_thermo(reading)
+            for temp_controller in temp_controllers.process(cycle_readings):
+                thermo_logger.log_temp_controller(temp_controller)
+            thermo_logger.flush()
+
+        results = {}
+        results["import_thermo"] = time_import("fermbot.thermo", repeat)
+        results["get_thermometers"] = time_call(
+            lambda: fermbot.thermo.get_thermometers(bus_path), repeat)
+        results["logger_chain"] = time_call(
+            lambda: log_readings(thermo_logger), repeat)
+        results["sql_inserts"] = time_call(
+            lambda: log_readings(batch_logger), repeat)
+        results["temp_controller_process"] = time_call(
+            lambda: temp_controllers.process(
+                dict((r.serial, r) for r in readings)), repeat)
+        with read_latency(latency_secs):
+            results["thermometer_temp_c"] = time_call(
+                lambda: [t.temp_c for t in good_thermometers], repeat)
+            results["thermometer_temp_f"] = time_call(
+                lambda: [t.temp_f for t in good_thermometers], repeat)
+            results["read_thermometers"] = time_call(
+                lambda: fermbot.thermo.read_thermometers(thermometers),
+                repeat)
+            results["cycle"] = time_call(cycle, repeat)
+
+        thermo_logger.close()
+        batch_logger.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {"metadata": {"time": time.time(),
+                         "python": platform.python_version(),
+                         "machine": platform.machine()},
+            "parameters": {"sensor_count": sensor_count,
+                           "latency_secs": latency_secs,
+                           "crc_failure_rate": crc_failure_rate,
+                           "repeat": repeat},
+            "results": results}
+
+def compare_results(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """Return a list of (name, baseline seconds, current seconds) for each
+    benchmark whose best time is more than tolerance slower than the
+    baseline's"""
+    regressions = []
+    for name, result in sorted(current["results"].iteritems()):
+        if name not in baseline["results"]:
+            continue
+        baseline_secs = baseline["results"][name]["min"]
+        if result["min"] > baseline_secs * (1 + tolerance):
+            regressions.append((name, baseline_secs, result["min"]))
+    return regressions
+
+def results_file(label):
+    return os.path.join(RESULTS_DIR, label + ".json")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark fermbot.thermo against a synthetic bus")
+    parser.add_argument("--sensors", type=int, default=200,
+                        help="thermometers on the bus (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to each thermometer read")
+    parser.add_argument("--crc-failure-rate", type=float, default=0.0,
+                        help="fraction of thermometers failing their CRC")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs of each benchmark (default: %(default)s)")
+    parser.add_argument("--save", metavar="LABEL",
+                        help="save the results as benchmarks/results/LABEL")
+    parser.add_argument("--compare", metavar="LABEL",
+                        help="fail if slower than benchmarks/results/LABEL")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.compare:
+        # Compare like with like
+        with open(results_file(args.compare)) as f:
+            baseline = json.load(f)
+        parameters = baseline["parameters"]
+    else:
+        parameters = {"sensor_count": args.sensors,
+                      "latency_secs": args.latency,
+                      "crc_failure_rate": args.crc_failure_rate,
+                      "repeat": args.repeat}
+
+    current = run_benchmarks(**parameters)
+    for name, result in sorted(current["results"].iteritems()):
+        print("%-24s min %9.6fs  median %9.6fs" %
+              (name, result["min"], result["median"]))
+
+    if args.save:
+        with open(results_file(args.save), "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        regressions = compare_results(baseline, current, args.tolerance)
+        for name, baseline_secs, current_secs in regressions:
+            print("REGRESSION %s: %.6fs -> %.6fs" %
+                  (name, baseline_secs, current_secs))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Generates synthetic 1-wire bus master directory trees laid out like
+# /sys/devices/w1_bus_master1 and the fixtures in tests/data/thermo, for
+# benchmarking with far more thermometers than a real bus holds.
+
+import os, random, tempfile, contextlib, time
+import fermbot.thermo
+
+# tmpfs keeps the benchmarks from measuring the SD card
+TMPFS_ROOT = "/dev/shm"
+
+SLAVE_FILE_FORMAT = ("%(crc_bytes)s : crc=%(crc)s %(result)s\n"
+                     "%(crc_bytes)s t=%(temp)d\n")
+
+def default_root():
+    """Return a tmpfs directory if one is available, otherwise the system
+    temporary directory"""
+    if os.path.isdir(TMPFS_ROOT) and os.access(TMPFS_ROOT, os.W_OK):
+        return TMPFS_ROOT
+    return tempfile.gettempdir()
+
+def write_w1_slave(path, temp_millicelcius, crc_ok=True):
+    """Write a w1_slave file reporting temp_millicelcius"""
+    crc_bytes = "39 01 4b 46 7f ff 07 10 43"
+    with open(path, "w") as w1_slave:
+        w1_slave.write(SLAVE_FILE_FORMAT % {
+            "crc_bytes": crc_bytes, "crc": "43",
+            "result": "YES" if crc_ok else "NO", "temp": temp_millicelcius})
+
+def create_bus(root, sensor_count, crc_failure_rate=0.0, seed=0,
+               name="w1_bus_master1", bulk_read=False):
+    """Create a bus master directory named name under root with
+    sensor_count DS18B20 slaves and return its path
+
+    Each slave fails its CRC check with probability crc_failure_rate and
+    reads between 10 C and 25 C.  seed makes the bus reproducible.  With
+    bulk_read the bus master gets a therm_bulk_read file.
+    """
+    rng = random.Random(seed)
+    bus_path = os.path.join(root, name)
+    os.makedirs(bus_path)
+
+    serials = ["%02x-%012x" % (fermbot.thermo.DS18B20_1_WIRE_TYPE,
+                               rng.getrandbits(48))
+               for sensor in range(sensor_count)]
+    with open(os.path.join(bus_path, "w1_master_slaves"), "w") as slaves:
+        slaves.write("".join(serial + "\n" for serial in serials))
+
+    for serial in serials:
+        os.makedirs(os.path.join(bus_path, serial))
+        write_w1_slave(os.path.join(bus_path, serial, "w1_slave"),
+                       rng.randint(10000, 25000),
+                       rng.random() >= crc_failure_rate)
+
+    if bulk_read:
+        with open(os.path.join(bus_path, "therm_bulk_read"), "w") as f:
+            f.write("0\n")
+    return bus_path
+
+@contextlib.contextmanager
+def read_latency(latency_secs):
+    """Make every Thermometer.read take at least latency_secs longer while
+    the context is active, standing in for the DS18B20 conversion time"""
+    original_read = fermbot.thermo.Thermometer.read
+
+    def slow_read(thermometer):
+        time.sleep(latency_secs)
+        return original_read(thermometer)
+
+    fermbot.thermo.Thermometer.read = slow_read
+    try:
+        yield
+    finally:
+        fermbot.thermo.Thermometer.read = original_read
@@ -2,28 +2,71 @@
 # -*- coding: utf-8 -*-
 import time, thermo
 import display_temps_settings as settings
+import fermbot_thermo_settings
 from datetime import datetime
 
 # constants
 if settings.DEBUG:
     DEVICE_PATH = "../tests/data/thermo/dual_thermo_bus_master"
+    SNAPSHOT_FILE = "thermo_snapshot.json"
 else:
-    DEVICE_PATH = thermo.RPI_BUS_PATH
+    DEVICE_PATH = thermo.W1_DEVICES_PATH
+    SNAPSHOT_FILE = fermbot_thermo_settings.SNAPSHOT_FILE
+
+class DirectReader(object):
+    def __init__(self, device_path):
+        """Read the thermometers on the bus at device_path, for when
+        fermbot_thermo isn't publishing its readings"""
+        self._registry = thermo.MultiBusRegistry(device_path)
+        self._sampler = thermo.MultiBusSampler(self._registry)
+        self._histories = thermo.ReadingHistories()
+
+    def read(self):
+        """Return a tuple of dicts mapping each serial to its TempReading and
+        to its trend, as ReadingSnapshot.readings and slopes"""
+        self._registry.refresh()
+        readings = self._sampler.sample()
+        self._histories.add_readings(readings)
+        slopes = {}
+        for serial in readings:
+            history = self._histories.history(serial)
+            slopes[serial] = (None if history == None else
+                              history.slope_millicelcius_per_hour)
+        return (readings, slopes)
+
+def format_temperature(reading, slope):
+    """Return the message shown for reading, a TempReading or None, with its
+    trend slope in thousandths of a degree Celcius per hour or None"""
+    if reading == None:
+        return "Failed to read temperature"
+
+    temperature_message = "%.1f° F" % (reading.temp_f)
+    if reading.stale:
+        temperature_message += " (%ds old)" % reading.age_secs
+    if slope != None:
+        # A change of 1° C is a change of 1.8° F
+        temperature_message += " %+.1f° F/h" % (slope * 0.0018)
+    return temperature_message
 
 def main():
+    # Only reads the bus when fermbot_thermo isn't running, so any number of
+    # displays add no 1-wire traffic to the controller's
+    direct_reader = None
     while True:
-        for thermometer in thermo.get_thermometers(DEVICE_PATH):
-            temperature_message = ""
-            
-            try:
-                temperature_message =  "%.1f° F" % (thermometer.temp_f)
-            except thermo.TempReadingError:
-                temperature_message = "Failed to read temperature"
-                
+        snapshot = thermo.read_snapshot(SNAPSHOT_FILE)
+        if (snapshot != None and
+            snapshot.age_secs <= settings.MAX_SNAPSHOT_AGE_SECS):
+            readings, slopes = snapshot.readings, snapshot.slopes
+        else:
+            if direct_reader == None:
+                direct_reader = DirectReader(DEVICE_PATH)
+            readings, slopes = direct_reader.read()
+
+        for serial in sorted(readings):
             print("[%s] %s: %s" %
-                  (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                   thermometer.serial, temperature_message))
-            
+                  (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), serial,
+                   format_temperature(readings[serial], slopes.get(serial))))
+
         time.sleep(settings.WAIT_SECS)
 
 if __name__ == '__main__':
@@ -1,3 +1,7 @@
 # constants
 DEBUG = False
-WAIT_SECS = 60
\ No newline at end of file
+WAIT_SECS = 60
+
+# Oldest snapshot from fermbot_thermo shown before falling back to reading
+# the thermometers directly
+MAX_SNAPSHOT_AGE_SECS = 180
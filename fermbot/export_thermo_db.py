@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Running this script exports readings from the thermo logger database to a
+# gzip compressed CSV or JSON lines file.  Readings are streamed a chunk at
+# a time so memory use stays the same however many are exported.  With
+# --state the id of the last exported reading is kept in a file and the next
+# export carries on after it, so only new readings are exported.
+
+import thermo, os, sys, csv, json, gzip, argparse
+from fermbot_thermo import SQL_LOGGER_DB_FILE
+
+FORMATS = ("csv", "jsonl")
+FIELDS = ("id", "serial", "record_time", "temp_millicelcius")
+
+def export_points(reader, out_file, format="csv", serial=None,
+                  start_time=None, end_time=None, after_id=0):
+    """Write the readings from reader, a SQLThermoReader, chosen as for
+    SQLThermoReader.iter_points to out_file in format and return a tuple of
+    the number written and the id of the last one, after_id if none were"""
+    if format == "csv":
+        writer = csv.writer(out_file)
+        writer.writerow(FIELDS)
+        write = writer.writerow
+    elif format == "jsonl":
+        write = lambda point: out_file.write(
+            json.dumps(dict(zip(FIELDS, point)), separators=(",", ":"),
+                       sort_keys=True) + "\n")
+    else:
+        raise ValueError("Unknown export format '" + format + "'")
+
+    count = 0
+    last_id = after_id
+    for point in reader.iter_points(serial, start_time, end_time, after_id):
+        write(point)
+        count += 1
+        last_id = point[0]
+    return (count, last_id)
+
+def read_state(state_file):
+    """Return the last exported id stored in state_file, or 0 if it doesn't
+    exist"""
+    if not os.path.exists(state_file):
+        return 0
+    with open(state_file) as f:
+        return int(f.read().strip() or 0)
+
+def write_state(state_file, last_id):
+    """Store last_id in state_file, replacing it in one step"""
+    temp_file = state_file + ".tmp"
+    with open(temp_file, "w") as f:
+        f.write("%d\n" % last_id)
+    os.rename(temp_file, state_file)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export thermo logger readings to compressed CSV or JSONL")
+    parser.add_argument("output", help="gzip file to write, or - for stdout")
+    parser.add_argument("--db", dest="db_file", default=SQL_LOGGER_DB_FILE,
+                        help="database to export (default: %(default)s)")
+    parser.add_argument("--format", choices=FORMATS, default="csv",
+                        help="output format (default: %(default)s)")
+    parser.add_argument("--serial", help="export only this thermometer")
+    parser.add_argument("--start", type=int,
+                        help="export readings from this epoch second on")
+    parser.add_argument("--end", type=int,
+                        help="export readings up to this epoch second")
+    parser.add_argument("--after-id", type=int, default=0,
+                        help="export readings with ids above this one")
+    parser.add_argument("--state", metavar="STATE_FILE",
+                        help="resume after the id stored in STATE_FILE and "
+                        "store the last exported id in it")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="rows fetched at a time (default: %(default)s)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db_file):
+        parser.error("database '" + args.db_file + "' doesn't exist")
+
+    after_id = args.after_id
+    if args.state:
+        after_id = max(after_id, read_state(args.state))
+
+    reader = thermo.SQLThermoReader(args.db_file, args.chunk_size)
+    try:
+        if args.output == "-":
+            out_file = gzip.GzipFile(fileobj=sys.stdout, mode="wb")
+        else:
+            out_file = gzip.open(args.output, "wb")
+        with out_file:
+            count, last_id = export_points(reader, out_file, args.format,
+                                           args.serial, args.start, args.end,
+                                           after_id)
+    finally:
+        reader.close()
+
+    # Only remember the export once it is completely written
+    if args.state:
+        write_state(args.state, last_id)
+    sys.stderr.write("Exported %d readings, last id %d\n" % (count, last_id))
+
+if __name__ == '__main__':
+    main()
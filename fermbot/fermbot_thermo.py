@@ -3,11 +3,17 @@
 
 # Running this script retrieves the temperatures for all attached thermometers
 # and logs the results.  Additionally this script applies the appropriate
-# temperature control logic to turn on or off controllers.  This is intended to
-# be called by a cron job so only runs through once on each call
+# temperature control logic to turn on or off controllers.  By default this
+# runs through once on each call so it can be called by a cron job.  With
+# --daemon it stays resident and runs a cycle every --interval seconds,
+# keeping the thermometers, loggers, database and controller alive between
+# cycles.
 
-import thermo, logging.config, inspect, os
+import thermo, logging.config, inspect, os, time, signal, argparse, threading
+import socket
 import fermbot_thermo_settings as settings
+import thermo_metrics as metrics
+import thermo_uplink
 
 cwd = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 LOG_CONFIG_FILE = os.path.join(cwd, "logging.conf")
@@ -18,25 +24,267 @@ if settings.DEBUG:
                                "../tests/data/thermo/dual_thermo_bus_master")
     LOGGING_APP_NAME = "fermbotThermoDebug"
     SQL_LOGGER_DB_FILE = os.path.join(cwd, "test.db")
+    METRICS_FILE = os.path.join(cwd, "fermbot_thermo.prom")
+    SNAPSHOT_FILE = os.path.join(cwd, "thermo_snapshot.json")
 else:
-    DEVICE_PATH = thermo.RPI_BUS_PATH
+    DEVICE_PATH = thermo.W1_DEVICES_PATH
     LOGGING_APP_NAME = "fermbotThermoApp"
     SQL_LOGGER_DB_FILE = "/var/lib/fermbot/fermbot_thermo.db"
+    METRICS_FILE = settings.METRICS_TEXTFILE
+    SNAPSHOT_FILE = settings.SNAPSHOT_FILE
+
+CYCLE_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_cycle_seconds", "Seconds taken by a control cycle")
+CYCLE_STAGE_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_cycle_stage_seconds",
+    "Seconds taken by each stage of a control cycle", ("stage",))
+LAST_CYCLE_TIME = metrics.REGISTRY.gauge(
+    "fermbot_last_cycle_timestamp_seconds",
+    "Unix time at which the last control cycle started")
+
+class FermbotThermo(object):
+    def __init__(self, device_path, logging_app_name, sql_logger_db_file,
+                 metrics_file=None, snapshot_file=None, resident=True):
+        """Create the thermometers, loggers and temperature controller used by
+        every cycle.  The metrics are written to metrics_file and the latest
+        readings published to snapshot_file after each cycle if given
+
+        Counters and histograms only add up over the cycles of one process,
+        so unless resident, running cycles for as long as it lives, only the
+        gauges are written.
+        """
+        self._metrics_file = metrics_file
+        self._resident = resident
+        self._snapshot_file = snapshot_file
+        self._histories = thermo.ReadingHistories(settings.HISTORY_SAMPLES)
+        self._registry = thermo.MultiBusRegistry(device_path)
+        self._registry.add_listener(self._on_registry_event)
+        self._sampler = thermo.MultiBusSampler(self._registry)
+        self._logging_app_name = logging_app_name
+
+        self._sql_logger = thermo.SQLThermoLogger(
+            sql_logger_db_file, settings.SQL_BATCH_SIZE,
+            settings.SQL_FLUSH_SECS,
+            thermo.RetentionPolicy(settings.RETENTION_RAW_DAYS,
+                                   settings.RETENTION_MAX_DB_BYTES,
+                                   settings.RETENTION_MINUTE_DAYS))
+        # Each logger writes from its own worker so slow storage never
+        # delays the control logic
+        self._thermo_logger = thermo.ThermoLoggerPipeline()
+        self._thermo_logger.add_sink(
+            thermo.FileThermoLogger(logging_app_name),
+            settings.LOGGER_QUEUE_SIZE, name="file")
+        self._sql_sink = self._thermo_logger.add_sink(
+            self._sql_logger, settings.LOGGER_QUEUE_SIZE, name="sql")
+        if settings.JSONL_LOG_DIR != None:
+            self._thermo_logger.add_sink(
+                thermo.JSONLThermoLogger(settings.JSONL_LOG_DIR,
+                                         settings.JSONL_SEGMENT_BYTES,
+                                         settings.JSONL_MAX_SEGMENTS),
+                settings.LOGGER_QUEUE_SIZE, name="jsonl")
+        if settings.UPLINK_URL != None:
+            self._thermo_logger.add_sink(
+                thermo_uplink.UplinkThermoLogger(
+                    settings.UPLINK_URL,
+                    settings.UPLINK_NODE or socket.gethostname(),
+                    sql_logger_db_file, sql_logger_db_file + ".uplink",
+                    settings.UPLINK_BATCH_SIZE, settings.UPLINK_FLUSH_SECS),
+                settings.LOGGER_QUEUE_SIZE, name="uplink")
+        self._maintenance_queued = threading.Event()
+
+        self._temp_controllers = (
+            thermo.TempControllerFactory.coolingControllerSet(
+                device_path, settings.FERMENTERS))
+
+    # Property holding the thermometers read each cycle
+    @property
+    def thermometers(self):
+        return self._registry.thermometers
+
+    # Property holding the ReadingHistories of the thermometers
+    @property
+    def histories(self):
+        return self._histories
+
+    # Property holding the logger pipeline
+    @property
+    def thermo_logger(self):
+        return self._thermo_logger
+
+    # Property holding the TempControllerSet of every fermenter
+    @property
+    def temp_controllers(self):
+        return self._temp_controllers
+
+    def run_cycle(self):
+        """Read each thermometer within the read budget, log the readings and
+        apply the temperature control logic of every fermenter to them"""
+        cycle_start_time = time.time()
+        LAST_CYCLE_TIME.set(cycle_start_time)
+        try:
+            stage_start_time = cycle_start_time
+            self._registry.refresh()
+            stage_start_time = self._end_stage("discover", stage_start_time)
+
+            thermometers = self.thermometers
+            readings = self._sampler.sample(settings.READ_BUDGET_SECS,
+                                            settings.MAX_FALLBACK_AGE_SECS)
+            self._histories.add_readings(readings)
+            stage_start_time = self._end_stage("read", stage_start_time)
+
+            # Stale readings were logged when they were taken
+            for thermometer in thermometers:
+                reading = readings[thermometer.serial]
+                if reading != None and not reading.stale:
+                    self.thermo_logger.log_thermo(reading)
+            stage_start_time = self._end_stage("log_readings",
+                                               stage_start_time)
+
+            if settings.SMOOTH_CONTROL:
+                processed = self.temp_controllers.process(
+                    self._histories.smoothed_readings(readings))
+            else:
+                processed = self.temp_controllers.process(readings)
+            stage_start_time = self._end_stage("control", stage_start_time)
+
+            self.publish_snapshot(readings)
+            stage_start_time = self._end_stage("publish", stage_start_time)
+
+            for temp_controller in processed:
+                self.thermo_logger.log_temp_controller(temp_controller)
+            self._end_stage("log_controllers", stage_start_time)
+        finally:
+            CYCLE_SECONDS.observe(time.time() - cycle_start_time)
+            self.export_metrics()
+
+    def _end_stage(self, stage, stage_start_time):
+        """Record the time taken by stage and return the time it ended"""
+        now = time.time()
+        CYCLE_STAGE_SECONDS.observe(now - stage_start_time, (stage,))
+        return now
+
+    def publish_snapshot(self, readings):
+        """Publish readings, the histories' trends and the controller states
+        to the snapshot file, if there is one, for display_temps and other
+        local readers, logging rather than raising any error"""
+        if self._snapshot_file == None:
+            return
+        try:
+            thermo.publish_snapshot(self._snapshot_file, readings,
+                                    self._histories,
+                                    self.temp_controllers.temp_controllers)
+        except EnvironmentError:
+            logging.getLogger(self._logging_app_name).exception(
+                "Publishing readings to %s failed" % self._snapshot_file)
+
+    def export_metrics(self):
+        """Write the metrics to the metrics file, if there is one, logging
+        rather than raising any error"""
+        if self._metrics_file == None:
+            return
+        kinds = None
+        if not self._resident:
+            kinds = (metrics.Gauge,)
+        try:
+            metrics.REGISTRY.write_textfile(self._metrics_file, kinds)
+        except EnvironmentError:
+            logging.getLogger(self._logging_app_name).exception(
+                "Writing metrics to %s failed" % self._metrics_file)
+
+    def _on_registry_event(self, event, thermometer):
+        if event == thermo.MultiBusRegistry.Events.REMOVED:
+            self._histories.discard(thermometer.serial)
+        logging.getLogger(self._logging_app_name).info(
+            "Thermometer %s %s" % (thermometer.serial,
+                                   thermo.MultiBusRegistry.Events.
+                                   reverse_mapping[event].lower()))
+
+    def maintain(self, idle_secs):
+        """Queue up to half of the idle_secs seconds until the next cycle of
+        work applying the database retention policy.  It runs on the SQL
+        logger's worker, so this returns straight away"""
+        if self._maintenance_queued.is_set():
+            return
+        time_budget_secs = min(settings.MAINTENANCE_SECS, idle_secs / 2)
+
+        def maintain_database():
+            try:
+                self._sql_logger.maintain(time_budget_secs)
+            finally:
+                self._maintenance_queued.clear()
+
+        self._maintenance_queued.set()
+        self._sql_sink.submit(maintain_database)
+
+    def close(self):
+        """Write out any buffered log data and stop the workers reading the
+        thermometers"""
+        self.thermo_logger.close()
+        self._sampler.close()
+
+def run_periodically(cycle, interval_secs, should_stop=lambda: False,
+                     idle=None):
+    """Call cycle every interval_secs seconds until should_stop returns True
+
+    Cycles are scheduled against fixed deadlines rather than sleeping a
+    fixed time after each cycle, so the period doesn't drift by the time
+    spent in the cycle.  Deadlines missed because a cycle overran are
+    skipped instead of being run back to back.  If given, idle is called
+    after each cycle with the seconds left until the next one and must
+    return well within them.
+    """
+    next_run = time.time()
+    while not should_stop():
+        try:
+            cycle()
+        except Exception:
+            logging.getLogger(LOGGING_APP_NAME).exception("Cycle failed")
+
+        next_run += interval_secs
+        now = time.time()
+        if next_run < now:
+            next_run += ((now - next_run) // interval_secs + 1) * interval_secs
+
+        if idle != None and not should_stop():
+            try:
+                idle(next_run - time.time())
+            except Exception:
+                logging.getLogger(LOGGING_APP_NAME).exception(
+                    "Idle task failed")
+
+        # Sleep in a loop since signals cut the sleep short
+        remaining = next_run - time.time()
+        while not should_stop() and remaining > 0:
+            time.sleep(remaining)
+            remaining = next_run - time.time()
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Log the thermometers and apply the temperature control")
+    parser.add_argument("--daemon", action="store_true",
+                        help="stay resident and run a cycle every interval")
+    parser.add_argument("--interval", type=float,
+                        default=settings.DAEMON_INTERVAL_SECS,
+                        help="seconds between cycles in daemon mode")
+    args = parser.parse_args()
+
     logging.config.fileConfig(LOG_CONFIG_FILE)
-    
-    thermo_logger = thermo.FileThermoLogger(LOGGING_APP_NAME)
-    thermo_logger.add_logger(thermo.SQLThermoLogger(SQL_LOGGER_DB_FILE))
-    
-    for thermometer in thermo.get_thermometers(DEVICE_PATH):
-        thermo_logger.log_thermo(thermometer)
-
-    # TODO: Currently set to the last controller, set more intelligently
-    temp_controller = thermo.TempControllerFactory.simpleCoolingController(
-        DEVICE_PATH, settings.MAX_TEMP_F, settings.TEMP_BAND_F)
-    temp_controller.process()
-    thermo_logger.log_temp_controller(temp_controller)
+
+    fermbot_thermo = FermbotThermo(DEVICE_PATH, LOGGING_APP_NAME,
+                                   SQL_LOGGER_DB_FILE, METRICS_FILE,
+                                   SNAPSHOT_FILE, args.daemon)
+    try:
+        if args.daemon:
+            stop = []
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.append(1))
+            signal.signal(signal.SIGINT, lambda signum, frame: stop.append(1))
+            run_periodically(fermbot_thermo.run_cycle, args.interval,
+                             lambda: len(stop) > 0, fermbot_thermo.maintain)
+        else:
+            fermbot_thermo.run_cycle()
+            fermbot_thermo.maintain(2 * settings.MAINTENANCE_SECS)
+    finally:
+        fermbot_thermo.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -7,4 +7,82 @@ DEBUG = False
 MAX_TEMP_F = Decimal("68.0")
 
 # Hysteresis Settings
-TEMP_BAND_F = Decimal("1.0")
\ No newline at end of file
+TEMP_BAND_F = Decimal("1.0")
+
+# Fermenters to control.  Each maps the serial of the fermenter's thermometer
+# (None for the last thermometer on the bus) to the GPIO board pin of the
+# device cooling it and its temperature settings
+FERMENTERS = [
+    {"serial": None, "pin": 12,
+     "max_temp_f": MAX_TEMP_F, "temp_band_f": TEMP_BAND_F},
+]
+
+# Directory of the journals of cooling device state transitions on the Pi
+DEVICE_JOURNAL_DIR = "/var/lib/fermbot"
+
+# Seconds between control cycles when running with --daemon
+DAEMON_INTERVAL_SECS = 60
+
+# Longest time in seconds spent reading the thermometers each cycle,
+# retrying failed reads, and the age in seconds of the oldest last good
+# reading the controllers use in place of a failed read
+READ_BUDGET_SECS = 5
+MAX_FALLBACK_AGE_SECS = 300
+
+# Recent readings kept for each thermometer, and whether the controllers use
+# the mean of them rather than the latest reading so a single noisy reading
+# can't switch the cooling
+HISTORY_SAMPLES = 5
+SMOOTH_CONTROL = True
+
+# Readings buffered by the SQLite logger before they are written together,
+# and the longest time in seconds a reading may wait to be written
+SQL_BATCH_SIZE = 30
+SQL_FLUSH_SECS = 300
+
+# Readings and controller events queued for each logger before the oldest
+# are dropped
+LOGGER_QUEUE_SIZE = 1000
+
+# Directory of a JSON lines log of every reading and controller event, kept
+# alongside the database as a compact archive that ingest_thermo_jsonl.py
+# can load back into it, or None to not keep one.  The log is rotated into a
+# gzipped segment every JSONL_SEGMENT_BYTES, and only the newest
+# JSONL_MAX_SEGMENTS segments are kept
+JSONL_LOG_DIR = None
+JSONL_SEGMENT_BYTES = 4 * 1024 * 1024
+JSONL_MAX_SEGMENTS = 200
+
+# Base URL of the thermo_collector.py server the readings and controller
+# intervals in the database are uploaded to, or None to not upload them, and
+# the name this fermbot is known by there, or None for the host name.
+# Readings are sent UPLINK_BATCH_SIZE at a time every UPLINK_FLUSH_SECS,
+# resuming after the last one the collector acknowledged
+UPLINK_URL = None
+UPLINK_NODE = None
+UPLINK_BATCH_SIZE = 1000
+UPLINK_FLUSH_SECS = 60
+
+# Raw readings older than this many days are deleted once the minute and
+# hour rollups cover them, minute rollups older than RETENTION_MINUTE_DAYS
+# days are deleted leaving the hour rollups, and the oldest data is deleted
+# whenever the database holds more than RETENTION_MAX_DB_BYTES.  Any may be
+# None
+RETENTION_RAW_DAYS = 180
+RETENTION_MINUTE_DAYS = 365
+RETENTION_MAX_DB_BYTES = 1024 * 1024 * 1024
+
+# File the latest readings are published to after each cycle so
+# display_temps can show them without reading the bus itself.  Keep it on a
+# tmpfs
+SNAPSHOT_FILE = "/run/fermbot/thermo_snapshot.json"
+
+# Prometheus metrics file written after each cycle for the node exporter's
+# textfile collector, or None to not write one.  Counters and histograms,
+# such as the cooling duty cycle, are only written with --daemon, since a
+# run from cron starts them from zero each cycle
+METRICS_TEXTFILE = ("/var/lib/node_exporter/textfile_collector/"
+                    "fermbot_thermo.prom")
+
+# Longest time in seconds spent applying the retention policy between cycles
+MAINTENANCE_SECS = 5
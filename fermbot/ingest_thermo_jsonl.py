@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Running this script loads the readings in JSON lines segments written by
+# JSONLThermoLogger into the thermo logger database, for example to rebuild
+# it from the archive or to fill a gap.  Segments are streamed a line at a
+# time and inserted in batches.  Readings the database already has are
+# skipped, so loading a segment twice is harmless.  With --remove each segment
+# is deleted once its readings are committed.
+
+import thermo, os, sys, argparse
+import fermbot_thermo_settings as settings
+from fermbot_thermo import SQL_LOGGER_DB_FILE
+
+def closed_segments(directory):
+    """Return the gzipped segments in directory, oldest first"""
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.startswith(thermo.JSONLThermoLogger.SEGMENT_PREFIX) and
+            name.endswith(".jsonl.gz")]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load JSON lines thermo logs into the thermo logger "
+        "database")
+    parser.add_argument("segments", nargs="*",
+                        help="segments to load (default: the gzipped "
+                        "segments in JSONL_LOG_DIR)")
+    parser.add_argument("--db", dest="db_file", default=SQL_LOGGER_DB_FILE,
+                        help="database to load into (default: %(default)s)")
+    parser.add_argument("--remove", action="store_true",
+                        help="delete each segment once it is loaded")
+    args = parser.parse_args()
+
+    segments = args.segments
+    if not segments:
+        if settings.JSONL_LOG_DIR == None:
+            parser.error("no segments given and JSONL_LOG_DIR isn't set")
+        segments = closed_segments(settings.JSONL_LOG_DIR)
+
+    sql_logger = thermo.SQLThermoLogger(args.db_file, settings.SQL_BATCH_SIZE)
+    try:
+        total = 0
+        for segment in segments:
+            total += thermo.ingest_jsonl_segments([segment], sql_logger)
+            if args.remove:
+                os.remove(segment)
+    finally:
+        sql_logger.close()
+    sys.stderr.write("Loaded %d readings from %d segments\n" %
+                     (total, len(segments)))
+
+if __name__ == '__main__':
+    main()
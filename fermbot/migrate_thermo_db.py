@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Running this script upgrades an existing thermo logger database in place to
+# the schema version used by this release of thermo.py.  Stop anything
+# writing to the database (the fermbot_thermo cron job or daemon) first.
+
+import thermo, os, argparse
+from fermbot_thermo import SQL_LOGGER_DB_FILE
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Upgrade a thermo logger database to the current schema")
+    parser.add_argument("db_file", nargs="?", default=SQL_LOGGER_DB_FILE,
+                        help="database to upgrade (default: %(default)s)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db_file):
+        parser.error("database '" + args.db_file + "' doesn't exist")
+
+    old_size = os.path.getsize(args.db_file)
+    old_version, new_version = thermo.migrate_database(args.db_file)
+    if old_version == new_version:
+        print("%s is already at schema version %d" %
+              (args.db_file, new_version))
+    else:
+        print("Upgraded %s from schema version %d to %d, %d bytes to %d" %
+              (args.db_file, old_version, new_version, old_size,
+               os.path.getsize(args.db_file)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Running this script replays the readings stored by the thermo logger
+# through the temperature control logic for a grid of maximum temperatures
+# and hysteresis bands, and reports how each setting would have run the
+# cooling.  Use it to tune MAX_TEMP_F and TEMP_BAND_F in
+# fermbot_thermo_settings.py without experimenting on a live batch.
+
+import thermo, os, argparse, collections
+from decimal import Decimal
+from fermbot_thermo import SQL_LOGGER_DB_FILE
+
+# Readings evaluated at a time by sweep, bounding its memory use to about
+# SWEEP_CHUNK_SIZE bytes for each setting in the grid
+SWEEP_CHUNK_SIZE = 4096
+
+# cycles is the number of times the cooling was turned on, duty_cycle the
+# fraction of the time it was on and secs_above_max the seconds the
+# temperature was above the maximum
+SimulationResult = collections.namedtuple(
+    "SimulationResult", ("cycles", "duty_cycle", "secs_above_max",
+                         "total_secs"))
+
+class SimulatedDevice(thermo.ControlledDevice):
+    def __init__(self):
+        """Create a device that only counts the times it is turned on"""
+        super(SimulatedDevice, self).__init__()
+        self._on_count = 0
+
+    # Property holding the number of times the device was turned on
+    @property
+    def on_count(self):
+        return self._on_count
+
+    def _actuate(self, state):
+        if state == self.States.ON:
+            self._on_count += 1
+
+class SimulatedThermometer(object):
+    def __init__(self, serial):
+        """Stand in for the thermometer of a TempController fed stored
+        readings, which never reads the bus"""
+        self._serial = serial
+
+    @property
+    def serial(self):
+        return self._serial
+
+def replay(readings, max_temp_f, temp_band_f):
+    """Feed readings, an iterable of TempReadings oldest first such as from
+    SQLThermoReader.iter_readings, through a TempController and return a
+    SimulationResult
+
+    The controller's state after each reading is taken to hold until the
+    next reading.
+    """
+    device = SimulatedDevice()
+    temp_controller = thermo.TempController(
+        device, SimulatedThermometer("simulated"), max_temp_f, temp_band_f)
+    max_temp_mf = thermo._floor_thousandths(max_temp_f)
+
+    on_secs = 0
+    secs_above_max = 0
+    first_time = None
+    last_time = None
+    last_above_max = False
+    for reading in readings:
+        if last_time == None:
+            first_time = reading.timestamp
+        else:
+            held_secs = reading.timestamp - last_time
+            if device.state == thermo.ControlledDevice.States.ON:
+                on_secs += held_secs
+            if last_above_max:
+                secs_above_max += held_secs
+        temp_controller.process(reading)
+        last_time = reading.timestamp
+        last_above_max = reading.temp_millifahrenheit > max_temp_mf
+
+    if last_time == None:
+        return SimulationResult(0, 0.0, 0, 0)
+    total_secs = last_time - first_time
+    return SimulationResult(device.on_count,
+                            float(on_secs) / total_secs if total_secs else 0.0,
+                            secs_above_max, total_secs)
+
+def sweep(times, temps_millicelcius, max_temps_f, temp_bands_f):
+    """Evaluate every pair of max_temps_f[i] and temp_bands_f[i] against the
+    readings at once and return a list of a SimulationResult for each
+
+    times and temps_millicelcius are NumPy arrays of the epoch second times
+    and integer thousandths of a degree Celcius of the readings, oldest
+    first.  The result for each pair is the same as replay's, but the whole
+    grid is evaluated in one pass over the readings with array operations.
+    Requires NumPy.
+    """
+    import numpy
+
+    pair_count = len(max_temps_f)
+    max_mf = numpy.array([thermo._floor_thousandths(max_temp_f)
+                          for max_temp_f in max_temps_f], numpy.int64)
+    bottom_mf = numpy.array([thermo._floor_thousandths(max_temp_f - band_f)
+                             for max_temp_f, band_f
+                             in zip(max_temps_f, temp_bands_f)], numpy.int64)
+    times = numpy.asarray(times, numpy.int64)
+    temps = numpy.asarray(temps_millicelcius, numpy.int64)
+    if len(times) == 0:
+        return [SimulationResult(0, 0.0, 0, 0)] * pair_count
+
+    # The same integer conversion as TempReading.temp_millifahrenheit
+    fifths, remainder = numpy.divmod(temps * 9 + 160000, 5)
+    temps_mf = fifths + (remainder >= 3)
+    # Each reading's state holds until the next reading
+    held_secs = numpy.append(numpy.diff(times), 0)
+
+    on = numpy.zeros(pair_count, bool)
+    cycles = numpy.zeros(pair_count, numpy.int64)
+    on_secs = numpy.zeros(pair_count, numpy.int64)
+    secs_above_max = numpy.zeros(pair_count, numpy.int64)
+    for start in range(0, len(times), SWEEP_CHUNK_SIZE):
+        chunk_mf = temps_mf[start:start + SWEEP_CHUNK_SIZE]
+        chunk_secs = held_secs[start:start + SWEEP_CHUNK_SIZE]
+        columns = numpy.arange(len(chunk_mf))
+
+        # Above the maximum the cooling turns on, at or below the bottom of
+        # the band it turns off and in between it stays as it was, so the
+        # state after each reading is set by the last reading outside the
+        # band
+        above = chunk_mf[numpy.newaxis, :] > max_mf[:, numpy.newaxis]
+        below = chunk_mf[numpy.newaxis, :] <= bottom_mf[:, numpy.newaxis]
+        last_outside = numpy.maximum.accumulate(
+            numpy.where(above | below, columns, -1), axis=1)
+        last_above = above[numpy.arange(pair_count)[:, numpy.newaxis],
+                           numpy.maximum(last_outside, 0)]
+        states = numpy.where(last_outside >= 0, last_above,
+                             on[:, numpy.newaxis])
+
+        previous = numpy.concatenate((on[:, numpy.newaxis], states[:, :-1]),
+                                     axis=1)
+        cycles += (states & ~previous).sum(axis=1)
+        on_secs += (states * chunk_secs).sum(axis=1)
+        secs_above_max += (above * chunk_secs).sum(axis=1)
+        on = states[:, -1]
+
+    total_secs = int(times[-1] - times[0])
+    return [SimulationResult(int(cycles[i]),
+                             float(on_secs[i]) / total_secs
+                             if total_secs else 0.0,
+                             int(secs_above_max[i]), total_secs)
+            for i in range(pair_count)]
+
+def _decimal_list(text):
+    return [Decimal(value) for value in text.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay stored readings through the temperature control "
+        "logic for a grid of settings")
+    parser.add_argument("serial", help="thermometer whose readings to replay")
+    parser.add_argument("--db", dest="db_file", default=SQL_LOGGER_DB_FILE,
+                        help="thermo logger database (default: %(default)s)")
+    parser.add_argument("--start", type=int, default=0,
+                        help="replay readings from this epoch second on")
+    parser.add_argument("--end", type=int, default=2 ** 31 - 1,
+                        help="replay readings up to this epoch second")
+    parser.add_argument("--max-temps", type=_decimal_list, default="68.0",
+                        help="comma separated maximum temperatures in F")
+    parser.add_argument("--bands", type=_decimal_list, default="1.0",
+                        help="comma separated hysteresis bands in F")
+    parser.add_argument("--exact", action="store_true",
+                        help="replay each setting through a TempController "
+                        "instead of the NumPy sweep")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db_file):
+        parser.error("database '" + args.db_file + "' doesn't exist")
+
+    pairs = [(max_temp_f, band_f) for max_temp_f in args.max_temps
+             for band_f in args.bands]
+    thermo_reader = thermo.SQLThermoReader(args.db_file)
+    try:
+        if args.exact:
+            results = [replay(thermo_reader.iter_readings(
+                                  args.serial, args.start, args.end),
+                              max_temp_f, band_f)
+                       for max_temp_f, band_f in pairs]
+        else:
+            times, temps = thermo_reader.read_arrays(args.serial, args.start,
+                                                     args.end)
+            results = sweep(times, (temps * 1000).round().astype("int64"),
+                            [pair[0] for pair in pairs],
+                            [pair[1] for pair in pairs])
+    finally:
+        thermo_reader.close()
+
+    print("%8s %6s %8s %6s %12s" % ("max F", "band F", "cycles", "duty",
+                                    "hours above"))
+    for (max_temp_f, band_f), result in zip(pairs, results):
+        print("%8s %6s %8d %5.1f%% %12.1f" %
+              (max_temp_f, band_f, result.cycles, result.duty_cycle * 100,
+               result.secs_above_max / 3600.0))
+
+if __name__ == '__main__':
+    main()
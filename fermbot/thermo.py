@@ -1,31 +1,25 @@
 # -*- coding: utf-8 -*-
-import os, logging, datetime, inspect, errno
+# Importing this module does no I/O and touches no hardware, so tools that
+# only read thermometers start quickly.  The platform check, the GPIO
+# library, the devices and the sqlite3 Decimal adapters are all set up on
+# first use.  Keep it that way; benchmarks/bench_thermo.py times the import
+import os, logging, errno, time, threading, collections, array
 import sqlite3 as lite
-from decimal import Decimal
+from decimal import Decimal, ROUND_FLOOR
 import fermbot_thermo_settings as settings
-
-# Determine if running on a Raspberry Pi or not
-IS_RASPBERRY_PI = False
-import platform
-if (platform.machine() == "armv6l" and platform.system() == "Linux"):
-    IS_RASPBERRY_PI = True
-
-# Import the GPIO library only if we're on a Raspberry Pi
-if (IS_RASPBERRY_PI):
-    try:
-        import RPi.GPIO as GPIO
-        GPIO.setmode(GPIO.BOARD)
-
-    except RuntimeError:
-        print("Error importing RPi.GPIO!  This is probably because you need " + 
-              "superuser privileges.  You can achieve this by using 'sudo' " + 
-              "to run your script")
+import thermo_metrics as metrics
 
 RPI_BUS_PATH = "/sys/devices/w1_bus_master1"
+# Directory holding a w1_bus_master* directory for each 1-wire bus master,
+# the GPIO master and any DS2482 bridges
+W1_DEVICES_PATH = "/sys/devices"
+BUS_MASTER_PREFIX = "w1_bus_master"
+
+# inspect is slow to import, and this module is always loaded from a file
+cwd = os.path.dirname(os.path.abspath(__file__))
 
 # Debugging constants
 if settings.DEBUG:
-    cwd = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
     DEVICE_PATH = os.path.join(cwd,
                                "../tests/data/thermo/dual_thermo_bus_master")
 else:
@@ -36,10 +30,126 @@ DS18B20_1_WIRE_TYPE_PREFIX = hex(DS18B20_1_WIRE_TYPE).replace("0x", "", 1)
 
 SLAVE_LIST_FILE_PATH = "/w1_master_slaves"
 TEMPERATURE_FILE_PATH = "/w1_slave"
+BULK_READ_FILE_PATH = "/therm_bulk_read"
+
+# Upper bound on the threads used to read thermometers concurrently
+MAX_READ_THREADS = 16
+
+# Seconds to wait before retrying a failed thermometer read
+READ_RETRY_DELAY_SECS = 0.1
+
+# Age in seconds of the oldest last good reading used in place of a failed
+# read
+MAX_FALLBACK_AGE_SECS = 300
+
+# Bytes written to a JSONLThermoLogger segment before it is rotated
+JSONL_SEGMENT_BYTES = 4 * 1024 * 1024
+
+# Readings kept per thermometer by ReadingHistories
+HISTORY_SAMPLES = 10
+
+# Seconds between rereads of the slave list by a ThermometerRegistry when
+# its modification time hasn't changed.  sysfs doesn't update the mtime
+REGISTRY_POLL_SECS = 30
 
-cwd = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 THERMO_LOGGER_SQL_FILE = os.path.join(cwd, "thermo_logger.sql") 
 
+# The schema version created by THERMO_LOGGER_SQL_FILE, stored in the
+# database's user_version
+THERMO_LOGGER_SCHEMA_VERSION = 5
+
+# Bucket sizes in seconds of the rollups kept in temperature_rollups, finest
+# first
+ROLLUP_RESOLUTIONS = (60, 3600)
+
+# Default limit on the number of rows returned by SQLThermoLogger.summarize
+SUMMARY_MAX_POINTS = 500
+
+# Longest time in seconds between controller events logged in the same
+# controller_intervals row.  A longer gap, such as while fermbot_thermo was
+# stopped, starts a new row so the gap isn't counted as time in the state
+CONTROLLER_INTERVAL_MAX_GAP_SECS = 600
+
+# Instrumentation written out by fermbot_thermo for the node exporter
+READ_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_thermometer_read_seconds",
+    "Seconds taken to read a thermometer", ("serial",))
+READ_ERRORS = metrics.REGISTRY.counter(
+    "fermbot_thermometer_read_errors_total",
+    "Readings rejected for a failed CRC check or malformed data", ("serial",))
+LOGGER_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_logger_seconds",
+    "Seconds taken by a logger sink to log a reading or event", ("logger",))
+LOGGER_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    "fermbot_logger_queue_depth",
+    "Readings and events waiting for a logger sink", ("logger",))
+LOGGER_DROPPED = metrics.REGISTRY.counter(
+    "fermbot_logger_dropped_total",
+    "Readings and events dropped by a full logger sink", ("logger",))
+LOGGER_ERRORS = metrics.REGISTRY.counter(
+    "fermbot_logger_errors_total",
+    "Messages a logger sink failed to handle", ("logger",))
+SQL_COMMIT_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_sql_commit_seconds",
+    "Seconds taken to write a batch of readings to SQLite")
+PROCESS_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_controller_process_seconds",
+    "Seconds taken by a temperature controller to process a reading",
+    ("serial",))
+COOLING = metrics.REGISTRY.gauge(
+    "fermbot_controller_cooling",
+    "1 while a temperature controller's device is on, otherwise 0",
+    ("serial",))
+COOLING_SECONDS = metrics.REGISTRY.counter(
+    "fermbot_controller_cooling_seconds_total",
+    "Seconds a temperature controller's device has been on.  Its rate is "
+    "the duty cycle.  Only counted by a resident fermbot_thermo.py --daemon",
+    ("serial",))
+READ_RETRIES = metrics.REGISTRY.counter(
+    "fermbot_thermometer_read_retries_total",
+    "Failed thermometer reads retried within the cycle's time budget",
+    ("serial",))
+READ_TIMEOUTS = metrics.REGISTRY.counter(
+    "fermbot_thermometer_read_timeouts_total",
+    "Thermometer reads abandoned at the end of the cycle's time budget",
+    ("serial",))
+READ_FALLBACKS = metrics.REGISTRY.counter(
+    "fermbot_thermometer_read_fallbacks_total",
+    "Failed thermometer reads replaced by the last good reading",
+    ("serial",))
+ACTUATION_SECONDS = metrics.REGISTRY.histogram(
+    "fermbot_device_actuation_seconds",
+    "Seconds taken to switch a controlled device", ("device",))
+
+_is_raspberry_pi = None
+_gpio = None
+
+def is_raspberry_pi():
+    """Return True if running on a Raspberry Pi.  The platform is only
+    checked on the first call"""
+    global _is_raspberry_pi
+    if _is_raspberry_pi == None:
+        import platform
+        _is_raspberry_pi = (platform.machine() == "armv6l" and
+                            platform.system() == "Linux")
+    return _is_raspberry_pi
+
+def _get_gpio():
+    """Return the RPi.GPIO module, importing it and selecting board pin
+    numbering on the first call"""
+    global _gpio
+    if _gpio == None:
+        try:
+            import RPi.GPIO as GPIO
+        except RuntimeError:
+            print("Error importing RPi.GPIO!  This is probably because you " +
+                  "need superuser privileges.  You can achieve this by using " +
+                  "'sudo' to run your script")
+            raise
+        GPIO.setmode(GPIO.BOARD)
+        _gpio = GPIO
+    return _gpio
+
 # A helper method for enumerations from
 # http://stackoverflow.com/questions/36932/how-can-i-represent-an-enum-in-python
 def enum(*sequential, **named):
@@ -53,6 +163,8 @@ class Thermometer(object):
     def __init__(self, bus_master_path, serial):
         self._serial = ""
         self._bus_master_path = ""
+        self._last_reading = None
+        self._read_lock = threading.Lock()
         
         self.bus_master_path = bus_master_path
         self.serial = serial
@@ -93,6 +205,73 @@ class Thermometer(object):
         self._bus_master_path = value
         return self._bus_master_path
     
+    # Last reading property
+    @property
+    def last_reading(self):
+        """Return the TempReading from the most recent call to read(), or None
+        if the thermometer hasn't been read yet"""
+        return self._last_reading
+
+    def read(self):
+        """Return a TempReading snapshot of the current temperature
+
+        Queries the 1-wire bus files once.  Callers that need both the Celcius
+        and Fahrenheit temperatures, or that pass the temperature on to
+        several consumers, should read once and share the returned reading.
+        """
+        start_time = time.time()
+        try:
+            with open(self.bus_master_path + self.serial + 
+                      TEMPERATURE_FILE_PATH, "rb") as temperature_file:
+                data = temperature_file.read()
+        finally:
+            READ_SECONDS.observe(time.time() - start_time, (self.serial,))
+
+        # The first line ends with the CRC check result and the second with
+        # t= and the temperature in millidegrees Celcius
+        crc_end = data.find(b"\n")
+        temp_start = data.find(b"t=", crc_end)
+        if (crc_end < 0 or temp_start < 0 or
+            data[crc_end - 3:crc_end] != b"YES"):
+            READ_ERRORS.inc(labels=(self.serial,))
+            raise TempReadingError("Bad reading from thermometer '" + 
+                                   self.serial + "'")
+        try:
+            temp_millicelcius = int(data[temp_start + 2:])
+        except ValueError:
+            READ_ERRORS.inc(labels=(self.serial,))
+            raise TempReadingError("Bad reading from thermometer '" + 
+                                   self.serial + "'")
+
+        self._last_reading = TempReading(self.serial, temp_millicelcius,
+                                         time.time())
+        return self._last_reading
+
+    def read_until(self, deadline, retry_delay_secs=READ_RETRY_DELAY_SECS):
+        """Read the thermometer, retrying failed reads every
+        retry_delay_secs seconds until deadline, and return the TempReading
+
+        Raises TempReadingError if no read succeeded before deadline, which
+        is in seconds since the epoch or None for a single attempt, or
+        straight away if an earlier read is still stuck in the kernel.
+        """
+        if not self._read_lock.acquire(False):
+            raise TempReadingError("Thermometer '" + self.serial +
+                                   "' is still being read")
+        try:
+            while True:
+                try:
+                    return self.read()
+                except (TempReadingError, EnvironmentError):
+                    if (deadline == None or
+                        time.time() + retry_delay_secs >= deadline):
+                        raise TempReadingError("Bad reading from thermometer '"
+                                               + self.serial + "'")
+                READ_RETRIES.inc(labels=(self.serial,))
+                time.sleep(retry_delay_secs)
+        finally:
+            self._read_lock.release()
+
     # Temperature in Celcius property
     @property
     def temp_c(self):
@@ -102,21 +281,7 @@ class Thermometer(object):
         Queries the 1-wire bus files.  Precision is to the 1000th of a
         degree but accuracy is only to +/-0.5 C.
         """
-        with open(self.bus_master_path + self.serial + 
-                  TEMPERATURE_FILE_PATH) as temperature_file:
-            crc_line = temperature_file.readline();
-            temp_line = temperature_file.readline();
-            temperature_file.close()
-
-            crc = crc_line.split()[-1]
-
-            if crc.split()[-0] == "NO":
-                raise TempReadingError("Bad reading from thermometer '" + 
-                                       self.serial + "'")
-            
-            temperature_data = temp_line.split()[-1]
-            return (Decimal(temperature_data[2:]) / 
-                Decimal(1000))
+        return self.read().temp_c
     
     # Temperature in Fahrenheit property
     @property
@@ -126,13 +291,103 @@ class Thermometer(object):
         Queries the 1-wire bus files.  Precision is to the 1000th of a degree
         but accuracy is only to +/-0.5 C.
         """
-        return ((self.temp_c * Decimal(9) / Decimal(5)) + 
-                Decimal(32)).quantize(Decimal('1.000'))
+        return self.read().temp_f
+
+class TempReading(object):
+    """An immutable snapshot of a single thermometer reading
+
+    Exposes the same serial, temp_c and temp_f attributes as a Thermometer so
+    it can be handed to anything that logs a thermometer, but never touches
+    the 1-wire bus.
+    """
+    __slots__ = ("_serial", "_temp_millicelcius", "_timestamp",
+                 "_temp_millifahrenheit", "_stale")
+
+    def __init__(self, serial, temp_millicelcius, timestamp, stale=False):
+        """Create a reading of temp_millicelcius, an int in thousandths of a
+        degree Celcius, taken from serial at timestamp seconds since the
+        epoch.  stale marks an earlier reading standing in for a failed one
+        """
+        self._serial = serial
+        self._temp_millicelcius = temp_millicelcius
+        self._timestamp = timestamp
+        self._temp_millifahrenheit = None
+        self._stale = stale
+
+    # Serial property
+    @property
+    def serial(self):
+        """Return the 1-wire serial number of the thermometer that was read"""
+        return self._serial
+
+    # Timestamp property
+    @property
+    def timestamp(self):
+        """Return the time of the reading in seconds since the epoch"""
+        return self._timestamp
+
+    # Stale property
+    @property
+    def stale(self):
+        """Return True if this is the last good reading of a thermometer
+        that failed to read this cycle"""
+        return self._stale
+
+    # Age property
+    @property
+    def age_secs(self):
+        """Return the seconds since the reading was taken"""
+        return time.time() - self._timestamp
+
+    def as_stale(self):
+        """Return a copy of the reading marked as stale"""
+        return TempReading(self._serial, self._temp_millicelcius,
+                           self._timestamp, True)
+
+    # Temperature in thousandths of a degree Celcius property
+    @property
+    def temp_millicelcius(self):
+        """Return an int that is the temperature in thousandths of a degree
+        Celcius, as reported by the thermometer"""
+        return self._temp_millicelcius
+
+    # Temperature in thousandths of a degree Fahrenheit property
+    @property
+    def temp_millifahrenheit(self):
+        """Return an int that is the temperature in thousandths of a degree
+        Farenheit, rounded to the nearest thousandth"""
+        if self._temp_millifahrenheit == None:
+            # F = C * 9 / 5 + 32, kept in integers.  A remainder of 2.5 fifths
+            # can't happen so rounding half up is the same as half even
+            fifths, remainder = divmod(self._temp_millicelcius * 9 + 160000, 5)
+            if remainder >= 3:
+                fifths += 1
+            self._temp_millifahrenheit = fifths
+        return self._temp_millifahrenheit
+
+    # Temperature in Celcius property
+    @property
+    def temp_c(self):
+        """Return a Decimal that is the temperature in degrees Celcius"""
+        return Decimal(self._temp_millicelcius).scaleb(-3)
+
+    # Temperature in Fahrenheit property
+    @property
+    def temp_f(self):
+        """Return a Decimal that is the temperature in degrees Farenheit"""
+        return Decimal(self.temp_millifahrenheit).scaleb(-3)
 
 class TempReadingError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+class ThermoDatabaseError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
 class ThermoLogger(object):
     def __init__(self):
         self._next = None
@@ -154,7 +409,15 @@ class ThermoLogger(object):
             self.next.add_logger(logger)
     
     def log_thermo(self, thermo):
-        """Log the data from the Thermometer to all configured logs"""
+        """Log the data from the Thermometer to all configured logs
+
+        thermo may be a Thermometer or a TempReading.  A Thermometer is read
+        once here and the resulting TempReading is passed down the chain so
+        every logger records the same value.
+        """
+        if isinstance(thermo, Thermometer):
+            thermo = thermo.read()
+
         self._log_thermo_without_chain(thermo)
         
         if (self.next != None):
@@ -181,12 +444,40 @@ class ThermoLogger(object):
         raise TypeError('Abstract method `' + self._class.__name__ \
                             + '.' + self._function + '\' called')
 
+    def flush(self):
+        """Write out any buffered data in all configured logs"""
+        self._flush_without_chain()
+
+        if (self.next != None):
+            self.next.flush()
+
+    def _flush_without_chain(self):
+        """Write out any buffered data for the current class without calling
+        down the logging chain.  Subclasses that buffer override this method
+        """
+        return
+
+    def close(self):
+        """Flush and release the resources held by all configured logs"""
+        self._close_without_chain()
+
+        if (self.next != None):
+            self.next.close()
+
+    def _close_without_chain(self):
+        """Flush and release the resources held by the current class without
+        calling down the logging chain.  Subclasses that hold resources
+        override this method
+        """
+        self._flush_without_chain()
+
 class FileThermoLogger(ThermoLogger):
     def __init__(self, app_name):
         """Create a file logging based temperature logger with configured
         logged application name app_name"""
         super(FileThermoLogger, self).__init__()
         self._app_name = ""
+        self._logger = None
         
         self.app_name = app_name
     
@@ -198,23 +489,465 @@ class FileThermoLogger(ThermoLogger):
     @app_name.setter
     def app_name(self, value):
         self._app_name = value
+        self._logger = logging.getLogger(value)
         return self._app_name
     
     def _log_thermo_without_chain(self, thermo):
         """Log the thermometer serial, temp, and time to a log file"""
-        logger = logging.getLogger(self.app_name)
-        logger.info("%s at %.1f° F" % (thermo.serial, thermo.temp_f))
+        self._logger.info("%s at %.1f° F" % (thermo.serial, thermo.temp_f))
     
     def _log_temp_controller_without_chain(self, temp_controller):
         """Log the TempController thermo serial, thermo temp, target temp,
         state, and time to a log file"""
-        logger = logging.getLogger(self.app_name)
-        logger.info("TempController %s at %.1f° F, target is %.1f° F so TC is %s"
+        logger = self._logger
+        reading = temp_controller.current_reading()
+        logger.info("TempController %s at %.1f° F%s, target is %.1f° F so TC is %s"
                     % (temp_controller.thermometer.serial,
-                       temp_controller.thermometer.temp_f,
+                       reading.temp_f,
+                       " (%ds old)" % reading.age_secs if reading.stale else "",
                        temp_controller.max_temp_f,
                        TempController.States.reverse_mapping[temp_controller.state]))
 
+class JSONLThermoLogger(ThermoLogger):
+    CURRENT_FILE_NAME = "thermo.jsonl"
+    SEGMENT_PREFIX = "thermo-"
+
+    def __init__(self, directory, max_segment_bytes=JSONL_SEGMENT_BYTES,
+                 max_segments=None):
+        """Create a logger writing one JSON object per line to a file in
+        directory
+
+        Readings and controller events are written with their full integer
+        precision.  Once the file holds max_segment_bytes it is renamed to a
+        segment and gzipped in the background, and the oldest segments are
+        deleted if there are more than max_segments.  ingest_jsonl_segments
+        loads segments into another logger, such as a SQLThermoLogger.
+        """
+        super(JSONLThermoLogger, self).__init__()
+        self._directory = directory
+        self._max_segment_bytes = max_segment_bytes
+        self._max_segments = max_segments
+        self._compressors = []
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file_name = os.path.join(directory, self.CURRENT_FILE_NAME)
+        self._file = open(self._file_name, "a")
+        self._size = os.path.getsize(self._file_name)
+
+        # Finish what an earlier run left: drop partly written gzipped
+        # copies and raw segments already compressed, then compress the rest
+        segments = self.segments()
+        for name in os.listdir(directory):
+            file_name = os.path.join(directory, name)
+            if (name.startswith(self.SEGMENT_PREFIX) and
+                name.endswith((".jsonl", ".jsonl.gz.tmp")) and
+                file_name not in segments):
+                os.remove(file_name)
+        for segment in segments:
+            if not segment.endswith(".gz"):
+                self._compress_in_background(segment)
+        self._last_segment_time = 0
+        if segments:
+            self._last_segment_time = int(os.path.basename(
+                segments[-1])[len(self.SEGMENT_PREFIX):].partition(".")[0])
+
+    # Property holding the directory of the log and its segments
+    @property
+    def directory(self):
+        return self._directory
+
+    def segments(self):
+        """Return the paths of the rotated segments, oldest first
+
+        Each segment is listed once, as its gzipped copy once that is
+        finished and as the raw file while it is being compressed.
+        """
+        names = {}
+        for name in os.listdir(self._directory):
+            if not name.startswith(self.SEGMENT_PREFIX):
+                continue
+            # A thermo-<ms> stem names one segment in all of its forms
+            stem, _, extension = name.partition(".")
+            if extension == "jsonl.gz" or (extension == "jsonl" and
+                                           stem not in names):
+                names[stem] = name
+        return [os.path.join(self._directory, names[stem])
+                for stem in sorted(names)]
+
+    def _write(self, record):
+        import json
+
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self._file.write(line)
+        self._size += len(line)
+        if self._size >= self._max_segment_bytes:
+            self._rotate()
+
+    def _log_thermo_without_chain(self, thermo):
+        if not isinstance(thermo, TempReading):
+            thermo = thermo.read()
+        self._write({"type": "reading", "serial": thermo.serial,
+                     "time": thermo.timestamp,
+                     "temp_millicelcius": thermo.temp_millicelcius})
+
+    def _log_temp_controller_without_chain(self, temp_controller):
+        reading = temp_controller.current_reading()
+        self._write({
+            "type": "controller",
+            "serial": temp_controller.thermometer.serial,
+            "time": reading.timestamp,
+            "temp_millicelcius": reading.temp_millicelcius,
+            "state": TempController.States.reverse_mapping[
+                temp_controller.state],
+            "max_temp_millifahrenheit": _floor_thousandths(
+                temp_controller.max_temp_f),
+            "temp_band_millifahrenheit": _floor_thousandths(
+                temp_controller.temp_band_f)})
+
+    def _rotate(self):
+        """Turn the current file into a segment and start a new one"""
+        self._file.close()
+        # Milliseconds keep the names in time order.  Each name is later
+        # than the last, even within a millisecond, as a deleted segment's
+        # name would sort before the newer ones
+        segment_time = max(int(time.time() * 1000),
+                           self._last_segment_time + 1)
+        self._last_segment_time = segment_time
+        segment = os.path.join(self._directory, "%s%013d.jsonl" %
+                               (self.SEGMENT_PREFIX, segment_time))
+        os.rename(self._file_name, segment)
+        self._file = open(self._file_name, "a")
+        self._size = 0
+
+        self._compress_in_background(segment)
+        self._remove_old_segments()
+
+    def _remove_old_segments(self):
+        """Delete the oldest segments beyond max_segments, except those
+        still being compressed, which count towards it all the same"""
+        if self._max_segments == None:
+            return
+        for old_segment in self.segments()[:-self._max_segments]:
+            if old_segment.endswith(".gz"):
+                os.remove(old_segment)
+
+    def _compress_in_background(self, segment):
+        self._compressors = [c for c in self._compressors if c.is_alive()]
+        compressor = threading.Thread(target=_compress_segment,
+                                      args=(segment,))
+        compressor.daemon = True
+        compressor.start()
+        self._compressors.append(compressor)
+
+    def _flush_without_chain(self):
+        self._file.flush()
+
+    def _close_without_chain(self):
+        """Close the file and wait for segments being compressed"""
+        self._file.close()
+        for compressor in self._compressors:
+            compressor.join()
+        self._remove_old_segments()
+
+def _compress_segment(segment):
+    """Replace segment with a gzipped copy"""
+    import gzip, shutil
+
+    try:
+        with open(segment, "rb") as source:
+            compressed = gzip.open(segment + ".gz.tmp", "wb")
+            try:
+                shutil.copyfileobj(source, compressed)
+            finally:
+                compressed.close()
+        os.rename(segment + ".gz.tmp", segment + ".gz")
+        os.remove(segment)
+    except EnvironmentError:
+        logging.getLogger(__name__).exception("Compressing %s failed" %
+                                              segment)
+
+def iter_jsonl_records(file_name):
+    """Yield each record written by a JSONLThermoLogger to file_name, a
+    segment, gzipped or not, or its current file"""
+    import gzip, json
+
+    if file_name.endswith(".gz"):
+        jsonl_file = gzip.open(file_name, "rb")
+    else:
+        jsonl_file = open(file_name, "rb")
+    try:
+        for line in jsonl_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by a crash
+                continue
+    finally:
+        jsonl_file.close()
+
+def ingest_jsonl_segments(file_names, sql_logger):
+    """Log the readings in the JSONLThermoLogger files file_names with
+    sql_logger, a SQLThermoLogger, and return the number logged
+
+    Readings the database already has a point for, at the same time from the
+    same thermometer, are skipped, so a segment can be loaded again or into
+    the database the fermbot was logging to as well.  Records are streamed
+    one at a time and each file is written as it is finished, so any amount
+    of log can be loaded.  Controller events are skipped.
+    """
+    count = 0
+    for file_name in file_names:
+        # Points only reach the database when flushed, so the points of this
+        # file are remembered until then
+        logged = set()
+        for record in iter_jsonl_records(file_name):
+            if record.get("type") != "reading":
+                continue
+            point = (str(record["serial"]), int(record["time"]))
+            if point in logged or sql_logger.has_point(*point):
+                continue
+            sql_logger.log_thermo(TempReading(
+                point[0], record["temp_millicelcius"], record["time"]))
+            logged.add(point)
+            count += 1
+        sql_logger.flush()
+    return count
+
+class ThermoLoggerSink(object):
+    OverflowPolicies = enum("BLOCK", "DROP_NEWEST", "DROP_OLDEST")
+
+    # Kinds of message passed to the worker thread.  Only readings and
+    # controller events count against the queue limit or are ever dropped
+    _THERMO, _TEMP_CONTROLLER, _CALL, _CLOSE = range(4)
+
+    def __init__(self, logger, max_queue, overflow, block_secs, name):
+        """Create a sink named name that feeds logger from a bounded queue
+        on its own worker thread.  Use ThermoLoggerPipeline.add_sink to
+        create one"""
+        self._logger = logger
+        self._name = name
+        self._max_queue = max_queue
+        self._overflow = overflow
+        self._block_secs = block_secs
+        self._messages = collections.deque()
+        self._condition = threading.Condition()
+        self._queued_count = 0
+        self._unfinished_count = 0
+        self._dropped_count = 0
+        self._error_count = 0
+        self._closed = False
+        self._labels = (name,)
+
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    # Property holding the logger fed by this sink
+    @property
+    def logger(self):
+        return self._logger
+
+    # Property holding the name the sink's metrics are labelled with
+    @property
+    def name(self):
+        return self._name
+
+    # Property holding the number of readings and events waiting for the
+    # worker
+    @property
+    def queue_depth(self):
+        return self._queued_count
+
+    # Property holding the number of readings and events dropped because
+    # the queue was full
+    @property
+    def dropped_count(self):
+        return self._dropped_count
+
+    # Property holding the number of messages the logger failed to handle
+    @property
+    def error_count(self):
+        return self._error_count
+
+    def _make_room(self):
+        """Apply the overflow policy to a full queue and return False if the
+        new message must be dropped.  Called holding the condition"""
+        if self._overflow == self.OverflowPolicies.DROP_OLDEST:
+            for message in self._messages:
+                if message[0] in (self._THERMO, self._TEMP_CONTROLLER):
+                    self._messages.remove(message)
+                    self._queued_count -= 1
+                    self._unfinished_count -= 1
+                    self._dropped_count += 1
+                    LOGGER_DROPPED.inc(labels=self._labels)
+                    return True
+
+        elif self._overflow == self.OverflowPolicies.BLOCK:
+            deadline = time.time() + self._block_secs
+            while (self._queued_count >= self._max_queue and
+                   time.time() < deadline):
+                self._condition.wait(deadline - time.time())
+            if self._queued_count < self._max_queue:
+                return True
+
+        self._dropped_count += 1
+        LOGGER_DROPPED.inc(labels=self._labels)
+        return False
+
+    def _put(self, message):
+        with self._condition:
+            if message[0] in (self._THERMO, self._TEMP_CONTROLLER):
+                if (self._queued_count >= self._max_queue and
+                    not self._make_room()):
+                    return
+            # Checked after _make_room, which may wait for the worker
+            if self._closed:
+                # The worker has stopped, so nothing would handle it
+                if message[0] in (self._THERMO, self._TEMP_CONTROLLER):
+                    self._dropped_count += 1
+                    LOGGER_DROPPED.inc(labels=self._labels)
+                return
+            if message[0] == self._CLOSE:
+                self._closed = True
+            elif message[0] in (self._THERMO, self._TEMP_CONTROLLER):
+                self._queued_count += 1
+                LOGGER_QUEUE_DEPTH.set(self._queued_count, self._labels)
+            self._messages.append(message)
+            self._unfinished_count += 1
+            self._condition.notify_all()
+
+    def log_thermo(self, reading):
+        """Queue reading for the logger, applying the overflow policy if the
+        queue is full"""
+        self._put((self._THERMO, reading))
+
+    def log_temp_controller(self, snapshot):
+        """Queue a TempControllerSnapshot for the logger, applying the
+        overflow policy if the queue is full"""
+        self._put((self._TEMP_CONTROLLER, snapshot))
+
+    def submit(self, function):
+        """Queue a call of function() on the worker thread.  Use this for
+        anything else that needs the logger"""
+        self._put((self._CALL, function))
+
+    def join(self):
+        """Wait until the worker has handled everything queued so far"""
+        with self._condition:
+            while self._unfinished_count > 0:
+                self._condition.wait()
+
+    def close(self):
+        """Flush and close the logger on the worker thread and wait for the
+        worker to finish.  Anything queued afterwards is dropped"""
+        self._put((self._CLOSE, None))
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._messages:
+                    self._condition.wait()
+                kind, payload = self._messages.popleft()
+                if kind in (self._THERMO, self._TEMP_CONTROLLER):
+                    self._queued_count -= 1
+                    LOGGER_QUEUE_DEPTH.set(self._queued_count, self._labels)
+                self._condition.notify_all()
+
+            start_time = time.time()
+            try:
+                if kind == self._THERMO:
+                    self._logger.log_thermo(payload)
+                    LOGGER_SECONDS.observe(time.time() - start_time,
+                                           self._labels)
+                elif kind == self._TEMP_CONTROLLER:
+                    self._logger.log_temp_controller(payload)
+                    LOGGER_SECONDS.observe(time.time() - start_time,
+                                           self._labels)
+                elif kind == self._CALL:
+                    payload()
+                else:
+                    self._logger.close()
+            except Exception:
+                self._error_count += 1
+                LOGGER_ERRORS.inc(labels=self._labels)
+                logging.getLogger(__name__).exception(
+                    "%s failed" % type(self._logger).__name__)
+            finally:
+                with self._condition:
+                    self._unfinished_count -= 1
+                    self._condition.notify_all()
+
+            if kind == self._CLOSE:
+                return
+
+class ThermoLoggerPipeline(ThermoLogger):
+    def __init__(self):
+        """Create a logger that hands each reading and controller event to
+        the loggers added with add_sink without waiting for them to log it"""
+        super(ThermoLoggerPipeline, self).__init__()
+        self._sinks = []
+
+    # Property holding the ThermoLoggerSinks fed by the pipeline
+    @property
+    def sinks(self):
+        return list(self._sinks)
+
+    def add_sink(self, logger, max_queue=1000,
+                 overflow=ThermoLoggerSink.OverflowPolicies.DROP_OLDEST,
+                 block_secs=1.0, name=None):
+        """Feed logger, and any loggers chained to it, from its own worker
+        thread and return the ThermoLoggerSink
+
+        At most max_queue messages wait for the logger.  When the queue is
+        full overflow decides whether to wait up to block_secs for room
+        (BLOCK), drop the new message (DROP_NEWEST) or drop the oldest
+        queued one (DROP_OLDEST).  A slow logger only ever holds up its own
+        queue.
+
+        The sink's metrics are labelled with name, which must be unique in
+        the pipeline.  It defaults to the logger's class name, numbered if
+        another sink already uses it.
+        """
+        names = [sink.name for sink in self._sinks]
+        if name == None:
+            name = type(logger).__name__
+            number = 1
+            while name in names:
+                number += 1
+                name = "%s_%d" % (type(logger).__name__, number)
+        elif name in names:
+            raise ValueError("Sink '" + name + "' is already in the pipeline")
+        sink = ThermoLoggerSink(logger, max_queue, overflow, block_secs, name)
+        self._sinks.append(sink)
+        return sink
+
+    def _log_thermo_without_chain(self, thermo):
+        for sink in self._sinks:
+            sink.log_thermo(thermo)
+
+    def log_temp_controller(self, temp_controller):
+        """Log a snapshot of the TempController to all configured logs, so
+        the sinks see its state as it was when logged"""
+        super(ThermoLoggerPipeline, self).log_temp_controller(
+            temp_controller.snapshot())
+
+    def _log_temp_controller_without_chain(self, temp_controller):
+        for sink in self._sinks:
+            sink.log_temp_controller(temp_controller)
+
+    def _flush_without_chain(self):
+        """Wait until every sink has logged what was queued and flushed"""
+        for sink in self._sinks:
+            sink.submit(sink.logger.flush)
+        for sink in self._sinks:
+            sink.join()
+
+    def _close_without_chain(self):
+        for sink in self._sinks:
+            sink.close()
+
 # SQLite3/decimal.Decimal converters        
 def adapt_decimal(d):
     return str(d)
@@ -222,17 +955,105 @@ def adapt_decimal(d):
 def convert_decimal(s):
     return Decimal(s)
 
-lite.register_adapter(Decimal, adapt_decimal)
-lite.register_converter("decimal", convert_decimal)
+_decimal_adapters_registered = False
+
+def register_decimal_adapters():
+    """Let sqlite3 store Decimals and convert columns declared decimal back
+    to Decimals.  Called when a database is opened"""
+    global _decimal_adapters_registered
+    if not _decimal_adapters_registered:
+        lite.register_adapter(Decimal, adapt_decimal)
+        lite.register_converter("decimal", convert_decimal)
+        _decimal_adapters_registered = True
+
+class RetentionPolicy(object):
+    def __init__(self, raw_days=None, max_db_bytes=None, minute_days=None,
+                 batch_size=500, vacuum_pages=64):
+        """Create a storage retention policy for a SQLThermoLogger
+
+        Raw points older than raw_days days are deleted once they are
+        covered by the rollups, minute rollups older than minute_days days
+        are deleted, leaving the hour rollups, and the oldest data is
+        deleted while the live data takes up more than max_db_bytes.  Any
+        limit may be None to disable it.  Work is done batch_size rows or
+        vacuum_pages freed pages at a time so each step is a short
+        transaction.
+        """
+        self._raw_days = raw_days
+        self._max_db_bytes = max_db_bytes
+        self._minute_days = minute_days
+        self._batch_size = batch_size
+        self._vacuum_pages = vacuum_pages
+
+    # Property holding the age in days after which raw points are deleted
+    @property
+    def raw_days(self):
+        return self._raw_days
+
+    # Property holding the cap on the size of the live data in bytes
+    @property
+    def max_db_bytes(self):
+        return self._max_db_bytes
+
+    # Property holding the age in days after which minute rollups are
+    # deleted
+    @property
+    def minute_days(self):
+        return self._minute_days
+
+    def cutoff_time(self, resolution, now=None):
+        """Return the epoch second before which the points at resolution, 0
+        meaning the raw points, are deleted for their age, or None if they
+        are kept"""
+        if resolution == 0:
+            days = self._raw_days
+        elif resolution == ROLLUP_RESOLUTIONS[0]:
+            days = self._minute_days
+        else:
+            days = None
+        if days == None:
+            return None
+        if now == None:
+            now = time.time()
+        return int(now) - days * 86400
+
+    # Property holding the number of rows deleted in each step
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    # Property holding the number of pages released in each vacuum step
+    @property
+    def vacuum_pages(self):
+        return self._vacuum_pages
 
 class SQLThermoLogger(ThermoLogger):
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, batch_size=1, flush_secs=None,
+                 retention=None):
         """Create a SQLite3 based temperature logger using database file
-        named dbFile"""
+        named dbFile
+
+        Readings are buffered and written in a single transaction once
+        batch_size readings are buffered or flush_secs seconds have passed
+        since the last write.  Call flush or close to write out the rest.
+        retention is an optional RetentionPolicy applied by maintain.
+        """
         super(SQLThermoLogger, self).__init__()
 
         self._db_file = ""
+        self._conn = None
+        self._batch_size = batch_size
+        self._flush_secs = flush_secs
+        self._retention = retention
+        self._points = []
+        # Maps each sensor id to the [id, sensor_id, start_time, end_time,
+        # state, max_temp_mf, temp_band_mf] of its latest controller
+        # interval, id being None until it is written
+        self._intervals = {}
+        self._changed_intervals = []
+        self._sensor_ids = {}
+        self._last_flush_time = time.time()
         
         self.db_file = db_file
         try:
@@ -251,18 +1072,345 @@ class SQLThermoLogger(ThermoLogger):
         self._db_file = value
         return self._db_file
     
+    # Property holding the number of readings waiting to be written
+    @property
+    def buffered_count(self):
+        return len(self._points)
+
+    def sensor_id(self, serial):
+        """Return the id of the sensors row for serial, adding it if needed"""
+        if serial not in self._sensor_ids:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO sensors(serial) VALUES (?)",
+                    (serial,))
+            self._sensor_ids[serial] = self._conn.execute(
+                "SELECT id FROM sensors WHERE serial = ?",
+                (serial,)).fetchone()[0]
+        return self._sensor_ids[serial]
+
+    def _find_sensor_id(self, serial):
+        """Return the id of the sensors row for serial, or None if nothing
+        has been logged for it.  Unlike sensor_id this never writes"""
+        if serial not in self._sensor_ids:
+            row = self._conn.execute("SELECT id FROM sensors WHERE serial = ?",
+                                     (serial,)).fetchone()
+            if row == None:
+                return None
+            self._sensor_ids[serial] = row[0]
+        return self._sensor_ids[serial]
+
+    def has_point(self, serial, record_time):
+        """Return whether the database has a point from serial at
+        record_time, in seconds since the epoch.  Buffered readings aren't
+        counted until they are flushed"""
+        sensor_id = self._find_sensor_id(serial)
+        if sensor_id == None:
+            return False
+        return self._conn.execute(
+            """SELECT 1 FROM temperature_points
+            WHERE sensor_id = ? AND record_time = ? LIMIT 1""",
+            (sensor_id, int(record_time))).fetchone() != None
+
     def _log_thermo_without_chain(self, thermo):
-        with lite.connect(self.db_file,
-                          detect_types=lite.PARSE_DECLTYPES) as conn:
-            conn.execute("""INSERT INTO temperature_points(thermometer_serial,
-                         record_time, temp_celcius)
-                         VALUES (?, ?, ?)""",
-                         (thermo.serial, datetime.datetime.now(),
-                          thermo.temp_c))
-    
-    def _log_temp_controller_without_chain(self, thermo):
-        # TODO: Write SQL logging code
-        return
+        self._points.append(
+            (self.sensor_id(thermo.serial), int(thermo.timestamp),
+             thermo.temp_millicelcius))
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if (len(self._points) >= self._batch_size or
+            (self._flush_secs != None and
+             time.time() - self._last_flush_time >= self._flush_secs)):
+            self._flush_without_chain()
+    
+    def _log_temp_controller_without_chain(self, temp_controller):
+        """Extend the controller's current interval, or start a new one if
+        its state or thresholds changed"""
+        sensor_id = self.sensor_id(temp_controller.thermometer.serial)
+        settings = (temp_controller.state,
+                    _floor_thousandths(temp_controller.max_temp_f),
+                    _floor_thousandths(temp_controller.temp_band_f))
+        if sensor_id not in self._intervals:
+            self._intervals[sensor_id] = self._latest_interval(sensor_id)
+        interval = self._intervals[sensor_id]
+        event_time = int(temp_controller.current_reading().timestamp)
+        if interval != None:
+            # A stale reading may be older than the last event
+            event_time = max(event_time, interval[3])
+            if event_time - interval[3] <= CONTROLLER_INTERVAL_MAX_GAP_SECS:
+                # The interval lasts until this event even if the state
+                # changed with it
+                interval[3] = event_time
+                self._interval_changed(interval)
+                if tuple(interval[4:]) == settings:
+                    self._flush_if_due()
+                    return
+
+        interval = [None, sensor_id, event_time, event_time] + list(settings)
+        self._intervals[sensor_id] = interval
+        self._interval_changed(interval)
+        self._flush_if_due()
+
+    def _latest_interval(self, sensor_id):
+        """Return the [id, sensor_id, start_time, end_time, state,
+        max_temp_mf, temp_band_mf] of the sensor's latest stored controller
+        interval, or None if it has none
+
+        A fermbot run once a cycle logs each event with a new logger, so
+        its intervals are only extended if they are picked up from the
+        database.
+        """
+        row = self._conn.execute(
+            """SELECT id, sensor_id, start_time, end_time, state,
+            max_temp_millifahrenheit, temp_band_millifahrenheit
+            FROM controller_intervals WHERE sensor_id = ?
+            ORDER BY end_time DESC LIMIT 1""", (sensor_id,)).fetchone()
+        return None if row == None else list(row)
+
+    def _interval_changed(self, interval):
+        if not any(changed is interval
+                   for changed in self._changed_intervals):
+            self._changed_intervals.append(interval)
+
+    def _flush_without_chain(self):
+        """Write all of the buffered readings and update the rollups in a
+        single transaction"""
+        if self._points:
+            start_time = time.time()
+            with self._conn:
+                insert_points(self._conn, self._points)
+            self._points = []
+            SQL_COMMIT_SECONDS.observe(time.time() - start_time)
+        if self._changed_intervals:
+            with self._conn:
+                for interval in self._changed_intervals:
+                    if interval[0] == None:
+                        interval[0] = self._conn.execute(
+                            """INSERT INTO controller_intervals(sensor_id,
+                            start_time, end_time, state,
+                            max_temp_millifahrenheit,
+                            temp_band_millifahrenheit)
+                            VALUES (?, ?, ?, ?, ?, ?)""",
+                            interval[1:]).lastrowid
+                    else:
+                        self._conn.execute(
+                            """UPDATE controller_intervals SET end_time = ?
+                            WHERE id = ?""", (interval[3], interval[0]))
+            self._changed_intervals = []
+        self._last_flush_time = time.time()
+
+    def summary_resolution(self, serial, start_time, end_time,
+                           max_points=SUMMARY_MAX_POINTS):
+        """Return the finest resolution in seconds that covers start_time to
+        end_time in at most max_points rows, 0 meaning the raw points, or the
+        coarsest rollup resolution if none does
+
+        Resolutions the retention policy has already deleted from part of
+        the range are passed over, as are raw points if none are left in it.
+        """
+        span = end_time - start_time
+        if (span <= max_points * ROLLUP_RESOLUTIONS[0] and
+            not self._pruned_from(0, start_time)):
+            # Short enough that counting the raw points in the index is cheap
+            raw_count = self._conn.execute(
+                """SELECT COUNT(*) FROM temperature_points
+                WHERE sensor_id = ? AND record_time BETWEEN ? AND ?""",
+                (self._find_sensor_id(serial), start_time,
+                 end_time)).fetchone()[0]
+            if 0 < raw_count <= max_points:
+                return 0
+
+        for resolution in ROLLUP_RESOLUTIONS[:-1]:
+            if (span // resolution + 1 <= max_points and
+                not self._pruned_from(resolution, start_time)):
+                return resolution
+        return ROLLUP_RESOLUTIONS[-1]
+
+    def _pruned_from(self, resolution, start_time):
+        """Return whether the retention policy deletes the points at
+        resolution from after start_time for their age"""
+        if self._retention == None:
+            return False
+        cutoff_time = self._retention.cutoff_time(resolution)
+        return cutoff_time != None and start_time < cutoff_time
+
+    def summarize(self, serial, start_time, end_time,
+                  max_points=SUMMARY_MAX_POINTS):
+        """Return a list of (time, min, max, mean, count) tuples covering the
+        readings from serial between start_time and end_time in epoch seconds
+
+        Temperatures are in millidegrees Celcius.  The rows are the raw points
+        when there are few enough of them, otherwise the rollups at the
+        resolution picked by summary_resolution, so the cost of a query
+        depends on max_points rather than on the length of the time span.
+        Buffered readings are flushed first.
+        """
+        self._flush_without_chain()
+        sensor_id = self._find_sensor_id(serial)
+        if sensor_id == None:
+            return []
+        resolution = self.summary_resolution(serial, start_time, end_time,
+                                             max_points)
+        if resolution == 0:
+            return [(record_time, temp, temp, float(temp), 1)
+                    for record_time, temp in self._conn.execute(
+                        """SELECT record_time, temp_millicelcius
+                        FROM temperature_points WHERE sensor_id = ?
+                        AND record_time BETWEEN ? AND ?
+                        ORDER BY record_time""",
+                        (sensor_id, start_time, end_time))]
+
+        return [(bucket_time, min_temp, max_temp,
+                 float(sum_temp) / point_count, point_count)
+                for bucket_time, min_temp, max_temp, sum_temp, point_count
+                in self._conn.execute(
+                    """SELECT bucket_time, min_millicelcius, max_millicelcius,
+                    sum_millicelcius, point_count FROM temperature_rollups
+                    WHERE sensor_id = ? AND resolution = ?
+                    AND bucket_time BETWEEN ? AND ? ORDER BY bucket_time""",
+                    (sensor_id, resolution,
+                     start_time - start_time % resolution, end_time))]
+
+    def controller_intervals(self, serial, start_time, end_time):
+        """Return a list of (start_time, end_time, state) tuples of the
+        controller intervals of serial overlapping start_time to end_time in
+        epoch seconds, oldest first
+
+        Only the index is read, so the cost depends on the number of state
+        changes in the range rather than on the number of control cycles.
+        Buffered events are flushed first.
+        """
+        self._flush_without_chain()
+        sensor_id = self._find_sensor_id(serial)
+        if sensor_id == None:
+            return []
+        return self._conn.execute(
+            """SELECT start_time, end_time, state FROM controller_intervals
+            WHERE sensor_id = ? AND end_time >= ? AND start_time <= ?
+            ORDER BY start_time""",
+            (sensor_id, start_time, end_time)).fetchall()
+
+    def duty_cycles(self, serial, start_time, end_time, resolution=86400):
+        """Return a list of (bucket_time, duty_cycle, logged_secs) tuples
+        for each bucket of resolution seconds between start_time and
+        end_time in which serial's controller logged events
+
+        duty_cycle is the fraction of logged_secs, the seconds covered by
+        intervals, that the controller was COOLING.  Buckets start at
+        multiples of resolution, so days are UTC days.
+        """
+        buckets = {}
+        for interval_start, interval_end, state in self.controller_intervals(
+            serial, start_time, end_time):
+            interval_start = max(interval_start, start_time)
+            interval_end = min(interval_end, end_time)
+            bucket_time = interval_start - interval_start % resolution
+            while bucket_time < interval_end:
+                secs = (min(interval_end, bucket_time + resolution) -
+                        max(interval_start, bucket_time))
+                totals = buckets.setdefault(bucket_time, [0, 0])
+                if state == TempController.States.COOLING:
+                    totals[0] += secs
+                totals[1] += secs
+                bucket_time += resolution
+        return [(bucket_time, float(cooling_secs) / logged_secs, logged_secs)
+                for bucket_time, (cooling_secs, logged_secs)
+                in sorted(buckets.iteritems()) if logged_secs]
+
+    def live_data_bytes(self):
+        """Return the size of the database file less its free pages"""
+        return ((self._conn.execute("PRAGMA page_count").fetchone()[0] -
+                 self._conn.execute("PRAGMA freelist_count").fetchone()[0]) *
+                self._conn.execute("PRAGMA page_size").fetchone()[0])
+
+    def _delete_points(self, where, params):
+        """Delete a batch of the oldest raw points matching where that are
+        covered by an hour rollup and return True if any were deleted"""
+        with self._conn:
+            return self._conn.execute(
+                """DELETE FROM temperature_points WHERE id IN (
+                SELECT id FROM temperature_points p WHERE """ + where + """
+                AND EXISTS (SELECT 1 FROM temperature_rollups r
+                WHERE r.sensor_id = p.sensor_id AND r.resolution = ?
+                AND r.bucket_time = p.record_time - p.record_time % ?)
+                ORDER BY id LIMIT ?)""",
+                params + (ROLLUP_RESOLUTIONS[-1], ROLLUP_RESOLUTIONS[-1],
+                          self._retention.batch_size)).rowcount > 0
+
+    def _prune_expired_points(self):
+        cutoff_time = self._retention.cutoff_time(0)
+        if cutoff_time == None:
+            return False
+        return self._delete_points("record_time < ?", (cutoff_time,))
+
+    def _prune_expired_rollups(self):
+        resolution = ROLLUP_RESOLUTIONS[0]
+        cutoff_time = self._retention.cutoff_time(resolution)
+        if cutoff_time == None:
+            return False
+        with self._conn:
+            # Listing the sensors lets the primary key find the rows
+            return self._conn.execute(
+                """DELETE FROM temperature_rollups WHERE rowid IN (
+                SELECT rowid FROM temperature_rollups
+                WHERE sensor_id IN (SELECT id FROM sensors)
+                AND resolution = ? AND bucket_time < ? LIMIT ?)""",
+                (resolution, cutoff_time,
+                 self._retention.batch_size)).rowcount > 0
+
+    def _prune_for_size(self):
+        if (self._retention.max_db_bytes == None or
+            self.live_data_bytes() <= self._retention.max_db_bytes):
+            return False
+        if self._delete_points("1", ()):
+            return True
+
+        # Only rollups are left, so give up the finer ones first
+        for resolution in ROLLUP_RESOLUTIONS:
+            with self._conn:
+                if self._conn.execute(
+                    """DELETE FROM temperature_rollups WHERE rowid IN (
+                    SELECT rowid FROM temperature_rollups
+                    WHERE resolution = ? ORDER BY rowid LIMIT ?)""",
+                    (resolution, self._retention.batch_size)).rowcount > 0:
+                    return True
+        return False
+
+    def _vacuum_step(self):
+        if (self._conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2 or
+            self._conn.execute("PRAGMA freelist_count").fetchone()[0] == 0):
+            return False
+        self._conn.execute("PRAGMA incremental_vacuum(%d)" %
+                           self._retention.vacuum_pages).fetchall()
+        return True
+
+    def maintain(self, time_budget_secs):
+        """Apply the retention policy for at most about time_budget_secs
+        seconds and return True if there is nothing left to do
+
+        Each step deletes or vacuums a small batch in its own transaction, so
+        this can be called in the idle time between control cycles and
+        resumed on the next call when the budget runs out.
+        """
+        if self._retention == None:
+            return True
+
+        deadline = time.time() + time_budget_secs
+        self._flush_without_chain()
+        steps = (self._prune_expired_points, self._prune_expired_rollups,
+                 self._prune_for_size, self._vacuum_step)
+        while time.time() < deadline:
+            if not any(step() for step in steps):
+                return True
+        return False
+
+    def _close_without_chain(self):
+        """Write the buffered readings and close the database connection"""
+        if self._conn != None:
+            self._flush_without_chain()
+            self._conn.close()
+            self._conn = None
  
     def initDatabase(self):
         try:
@@ -273,12 +1421,339 @@ class SQLThermoLogger(ThermoLogger):
                 pass
             else: raise
 
-        self._conn = lite.connect(self.db_file)
+        # The connection may be used from a ThermoLoggerSink's worker thread,
+        # so the logger must only be used by one thread at a time
+        register_decimal_adapters()
+        self._conn = lite.connect(self.db_file, check_same_thread=False)
+        # Only takes effect on a new database so must come before anything
+        # else writes to it.  migrate_thermo_db.py converts older ones
+        self._conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # Write-ahead logging turns each commit into an append to the log
+        # and NORMAL only syncs it at checkpoints, which is still safe from
+        # corruption in WAL mode
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+
+        version = schema_version(self._conn)
+        if version != 0 and version < THERMO_LOGGER_SCHEMA_VERSION:
+            raise ThermoDatabaseError(
+                "Database '" + self.db_file + "' uses schema version " +
+                str(version) + ", run migrate_thermo_db.py to upgrade it")
+
         c = self._conn.cursor()
         with open(THERMO_LOGGER_SQL_FILE, 'r') as init_file:
             init_query = init_file.read()
         c.executescript(init_query)
 
+class SQLThermoReader(object):
+    def __init__(self, db_file, chunk_size=1000):
+        """Create a reader for the readings stored by a SQLThermoLogger in
+        database file db_file, fetching chunk_size rows at a time"""
+        self._db_file = db_file
+        self._chunk_size = chunk_size
+        # Transactions are managed explicitly so bulk reads see one snapshot
+        register_decimal_adapters()
+        self._conn = lite.connect(db_file, isolation_level=None)
+
+    # Property holding the path to the database file
+    @property
+    def db_file(self):
+        return self._db_file
+
+    def sensor_id(self, serial):
+        """Return the id of the sensors row for serial, or None if nothing
+        has been logged for it"""
+        row = self._conn.execute("SELECT id FROM sensors WHERE serial = ?",
+                                 (serial,)).fetchone()
+        return None if row == None else row[0]
+
+    def _select_points(self, sensor_id, start_time, end_time):
+        return self._conn.execute(
+            """SELECT record_time, temp_millicelcius FROM temperature_points
+            WHERE sensor_id = ? AND record_time BETWEEN ? AND ?
+            ORDER BY record_time""", (sensor_id, start_time, end_time))
+
+    def iter_readings(self, serial, start_time, end_time):
+        """Yield a TempReading for each reading from serial between
+        start_time and end_time in epoch seconds, oldest first
+
+        Rows are fetched chunk_size at a time so memory use doesn't depend
+        on the length of the time range.
+        """
+        sensor_id = self.sensor_id(serial)
+        if sensor_id == None:
+            return
+
+        cursor = self._select_points(sensor_id, start_time, end_time)
+        rows = cursor.fetchmany(self._chunk_size)
+        while rows:
+            for record_time, temp in rows:
+                yield TempReading(serial, temp, record_time)
+            rows = cursor.fetchmany(self._chunk_size)
+
+    def iter_points(self, serial=None, start_time=None, end_time=None,
+                    after_id=0):
+        """Yield (id, serial, record_time, temp_millicelcius) for each
+        stored reading with an id above after_id, in id order
+
+        serial, start_time and end_time, when given, limit the readings to
+        one thermometer and to a range of epoch seconds.  Each chunk of
+        chunk_size rows is a separate query starting after the last id
+        seen, so no read transaction is held open between chunks and an
+        export can resume from the last id it wrote.
+        """
+        serials = dict(self._conn.execute("SELECT id, serial FROM sensors"))
+        conditions = ["id > ?"]
+        params = []
+        if serial != None:
+            sensor_id = self.sensor_id(serial)
+            if sensor_id == None:
+                return
+            conditions.append("sensor_id = ?")
+            params.append(sensor_id)
+        if start_time != None:
+            conditions.append("record_time >= ?")
+            params.append(start_time)
+        if end_time != None:
+            conditions.append("record_time <= ?")
+            params.append(end_time)
+        query = ("SELECT id, sensor_id, record_time, temp_millicelcius "
+                 "FROM temperature_points WHERE " +
+                 " AND ".join(conditions) + " ORDER BY id LIMIT ?")
+
+        last_id = after_id
+        while True:
+            rows = self._conn.execute(
+                query, [last_id] + params + [self._chunk_size]).fetchall()
+            for point_id, sensor_id, record_time, temp in rows:
+                if sensor_id not in serials:
+                    serials[sensor_id] = self._conn.execute(
+                        "SELECT serial FROM sensors WHERE id = ?",
+                        (sensor_id,)).fetchone()[0]
+                yield (point_id, serials[sensor_id], record_time, temp)
+            if len(rows) < self._chunk_size:
+                return
+            last_id = rows[-1][0]
+
+    def read_arrays(self, serial, start_time, end_time):
+        """Return a tuple of NumPy arrays of the epoch second timestamps
+        (int64) and temperatures in degrees Celcius (float64) of the readings
+        from serial between start_time and end_time, oldest first
+
+        The arrays are allocated once and filled chunk by chunk without
+        creating per reading objects.  Requires NumPy.
+        """
+        import numpy
+
+        sensor_id = self.sensor_id(serial)
+        if sensor_id == None:
+            return (numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float64))
+
+        # Count and fetch in one transaction so both see the same rows
+        self._conn.execute("BEGIN")
+        try:
+            count = self._conn.execute(
+                """SELECT COUNT(*) FROM temperature_points
+                WHERE sensor_id = ? AND record_time BETWEEN ? AND ?""",
+                (sensor_id, start_time, end_time)).fetchone()[0]
+            points = numpy.empty((count, 2), numpy.int64)
+
+            cursor = self._select_points(sensor_id, start_time, end_time)
+            filled = 0
+            rows = cursor.fetchmany(self._chunk_size)
+            while rows:
+                points[filled:filled + len(rows)] = rows
+                filled += len(rows)
+                rows = cursor.fetchmany(self._chunk_size)
+        finally:
+            self._conn.execute("COMMIT")
+
+        return (numpy.ascontiguousarray(points[:, 0]),
+                points[:, 1] / 1000.0)
+
+    def iter_controller_intervals(self, min_end_time=0):
+        """Yield (id, serial, start_time, end_time, state,
+        max_temp_millifahrenheit, temp_band_millifahrenheit) for each
+        controller interval lasting until min_end_time or later, in id order
+
+        An interval's end time is extended as its controller logs events, so
+        this finds every interval changed since min_end_time.
+        """
+        rows = self._conn.execute(
+            """SELECT controller_intervals.id, serial, start_time, end_time,
+            state, max_temp_millifahrenheit, temp_band_millifahrenheit
+            FROM controller_intervals
+            JOIN sensors ON sensors.id = controller_intervals.sensor_id
+            WHERE end_time >= ? ORDER BY controller_intervals.id""",
+            (min_end_time,))
+        for row in rows:
+            yield (row[0], str(row[1])) + tuple(row[2:])
+
+    def close(self):
+        """Close the database connection"""
+        self._conn.close()
+
+def insert_points(conn, points):
+    """Insert (sensor_id, record_time, temp_millicelcius) points into the
+    thermo logger database of conn and merge them into the rollups, leaving
+    the transaction for the caller to commit"""
+    rollups = _rollup_points(points)
+    conn.executemany(
+        """INSERT INTO temperature_points(sensor_id, record_time,
+        temp_millicelcius)
+        VALUES (?, ?, ?)""", points)
+    # Create any missing buckets empty, then merge the batch in
+    conn.executemany(
+        """INSERT OR IGNORE INTO temperature_rollups(sensor_id, resolution,
+        bucket_time, min_millicelcius, max_millicelcius, sum_millicelcius,
+        point_count)
+        VALUES (?, ?, ?, ?, ?, 0, 0)""",
+        [key + (value[0], value[1]) for key, value in rollups.iteritems()])
+    conn.executemany(
+        """UPDATE temperature_rollups SET
+        min_millicelcius = MIN(min_millicelcius, ?),
+        max_millicelcius = MAX(max_millicelcius, ?),
+        sum_millicelcius = sum_millicelcius + ?,
+        point_count = point_count + ?
+        WHERE sensor_id = ? AND resolution = ? AND bucket_time = ?""",
+        [value + key for key, value in rollups.iteritems()])
+
+def _rollup_points(points):
+    """Aggregate (sensor_id, record_time, temp) points into a dict mapping
+    (sensor_id, resolution, bucket_time) to [min, max, sum, count]"""
+    rollups = {}
+    for sensor_id, record_time, temp in points:
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (sensor_id, resolution, record_time - record_time % resolution)
+            rollup = rollups.get(key)
+            if rollup == None:
+                rollups[key] = [temp, temp, temp, 1]
+            else:
+                rollup[0] = min(rollup[0], temp)
+                rollup[1] = max(rollup[1], temp)
+                rollup[2] += temp
+                rollup[3] += 1
+    return dict((key, tuple(value)) for key, value in rollups.iteritems())
+
+def schema_version(conn):
+    """Return the thermo logger schema version of the database.  Databases
+    created before versioning are version 1 and empty databases version 0"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0 and conn.execute(
+        """SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name = 'temperature_points'""").fetchone()[0]:
+        version = 1
+    return version
+
+def _migrate_v1_to_v2(conn):
+    """Convert the CHAR serials, TIMESTAMP strings and DECIMAL temperatures of
+    version 1 to sensor ids, epoch seconds and integer millidegrees"""
+    conn.execute("""ALTER TABLE temperature_points
+                 RENAME TO temperature_points_v1""")
+    conn.execute("""CREATE TABLE sensors(
+                 id INTEGER PRIMARY KEY,
+                 serial TEXT NOT NULL UNIQUE)""")
+    conn.execute("""CREATE TABLE temperature_points(
+                 id INTEGER PRIMARY KEY,
+                 sensor_id INTEGER NOT NULL REFERENCES sensors(id),
+                 record_time INTEGER NOT NULL,
+                 temp_millicelcius INTEGER NOT NULL)""")
+    conn.execute("""INSERT INTO sensors(serial)
+                 SELECT DISTINCT thermometer_serial FROM temperature_points_v1
+                 WHERE thermometer_serial IS NOT NULL""")
+    # Version 1 stored datetime.now(), so the timestamps are local time
+    conn.execute("""INSERT INTO temperature_points(id, sensor_id, record_time,
+                 temp_millicelcius)
+                 SELECT p.id, s.id,
+                 CAST(strftime('%s', p.record_time, 'utc') AS INTEGER),
+                 CAST(ROUND(p.temp_celcius * 1000) AS INTEGER)
+                 FROM temperature_points_v1 p
+                 JOIN sensors s ON s.serial = p.thermometer_serial
+                 WHERE p.record_time IS NOT NULL
+                 AND p.temp_celcius IS NOT NULL""")
+    conn.execute("DROP TABLE temperature_points_v1")
+    conn.execute("""CREATE INDEX temperature_points_sensor_time
+                 ON temperature_points(sensor_id, record_time,
+                 temp_millicelcius)""")
+    conn.execute("PRAGMA user_version = 2")
+
+def _migrate_v2_to_v3(conn):
+    """Add temperature_rollups and backfill it from the existing points"""
+    conn.execute("""CREATE TABLE temperature_rollups(
+                 sensor_id INTEGER NOT NULL REFERENCES sensors(id),
+                 resolution INTEGER NOT NULL,
+                 bucket_time INTEGER NOT NULL,
+                 min_millicelcius INTEGER NOT NULL,
+                 max_millicelcius INTEGER NOT NULL,
+                 sum_millicelcius INTEGER NOT NULL,
+                 point_count INTEGER NOT NULL,
+                 PRIMARY KEY (sensor_id, resolution, bucket_time))""")
+    for resolution in ROLLUP_RESOLUTIONS:
+        conn.execute("""INSERT INTO temperature_rollups
+                     SELECT sensor_id, ?, record_time - record_time % ?,
+                     MIN(temp_millicelcius), MAX(temp_millicelcius),
+                     SUM(temp_millicelcius), COUNT(*)
+                     FROM temperature_points
+                     GROUP BY sensor_id, record_time - record_time % ?""",
+                     (resolution, resolution, resolution))
+    conn.execute("PRAGMA user_version = 3")
+
+def _migrate_v3_to_v4(conn):
+    """Switch to incremental auto-vacuum, applied by the VACUUM that follows
+    the migrations"""
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("PRAGMA user_version = 4")
+
+def _migrate_v4_to_v5(conn):
+    """Add controller_intervals, which starts empty"""
+    conn.execute("""CREATE TABLE controller_intervals(
+                 id INTEGER PRIMARY KEY,
+                 sensor_id INTEGER NOT NULL REFERENCES sensors(id),
+                 start_time INTEGER NOT NULL,
+                 end_time INTEGER NOT NULL,
+                 state INTEGER NOT NULL,
+                 max_temp_millifahrenheit INTEGER NOT NULL,
+                 temp_band_millifahrenheit INTEGER NOT NULL)""")
+    conn.execute("""CREATE INDEX controller_intervals_sensor_end
+                 ON controller_intervals(sensor_id, end_time, start_time,
+                 state)""")
+    conn.execute("PRAGMA user_version = 5")
+
+# Maps each schema version to the function that upgrades it by one version
+SCHEMA_MIGRATIONS = {1: _migrate_v1_to_v2, 2: _migrate_v2_to_v3,
+                     3: _migrate_v3_to_v4, 4: _migrate_v4_to_v5}
+
+def migrate_database(db_file):
+    """Upgrade the thermo logger database in db_file in place to the current
+    schema version and return a tuple of the old and new versions
+
+    All of the upgrades run in one transaction.  The database is vacuumed
+    afterwards to hand the space freed by the smaller rows back to the file
+    system.
+    """
+    register_decimal_adapters()
+    conn = lite.connect(db_file, isolation_level=None)
+    try:
+        old_version = version = schema_version(conn)
+        if version == 0:
+            return (old_version, version)
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while version < THERMO_LOGGER_SCHEMA_VERSION:
+                SCHEMA_MIGRATIONS[version](conn)
+                version = schema_version(conn)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+        if version != old_version:
+            conn.execute("VACUUM")
+        return (old_version, version)
+    finally:
+        conn.close()
+
 def get_thermometers(bus_master_path):
     thermometers = []
     with open(bus_master_path + SLAVE_LIST_FILE_PATH) as w1_master_slaves_file:
@@ -289,25 +1764,782 @@ def get_thermometers(bus_master_path):
                 
     return thermometers
 
+def _bus_number(name):
+    number = name[len(BUS_MASTER_PREFIX):]
+    return (int(number), name) if number.isdigit() else (None, name)
+
+def get_bus_masters(path):
+    """Return the paths of the 1-wire bus masters at path in bus number
+    order, either path itself if it is a bus master or every w1_bus_master*
+    directory in it"""
+    if os.path.isfile(path + SLAVE_LIST_FILE_PATH):
+        return [path]
+    names = [name for name in os.listdir(path)
+             if name.startswith(BUS_MASTER_PREFIX) and
+             os.path.isfile(os.path.join(path, name) + SLAVE_LIST_FILE_PATH)]
+    return [os.path.join(path, name) for name in sorted(names, key=_bus_number)]
+
+def get_all_thermometers(path):
+    """Return the thermometers on every bus master at path, as found by
+    get_bus_masters, in bus order"""
+    return [thermometer for bus_master_path in get_bus_masters(path)
+            for thermometer in get_thermometers(bus_master_path)]
+
+class ThermometerRegistry(object):
+    Events = enum("ADDED", "REMOVED")
+
+    def __init__(self, bus_master_path, poll_secs=REGISTRY_POLL_SECS):
+        """Create a registry of the thermometers on the bus that keeps the
+        same Thermometer objects between calls to refresh"""
+        self._bus_master_path = bus_master_path
+        self._poll_secs = poll_secs
+        self._thermometers = []
+        self._listeners = []
+        self._slaves = None
+        self._slaves_mtime = None
+        self._last_poll_time = None
+
+        self.refresh()
+
+    # Property holding the path to the 1-wire bus master
+    @property
+    def bus_master_path(self):
+        return self._bus_master_path
+
+    # Property holding the thermometers in bus order
+    @property
+    def thermometers(self):
+        return list(self._thermometers)
+
+    def add_listener(self, listener):
+        """Call listener(event, thermometer) with an Events value each time
+        refresh finds a thermometer was added or removed"""
+        self._listeners.append(listener)
+
+    def refresh(self, force=False):
+        """Update the thermometers if the bus's slave list has changed and
+        return True if any were added or removed
+
+        The slave list is only reread when its modification time changes or
+        poll_secs have passed since it was last read, unless force is True.
+        Thermometers that are still present keep their Thermometer objects.
+        """
+        slaves_path = self.bus_master_path + SLAVE_LIST_FILE_PATH
+        mtime = os.stat(slaves_path).st_mtime
+        now = time.time()
+        if (not force and mtime == self._slaves_mtime and
+            now - self._last_poll_time < self._poll_secs):
+            return False
+
+        self._slaves_mtime = mtime
+        self._last_poll_time = now
+        with open(slaves_path) as w1_master_slaves_file:
+            slaves = w1_master_slaves_file.read()
+        if slaves == self._slaves:
+            return False
+        self._slaves = slaves
+
+        current = dict((t.serial, t) for t in self._thermometers)
+        serials = [slave.strip() for slave in slaves.splitlines()
+                   if slave.startswith(DS18B20_1_WIRE_TYPE_PREFIX)]
+        added = [Thermometer(self.bus_master_path, serial)
+                 for serial in serials if serial not in current]
+        removed = [t for t in self._thermometers if t.serial not in serials]
+
+        current.update((t.serial, t) for t in added)
+        self._thermometers = [current[serial] for serial in serials]
+
+        for thermometer in removed:
+            for listener in self._listeners:
+                listener(self.Events.REMOVED, thermometer)
+        for thermometer in added:
+            for listener in self._listeners:
+                listener(self.Events.ADDED, thermometer)
+        return len(added) > 0 or len(removed) > 0
+
+class MultiBusRegistry(object):
+    Events = ThermometerRegistry.Events
+
+    def __init__(self, path, poll_secs=REGISTRY_POLL_SECS):
+        """Create a registry of the thermometers on every bus master at path,
+        as found by get_bus_masters, with a ThermometerRegistry for each
+
+        Bus masters are looked for again at most every poll_secs seconds, so
+        a bridge added or removed while running is picked up.
+        """
+        self._path = path
+        self._poll_secs = poll_secs
+        self._registries = []
+        self._listeners = []
+        self._last_discovery_time = None
+
+        self.refresh()
+
+    # Property holding the path searched for bus masters
+    @property
+    def path(self):
+        return self._path
+
+    # Property holding the paths of the bus masters in bus order
+    @property
+    def bus_master_paths(self):
+        return [registry.bus_master_path for registry in self._registries]
+
+    # Property holding the thermometers of every bus in bus order
+    @property
+    def thermometers(self):
+        return [thermometer for registry in self._registries
+                for thermometer in registry.thermometers]
+
+    def add_listener(self, listener):
+        """Call listener(event, thermometer) with an Events value each time
+        refresh finds a thermometer was added or removed on any bus"""
+        self._listeners.append(listener)
+
+    def _notify(self, event, thermometer):
+        for listener in self._listeners:
+            listener(event, thermometer)
+
+    def refresh(self, force=False):
+        """Update the bus masters and the thermometers on each and return
+        True if any thermometers were added or removed
+
+        The thermometers of a bus master that appears or disappears are
+        reported as added or removed.  See ThermometerRegistry.refresh.
+        """
+        changed = False
+        now = time.time()
+        if (not force and self._last_discovery_time != None and
+            now - self._last_discovery_time < self._poll_secs):
+            try:
+                for registry in self._registries:
+                    changed = registry.refresh() or changed
+                return changed
+            except EnvironmentError as exc:
+                # A bus master has gone, so look for them again now
+                if exc.errno != errno.ENOENT:
+                    raise
+
+        self._last_discovery_time = now
+        current = dict((registry.bus_master_path, registry)
+                       for registry in self._registries)
+        bus_master_paths = get_bus_masters(self._path)
+        for registry in self._registries:
+            if registry.bus_master_path not in bus_master_paths:
+                for thermometer in registry.thermometers:
+                    self._notify(self.Events.REMOVED, thermometer)
+                changed = True
+
+        registries = []
+        for bus_master_path in bus_master_paths:
+            registry = current.get(bus_master_path)
+            if registry == None:
+                registry = ThermometerRegistry(bus_master_path,
+                                               self._poll_secs)
+                registry.add_listener(self._notify)
+                for thermometer in registry.thermometers:
+                    self._notify(self.Events.ADDED, thermometer)
+                changed = changed or len(registry.thermometers) > 0
+            else:
+                changed = registry.refresh(force) or changed
+            registries.append(registry)
+        self._registries = registries
+        return changed
+
+def trigger_bulk_read(bus_master_path):
+    """Start a simultaneous temperature conversion on every thermometer on
+    the bus.  Returns False if the bus master doesn't support bulk reads
+
+    Subsequent reads of each w1_slave file return the result of the bulk
+    conversion instead of starting a conversion of their own.
+    """
+    bulk_read_path = bus_master_path.rstrip("/") + BULK_READ_FILE_PATH
+    if not os.access(bulk_read_path, os.W_OK):
+        return False
+
+    with open(bulk_read_path, "w") as bulk_read_file:
+        bulk_read_file.write("trigger\n")
+    return True
+
+def _read_or_none(thermometer, deadline):
+    try:
+        return thermometer.read_until(deadline)
+    except TempReadingError:
+        return None
+
+def _last_good_reading(thermometer, max_age_secs):
+    """Return the thermometer's last reading marked as stale, or None if
+    there isn't one at most max_age_secs old"""
+    reading = thermometer.last_reading
+    if (max_age_secs == None or reading == None or
+        reading.age_secs > max_age_secs):
+        return None
+    READ_FALLBACKS.inc(labels=(thermometer.serial,))
+    return reading.as_stale()
+
+def read_thermometers(thermometers, pool=None, budget_secs=None,
+                      max_fallback_age_secs=MAX_FALLBACK_AGE_SECS):
+    """Read all of the thermometers concurrently and return a dict mapping
+    each serial to its TempReading, or to None if the reading failed
+
+    A bulk conversion is triggered first on every bus that supports it so a
+    full cycle costs about one conversion regardless of the number of
+    thermometers.  pool is an optional ThreadPool to reuse between calls.
+
+    With budget_secs failed reads are retried until budget_secs seconds
+    have passed, and reads still unfinished then are abandoned, so this
+    returns within the budget even if a read hangs.  A thermometer that
+    fails is given its last good reading, marked as stale, if it is at most
+    max_fallback_age_secs old.
+    """
+    if not thermometers:
+        return {}
+
+    deadline = None
+    if budget_secs != None:
+        deadline = time.time() + budget_secs
+
+    for bus_master_path in set(t.bus_master_path for t in thermometers):
+        trigger_bulk_read(bus_master_path)
+
+    # Imported here since multiprocessing is slow to import
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+    if pool == None:
+        read_pool = ThreadPool(min(len(thermometers), MAX_READ_THREADS))
+    else:
+        read_pool = pool
+    timed_out = False
+    readings = {}
+    try:
+        results = [(thermometer,
+                    read_pool.apply_async(_read_or_none,
+                                          (thermometer, deadline)))
+                   for thermometer in thermometers]
+        for thermometer, result in results:
+            try:
+                if deadline == None:
+                    reading = result.get()
+                else:
+                    reading = result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                READ_TIMEOUTS.inc(labels=(thermometer.serial,))
+                timed_out = True
+                reading = None
+
+            if reading == None:
+                reading = _last_good_reading(thermometer,
+                                             max_fallback_age_secs)
+            readings[thermometer.serial] = reading
+    finally:
+        if pool == None:
+            read_pool.close()
+            # Waiting for the pool's threads would wait for a hung read
+            if not timed_out:
+                read_pool.join()
+
+    return readings
+
+def sample_bus(bus_master_path, pool=None):
+    """Read every thermometer on the bus concurrently.  See read_thermometers
+    """
+    return read_thermometers(get_thermometers(bus_master_path), pool)
+
+def _sample_bus(bus_master_path, thermometers, deadline, readings):
+    """Trigger a bulk conversion on the bus and read its thermometers in
+    turn into the dict readings
+
+    Every thermometer is read once before any failed read is retried with
+    what is left until deadline, so a failing thermometer can't use up the
+    budget of the others on the bus.
+    """
+    trigger_bulk_read(bus_master_path)
+    for thermometer in thermometers:
+        readings[thermometer.serial] = _read_or_none(thermometer, None)
+    for thermometer in thermometers:
+        if readings[thermometer.serial] == None and deadline != None:
+            readings[thermometer.serial] = _read_or_none(thermometer,
+                                                         deadline)
+
+class MultiBusSampler(object):
+    def __init__(self, registry):
+        """Create a sampler of the thermometers in registry, a
+        MultiBusRegistry or ThermometerRegistry, with a worker thread for
+        each bus master
+
+        A bus master talks to one device at a time, so each worker reads its
+        bus's thermometers in turn, while the workers run at the same time
+        so the buses convert and are read in parallel.
+        """
+        self._registry = registry
+        self._workers = {}
+        self._pending = {}
+
+    # Property holding the registry of the thermometers sampled
+    @property
+    def registry(self):
+        return self._registry
+
+    def sample(self, budget_secs=None,
+               max_fallback_age_secs=MAX_FALLBACK_AGE_SECS):
+        """Read every thermometer in the registry and return a dict mapping
+        each serial to its TempReading, or to None if the reading failed
+
+        budget_secs and max_fallback_age_secs are as for read_thermometers.
+        A bus whose worker is still stuck in an earlier sample isn't read,
+        and its thermometers are given their last good readings, so a hung
+        bus doesn't hold up the others.
+        """
+        # Imported here since multiprocessing is slow to import
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+
+        deadline = None
+        if budget_secs != None:
+            deadline = time.time() + budget_secs
+
+        thermometers = self._registry.thermometers
+        buses = collections.OrderedDict()
+        for thermometer in thermometers:
+            buses.setdefault(thermometer.bus_master_path, []).append(
+                thermometer)
+        for bus_master_path in list(self._workers):
+            if bus_master_path not in buses:
+                self._workers.pop(bus_master_path).close()
+                del self._pending[bus_master_path]
+
+        samples = []
+        for bus_master_path, bus_thermometers in buses.iteritems():
+            pending = self._pending.get(bus_master_path)
+            if pending != None and not pending.ready():
+                continue
+            if bus_master_path not in self._workers:
+                self._workers[bus_master_path] = ThreadPool(1)
+            bus_readings = {}
+            self._pending[bus_master_path] = self._workers[
+                bus_master_path].apply_async(
+                    _sample_bus, (bus_master_path, bus_thermometers,
+                                  deadline, bus_readings))
+            samples.append((self._pending[bus_master_path], bus_readings))
+
+        readings = {}
+        for result, bus_readings in samples:
+            try:
+                if deadline == None:
+                    result.get()
+                else:
+                    result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                pass
+            # Keep whatever a timed out worker read in time
+            readings.update(dict(bus_readings))
+
+        for thermometer in thermometers:
+            if thermometer.serial not in readings:
+                READ_TIMEOUTS.inc(labels=(thermometer.serial,))
+                readings[thermometer.serial] = None
+            if readings[thermometer.serial] == None:
+                readings[thermometer.serial] = _last_good_reading(
+                    thermometer, max_fallback_age_secs)
+        return readings
+
+    def close(self):
+        """Stop the workers, without waiting for any stuck in a read"""
+        for worker in self._workers.values():
+            worker.close()
+        self._workers = {}
+        self._pending = {}
+
+class ReadingHistory(object):
+    def __init__(self, serial, capacity=HISTORY_SAMPLES):
+        """Create a history of the last capacity readings of the thermometer
+        serial
+
+        The readings are kept in fixed size arrays used as a ring buffer.
+        The mean, minimum, maximum and least squares slope of the readings
+        held are kept up to date as each reading is added, in constant time
+        per reading, so they are cheap to ask for every cycle.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self._serial = serial
+        self._capacity = capacity
+        self._temps = array.array("l", [0] * capacity)
+        self._times = array.array("d", [0.0] * capacity)
+        self._added_count = 0
+        self._last_reading = None
+
+        # Sums over the readings held, kept in integers so removing a
+        # reading exactly undoes adding it.  Times are in milliseconds from
+        # the first reading, temperatures in thousandths of a degree Celcius
+        self._origin_time = None
+        self._sum_temp = 0
+        self._sum_time = 0
+        self._sum_time_squared = 0
+        self._sum_time_temp = 0
+
+        # (sequence number, temperature) pairs with increasing temperatures
+        # for the minimum and decreasing ones for the maximum, so the front
+        # of each is the extreme of the readings held
+        self._min_candidates = collections.deque()
+        self._max_candidates = collections.deque()
+
+    # Serial property
+    @property
+    def serial(self):
+        return self._serial
+
+    # Capacity property
+    @property
+    def capacity(self):
+        return self._capacity
+
+    # Property holding the most recently added reading
+    @property
+    def last_reading(self):
+        return self._last_reading
+
+    def __len__(self):
+        return min(self._added_count, self._capacity)
+
+    def _relative_time(self, timestamp):
+        return int(round((timestamp - self._origin_time) * 1000))
+
+    def add(self, reading):
+        """Add reading, a TempReading, dropping the oldest reading if the
+        history is full"""
+        if self._origin_time == None:
+            self._origin_time = reading.timestamp
+
+        index = self._added_count % self._capacity
+        if self._added_count >= self._capacity:
+            old_temp = self._temps[index]
+            old_time = self._relative_time(self._times[index])
+            self._sum_temp -= old_temp
+            self._sum_time -= old_time
+            self._sum_time_squared -= old_time * old_time
+            self._sum_time_temp -= old_time * old_temp
+
+        temp = reading.temp_millicelcius
+        relative_time = self._relative_time(reading.timestamp)
+        self._temps[index] = temp
+        self._times[index] = reading.timestamp
+        self._sum_temp += temp
+        self._sum_time += relative_time
+        self._sum_time_squared += relative_time * relative_time
+        self._sum_time_temp += relative_time * temp
+
+        # Each reading is appended and popped at most once, so this is
+        # constant time on average
+        sequence = self._added_count
+        oldest_kept = sequence - self._capacity + 1
+        while self._min_candidates and self._min_candidates[-1][1] >= temp:
+            self._min_candidates.pop()
+        self._min_candidates.append((sequence, temp))
+        if self._min_candidates[0][0] < oldest_kept:
+            self._min_candidates.popleft()
+        while self._max_candidates and self._max_candidates[-1][1] <= temp:
+            self._max_candidates.pop()
+        self._max_candidates.append((sequence, temp))
+        if self._max_candidates[0][0] < oldest_kept:
+            self._max_candidates.popleft()
+
+        self._added_count += 1
+        self._last_reading = reading
+
+    # Property holding the mean temperature of the readings held
+    @property
+    def mean_millicelcius(self):
+        """Return a float that is the mean temperature in thousandths of a
+        degree Celcius, or None if the history is empty"""
+        if self._added_count == 0:
+            return None
+        return float(self._sum_temp) / len(self)
+
+    # Property holding the lowest temperature of the readings held
+    @property
+    def min_millicelcius(self):
+        if self._added_count == 0:
+            return None
+        return self._min_candidates[0][1]
+
+    # Property holding the highest temperature of the readings held
+    @property
+    def max_millicelcius(self):
+        if self._added_count == 0:
+            return None
+        return self._max_candidates[0][1]
+
+    # Property holding the trend of the readings held
+    @property
+    def slope_millicelcius_per_hour(self):
+        """Return a float that is the least squares slope of the readings
+        held in thousandths of a degree Celcius per hour, or None if there
+        are fewer than two readings at different times"""
+        count = len(self)
+        denominator = (count * self._sum_time_squared -
+                       self._sum_time * self._sum_time)
+        if count < 2 or denominator == 0:
+            return None
+        numerator = (count * self._sum_time_temp -
+                     self._sum_time * self._sum_temp)
+        return float(numerator) * 3600000 / denominator
+
+    def smoothed_reading(self):
+        """Return the last reading with its temperature replaced by the
+        mean of the readings held, rounded to a thousandth of a degree, or
+        None if the history is empty"""
+        if self._added_count == 0:
+            return None
+        return TempReading(self._serial,
+                           int(round(self.mean_millicelcius)),
+                           self._last_reading.timestamp)
+
+class ReadingHistories(object):
+    def __init__(self, capacity=HISTORY_SAMPLES):
+        """Create a ReadingHistory of capacity readings for each thermometer
+        as its readings are added"""
+        self._capacity = capacity
+        self._histories = {}
+
+    def history(self, serial):
+        """Return the ReadingHistory of serial, or None if it has none"""
+        return self._histories.get(serial)
+
+    def discard(self, serial):
+        """Forget the history of serial, for a thermometer that was
+        removed"""
+        self._histories.pop(serial, None)
+
+    def add_readings(self, readings):
+        """Add each reading of readings, a dict mapping serials to
+        TempReadings such as returned by read_thermometers, to its
+        thermometer's history.  Failed and stale readings are skipped"""
+        for serial, reading in readings.iteritems():
+            if reading == None or reading.stale:
+                continue
+            history = self._histories.get(serial)
+            if history == None:
+                history = ReadingHistory(serial, self._capacity)
+                self._histories[serial] = history
+            history.add(reading)
+
+    def smoothed_readings(self, readings):
+        """Return a copy of readings with each reading replaced by the
+        smoothed reading of its thermometer's history.  Failed readings stay
+        None and stale ones are kept as they are"""
+        smoothed = {}
+        for serial, reading in readings.iteritems():
+            history = self._histories.get(serial)
+            if (reading != None and not reading.stale and history != None and
+                history.last_reading is reading):
+                reading = history.smoothed_reading()
+            smoothed[serial] = reading
+        return smoothed
+
+class ReadingSnapshot(object):
+    """The latest readings published by the process sampling the bus, as
+    returned by read_snapshot"""
+    __slots__ = ("_published_time", "_readings", "_slopes",
+                 "_controller_states")
+
+    def __init__(self, published_time, readings, slopes, controller_states):
+        self._published_time = published_time
+        self._readings = readings
+        self._slopes = slopes
+        self._controller_states = controller_states
+
+    # Property holding the time the snapshot was published in seconds since
+    # the epoch
+    @property
+    def published_time(self):
+        return self._published_time
+
+    # Property holding the seconds since the snapshot was published
+    @property
+    def age_secs(self):
+        return time.time() - self._published_time
+
+    # Property holding a dict mapping each serial to its TempReading, or to
+    # None if it failed to read
+    @property
+    def readings(self):
+        return self._readings
+
+    # Property holding a dict mapping each serial to the trend of its
+    # ReadingHistory in thousandths of a degree Celcius per hour, or None
+    @property
+    def slopes(self):
+        return self._slopes
+
+    # Property holding a dict mapping the serial of each controller's
+    # thermometer to its TempController state
+    @property
+    def controller_states(self):
+        return self._controller_states
+
+def publish_snapshot(file_name, readings, histories=None,
+                     temp_controllers=()):
+    """Write readings, a dict mapping serials to TempReadings or None, the
+    trends from histories, a ReadingHistories, and the states of
+    temp_controllers to file_name for read_snapshot
+
+    The snapshot is written to a temporary file that is renamed over
+    file_name, so readers never see a partial one.  Put it on a tmpfs such
+    as /run so publishing every cycle costs no SD card writes.
+    """
+    import json
+
+    snapshot = {"published_time": time.time(), "readings": {}, "slopes": {},
+                "controller_states": {}}
+    for serial, reading in readings.iteritems():
+        if reading == None:
+            snapshot["readings"][serial] = None
+        else:
+            snapshot["readings"][serial] = [reading.temp_millicelcius,
+                                            reading.timestamp, reading.stale]
+        history = None if histories == None else histories.history(serial)
+        snapshot["slopes"][serial] = (None if history == None else
+                                      history.slope_millicelcius_per_hour)
+    for temp_controller in temp_controllers:
+        snapshot["controller_states"][temp_controller.thermometer.serial] = (
+            temp_controller.state)
+
+    directory = os.path.dirname(file_name)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_file_name = "%s.%d.tmp" % (file_name, os.getpid())
+    with open(temp_file_name, "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(",", ":"))
+    os.rename(temp_file_name, file_name)
+
+def read_snapshot(file_name):
+    """Return the ReadingSnapshot last published to file_name, or None if
+    there isn't one.  This never touches the 1-wire bus"""
+    import json
+
+    try:
+        with open(file_name) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+
+    readings = {}
+    for serial, reading in snapshot["readings"].iteritems():
+        serial = str(serial)
+        if reading == None:
+            readings[serial] = None
+        else:
+            readings[serial] = TempReading(serial, reading[0], reading[1],
+                                           reading[2])
+    return ReadingSnapshot(
+        snapshot["published_time"], readings,
+        dict((str(serial), slope)
+             for serial, slope in snapshot["slopes"].iteritems()),
+        dict((str(serial), state) for serial, state
+             in snapshot["controller_states"].iteritems()))
+
+class DeviceJournal(object):
+    # Bytes read from the end of the journal to find the last transition
+    TAIL_BYTES = 256
+
+    def __init__(self, file_name):
+        """Create an append-only journal of a device's state transitions
+        stored in file_name, creating its directory if needed"""
+        self._file_name = file_name
+
+        directory = os.path.dirname(file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # Property holding the path to the journal file
+    @property
+    def file_name(self):
+        return self._file_name
+
+    def record(self, state, timestamp, latency_secs):
+        """Append a transition to state at timestamp that took latency_secs
+        seconds to actuate"""
+        with open(self.file_name, "a") as journal_file:
+            journal_file.write("%.3f %d %.6f\n" % (timestamp, state,
+                                                    latency_secs))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def last_state(self):
+        """Return the state recorded by the last transition, or None if
+        there isn't one.  Only the end of the journal is read"""
+        try:
+            with open(self.file_name, "rb") as journal_file:
+                journal_file.seek(0, os.SEEK_END)
+                journal_file.seek(max(0, journal_file.tell() - self.TAIL_BYTES))
+                lines = journal_file.read().splitlines()
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+        if not lines or not lines[-1].split():
+            return None
+        # Files written before the journal hold just the state
+        fields = lines[-1].split()
+        try:
+            return int(fields[1] if len(fields) > 1 else fields[0])
+        except ValueError:
+            return None
+
 class ControlledDevice(object):
     States = enum("OFF", "ON")
 
-    def __init__(self):
+    def __init__(self, journal=None):
+        """Create a device, recording its transitions in journal, a
+        DeviceJournal, if given"""
         self._state = self.States.OFF
+        self._journal = journal
+        self._last_actuation_secs = None
     
     @property
     def state(self):
         return self._state
+
+    # Property holding the DeviceJournal recording the transitions
+    @property
+    def journal(self):
+        return self._journal
+
+    # Property holding the seconds taken by the last state transition
+    @property
+    def last_actuation_secs(self):
+        return self._last_actuation_secs
     
     def turn_on(self):
-        """Turn on the controlled device.  Subclasses must implement this
-        method
-        """
-        raise TypeError('Abstract method `' + self._class.__name__ \
-                            + '.' + self._function + '\' called')
+        """Turn on the controlled device if it isn't already on"""
+        return self._transition(self.States.ON)
     
     def turn_off(self):
-        """Turn off the controlled device.  Subclasses must implement this
+        """Turn off the controlled device if it isn't already off"""
+        return self._transition(self.States.OFF)
+
+    def _transition(self, state):
+        """Actuate the device only if state differs from the current state,
+        journal the transition and return True if there was one"""
+        if state == self._state:
+            return False
+
+        start_time = time.time()
+        self._actuate(state)
+        self._last_actuation_secs = time.time() - start_time
+        ACTUATION_SECONDS.observe(self._last_actuation_secs,
+                                  (type(self).__name__,))
+        self._state = state
+        if self._journal != None:
+            self._journal.record(state, start_time, self._last_actuation_secs)
+        return True
+
+    def _actuate(self, state):
+        """Drive the hardware to state.  Subclasses must implement this
         method
         """
         raise TypeError('Abstract method `' + self._class.__name__ \
@@ -316,58 +2548,64 @@ class ControlledDevice(object):
 class MockDevice(ControlledDevice):
     MOCK_FILE_NAME = os.path.join(cwd, "mock_device")
     
-    def __init__(self):
-        super(MockDevice, self).__init__()
+    def __init__(self, file_name=MOCK_FILE_NAME):
+        """Create a device that only exists as its journal in file_name"""
+        super(MockDevice, self).__init__(DeviceJournal(file_name))
         
-        # Get the current state from the mock file but create the file
-        # first if it doesn't already exist
-        if os.path.getsize(self.MOCK_FILE_NAME):
-            with open(self.MOCK_FILE_NAME, "a") as f:
-                f.write("0")
-        with open(self.MOCK_FILE_NAME, "r") as f:
-            f.seek(0, 0)
-            if f.read(1) == 1:
-                self._state = self.States.ON
-            else:
-                self._state = self.States.OFF
-    
-    def turn_on(self):
-        self._state = self.States.ON
-        with open(self.MOCK_FILE_NAME, "w") as f:
-            f.truncate(0)
-            f.seek(0)
-            f.write("1")
-        return
-    
-    def turn_off(self): 
-        self._state = self.States.OFF
-        with open(self.MOCK_FILE_NAME, "w") as f:
-            f.truncate(0)
-            f.seek(0)
-            f.write("0")
+        # Recover the state from the end of the journal
+        if self.journal.last_state() == self.States.ON:
+            self._state = self.States.ON
+        else:
+            self._state = self.States.OFF
+
+    # Property holding the file standing in for the device
+    @property
+    def file_name(self):
+        return self.journal.file_name
+
+    def _actuate(self, state):
+        # Journaling the transition is the only I/O
         return
     
 class PiDevice(ControlledDevice):
     PIN = 12
     
-    def __init__(self):
-        super(PiDevice, self).__init__()
-        GPIO.setup(self.PIN, GPIO.OUT)
+    def __init__(self, pin=PIN, journal=None):
+        """Create a device driven by GPIO board pin, recording its
+        transitions in journal, a DeviceJournal, if given
+
+        The state is recovered from the end of the journal and the pin
+        driven to match, since the pin resets when the Pi reboots.  Without
+        a journal entry it is read from the pin.
+        """
+        super(PiDevice, self).__init__(journal)
+        self._pin = pin
+        GPIO = _get_gpio()
+        GPIO.setup(self.pin, GPIO.OUT)
         
-        if (GPIO.input(self.PIN) == 1):
+        last_state = None
+        if self.journal != None:
+            last_state = self.journal.last_state()
+        if last_state != None:
+            self._state = (self.States.ON if last_state == self.States.ON
+                           else self.States.OFF)
+            GPIO.output(self.pin, self._state == self.States.ON)
+        elif (GPIO.input(self.pin) == 1):
             self._state = self.States.ON
         else:
             self._state = self.States.OFF
-    
-    def turn_on(self):
-        self._state = self.States.ON
-        GPIO.output(self.PIN, True)
-        return
-    
-    def turn_off(self):
-        self._state = self.States.OFF
-        GPIO.output(self.PIN, False)
-        return
+
+    # Property holding the GPIO board pin number driving the device
+    @property
+    def pin(self):
+        return self._pin
+
+    def _actuate(self, state):
+        _get_gpio().output(self.pin, state == self.States.ON)
+
+def _floor_thousandths(value):
+    """Return the int floor of value, a Decimal or int, in thousandths"""
+    return int((Decimal(value) * 1000).to_integral_value(ROUND_FLOOR))
 
 class TempController(object):
     States = enum("OFF", "COOLING")
@@ -380,6 +2618,13 @@ class TempController(object):
         self._max_temp_f = max_temp_f
         self._temp_band_f = temp_band_f
         self._state = self.States.OFF
+        self._reading = None
+        self._last_process_time = None
+
+        # Readings are whole thousandths of a degree, so comparing them to
+        # the floor of each threshold in thousandths is exact
+        self._max_temp_mf = _floor_thousandths(max_temp_f)
+        self._band_bottom_mf = _floor_thousandths(max_temp_f - temp_band_f)
 
     # Property holding the thermometer for this temp controller
     @property
@@ -416,26 +2661,187 @@ class TempController(object):
     def device(self):
         return self._device
     
-    def process(self):
-        if (self.thermometer.temp_f > self.max_temp_f):
+    # Property holding the reading used by the last call to process
+    @property
+    def reading(self):
+        return self._reading
+
+    def current_reading(self):
+        """Return the reading used by the last call to process, reading the
+        thermometer only if process hasn't been called yet"""
+        if (self.reading == None):
+            return self.thermometer.read()
+        return self.reading
+
+    def snapshot(self):
+        """Return a TempControllerSnapshot of the controller as it is now"""
+        return TempControllerSnapshot(self)
+
+    def process(self, reading=None):
+        """Apply the control logic to reading, a TempReading from this
+        controller's thermometer.  The thermometer is read once if no reading
+        is given"""
+        start_time = time.time()
+        labels = (self.thermometer.serial,)
+        if (self._last_process_time != None and
+            self.device.state == ControlledDevice.States.ON):
+            COOLING_SECONDS.inc(start_time - self._last_process_time, labels)
+        self._last_process_time = start_time
+
+        if (reading == None):
+            reading = self.thermometer.read()
+        self._reading = reading
+
+        temp_mf = reading.temp_millifahrenheit
+        if (temp_mf > self._max_temp_mf):
             self.state = self.States.COOLING
             self.device.turn_on()
         elif (self.device.state == ControlledDevice.States.ON and
-              self.thermometer.temp_f > self.max_temp_f - self.temp_band_f):
+              temp_mf > self._band_bottom_mf):
             self.state = self.States.COOLING
         else:
             self.state = self.States.OFF
             self.device.turn_off()
+
+        COOLING.set(int(self.device.state == ControlledDevice.States.ON),
+                    labels)
+        PROCESS_SECONDS.observe(time.time() - start_time, labels)
         return
 
-class TempControllerFactory(object):
-    if (IS_RASPBERRY_PI):
-        device = PiDevice()
+class TempControllerSnapshot(object):
+    """An immutable copy of the parts of a TempController that are logged
+
+    Has the same thermometer, reading, max_temp_f, temp_band_f and state
+    attributes as the TempController it was taken from.
+    """
+    __slots__ = ("_thermometer", "_reading", "_max_temp_f", "_temp_band_f",
+                 "_state")
+
+    def __init__(self, temp_controller):
+        self._thermometer = temp_controller.thermometer
+        self._reading = temp_controller.current_reading()
+        self._max_temp_f = temp_controller.max_temp_f
+        self._temp_band_f = temp_controller.temp_band_f
+        self._state = temp_controller.state
+
+    @property
+    def thermometer(self):
+        return self._thermometer
+
+    @property
+    def reading(self):
+        return self._reading
+
+    @property
+    def max_temp_f(self):
+        return self._max_temp_f
+
+    @property
+    def temp_band_f(self):
+        return self._temp_band_f
+
+    @property
+    def state(self):
+        return self._state
+
+    def current_reading(self):
+        """Return the reading the controller had when the snapshot was taken
+        """
+        return self._reading
+
+    def snapshot(self):
+        return self
+
+class TempControllerSet(object):
+    def __init__(self, temp_controllers):
+        """Create a set of temperature controllers that are processed
+        together from one sample of the bus"""
+        self._temp_controllers = list(temp_controllers)
+
+    # Property holding the temperature controllers
+    @property
+    def temp_controllers(self):
+        return list(self._temp_controllers)
+
+    def process(self, readings):
+        """Process each controller with its thermometer's reading from
+        readings, a dict mapping serials to TempReadings such as returned by
+        read_thermometers, and return the controllers that were processed
+
+        Controllers without a reading are skipped, leaving their devices as
+        they are.
+        """
+        processed = []
+        for temp_controller in self._temp_controllers:
+            reading = readings.get(temp_controller.thermometer.serial)
+            if reading != None:
+                temp_controller.process(reading)
+                processed.append(temp_controller)
+        return processed
+
+def _create_device(pin):
+    """Return a new device driven by GPIO board pin, journaling its
+    transitions.  Off the Pi each pin gets its own MockDevice file"""
+    if (is_raspberry_pi()):
+        return PiDevice(pin, DeviceJournal(os.path.join(
+            settings.DEVICE_JOURNAL_DIR, "device_" + str(pin) + ".journal")))
+    elif pin == PiDevice.PIN:
+        return MockDevice()
     else:
-        device = MockDevice()
+        return MockDevice(MockDevice.MOCK_FILE_NAME + "_" + str(pin))
+
+class TempControllerFactory(object):
+    # Devices are created on first use, which may mean setting up GPIO pins
+    # or reading journals
+    _devices = {}
     
     @classmethod
     def simpleCoolingController(cls, bus_path, max_temp_f, temp_band_f):
-        return TempController(cls.device, get_thermometers(bus_path)[-1],
+        return TempController(cls.device_for_pin(PiDevice.PIN),
+                              get_all_thermometers(bus_path)[-1],
                               max_temp_f, temp_band_f)
 
+    @classmethod
+    def device_for_pin(cls, pin):
+        """Return the device driven by GPIO board pin, creating it on first
+        use"""
+        if pin not in cls._devices:
+            cls._devices[pin] = _create_device(pin)
+        return cls._devices[pin]
+
+    @classmethod
+    def coolingControllerSet(cls, bus_path, fermenters):
+        """Return a TempControllerSet with a cooling controller for each
+        fermenter in fermenters, a list of dicts with these keys
+
+        serial -- the fermenter's thermometer serial, or None for the last
+                  thermometer on the last bus
+        pin -- the GPIO board pin driving the fermenter's cooling device
+        max_temp_f, temp_band_f -- the controller's temperature settings
+
+        bus_path is a bus master or a directory of them, as for
+        get_bus_masters.  A thermometer missing from every bus is expected
+        on the first.
+        """
+        pins = [fermenter["pin"] for fermenter in fermenters]
+        if len(set(pins)) != len(pins):
+            raise ValueError("Each fermenter must use a different pin")
+
+        thermometers = get_all_thermometers(bus_path)
+        temp_controllers = []
+        for fermenter in fermenters:
+            if fermenter["serial"] == None:
+                thermometer = thermometers[-1]
+            else:
+                found = [t for t in thermometers
+                         if t.serial == fermenter["serial"]]
+                if found:
+                    thermometer = found[0]
+                else:
+                    thermometer = Thermometer(get_bus_masters(bus_path)[0],
+                                              fermenter["serial"])
+            temp_controllers.append(TempController(
+                cls.device_for_pin(fermenter["pin"]), thermometer,
+                fermenter["max_temp_f"], fermenter["temp_band_f"]))
+        return TempControllerSet(temp_controllers)
+
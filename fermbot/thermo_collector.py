@@ -0,0 +1,182 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Running this script starts the collector that fermbots upload their
+# readings and controller intervals to when UPLINK_URL is set in
+# fermbot_thermo_settings.py.  Everything is stored in one thermo logger
+# database, the same schema each fermbot keeps locally, with the id of the
+# last reading stored from each node so uploads that are sent again aren't
+# stored twice.  Each upload is a batch stored in one transaction, so one
+# collector keeps up with dozens of nodes.
+
+import thermo, thermo_uplink, json, argparse, logging, threading
+import BaseHTTPServer, SocketServer
+import sqlite3 as lite
+
+DEFAULT_PORT = 8642
+
+class Collector(object):
+    def __init__(self, db_file):
+        """Create a collector storing uploads in the thermo logger database
+        db_file"""
+        self._db_file = db_file
+        self._lock = threading.Lock()
+        # Create the database, or check its schema is current
+        thermo.SQLThermoLogger(db_file).close()
+        self._conn = lite.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        with self._conn:
+            # The id of the last reading stored from each node, and the
+            # interval each of its controller intervals is stored as
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS node_cursors(
+                               node TEXT PRIMARY KEY,
+                               point_id INTEGER NOT NULL)""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS node_intervals(
+                               node TEXT NOT NULL,
+                               node_interval_id INTEGER NOT NULL,
+                               interval_id INTEGER NOT NULL
+                                   REFERENCES controller_intervals(id),
+                               PRIMARY KEY (node, node_interval_id))""")
+        self._sensor_ids = {}
+
+    # Property holding the path to the database file
+    @property
+    def db_file(self):
+        return self._db_file
+
+    def cursor(self, node):
+        """Return the id node gave the last reading stored from it, or 0 if
+        there are none"""
+        row = self._conn.execute(
+            "SELECT point_id FROM node_cursors WHERE node = ?",
+            (node,)).fetchone()
+        return 0 if row == None else row[0]
+
+    def _sensor_id(self, serial):
+        if serial not in self._sensor_ids:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO sensors(serial) VALUES (?)", (serial,))
+            self._sensor_ids[serial] = self._conn.execute(
+                "SELECT id FROM sensors WHERE serial = ?",
+                (serial,)).fetchone()[0]
+        return self._sensor_ids[serial]
+
+    def _store_interval(self, node, interval):
+        (node_interval_id, serial, start_time, end_time, state, max_mf,
+         band_mf) = interval
+        row = self._conn.execute(
+            """SELECT interval_id FROM node_intervals
+            WHERE node = ? AND node_interval_id = ?""",
+            (node, node_interval_id)).fetchone()
+        if row != None:
+            self._conn.execute(
+                "UPDATE controller_intervals SET end_time = ? WHERE id = ?",
+                (end_time, row[0]))
+            return
+        interval_id = self._conn.execute(
+            """INSERT INTO controller_intervals(sensor_id, start_time,
+            end_time, state, max_temp_millifahrenheit,
+            temp_band_millifahrenheit)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (self._sensor_id(serial), start_time, end_time, state, max_mf,
+             band_mf)).lastrowid
+        self._conn.execute(
+            """INSERT INTO node_intervals(node, node_interval_id, interval_id)
+            VALUES (?, ?, ?)""", (node, node_interval_id, interval_id))
+
+    def store(self, data):
+        """Store the readings of an upload not stored already and its
+        controller intervals, and return the node's new cursor.  Raises
+        ValueError if data isn't a valid upload
+
+        The readings, intervals and cursor are committed in one transaction,
+        so an upload is either stored whole or not at all.
+        """
+        node, points, intervals = thermo_uplink.decode_payload(data)
+        with self._lock:
+            try:
+                with self._conn:
+                    cursor = self.cursor(node)
+                    thermo.insert_points(self._conn, [
+                        (self._sensor_id(serial), record_time, temp)
+                        for point_id, serial, record_time, temp in points
+                        if point_id > cursor])
+                    for interval in intervals:
+                        self._store_interval(node, interval)
+                    if points and points[-1][0] > cursor:
+                        cursor = points[-1][0]
+                        self._conn.execute(
+                            """INSERT OR REPLACE INTO node_cursors(node,
+                            point_id) VALUES (?, ?)""", (node, cursor))
+            except:
+                # Sensors added by the rolled back transaction are gone
+                self._sensor_ids = {}
+                raise
+        return cursor
+
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self._conn.close()
+
+class CollectorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != thermo_uplink.UPLOAD_PATH:
+            self.send_error(404)
+            return
+        data = self.rfile.read(int(self.headers.getheader("Content-Length",
+                                                          0)))
+        try:
+            cursor = self.server.collector.store(data)
+        except ValueError as exc:
+            self.send_error(400, str(exc))
+            return
+
+        body = json.dumps({"id": cursor})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug("%s %s" % (self.client_address[0],
+                                                     format % args))
+
+class CollectorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, collector):
+        """Create a server storing the uploads it receives on address, a
+        (host, port) tuple, with collector"""
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           CollectorRequestHandler)
+        self.collector = collector
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect the readings uploaded by fermbots")
+    parser.add_argument("--db", dest="db_file", default="collector.db",
+                        help="database to store them in "
+                        "(default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="port to listen on (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    collector = Collector(args.db_file)
+    server = CollectorServer((args.host, args.port), collector)
+    logging.getLogger(__name__).info("Collecting on http://%s:%d/" %
+                                     server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        collector.close()
+
+if __name__ == '__main__':
+    main()
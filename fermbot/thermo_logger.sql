@@ -1,9 +1,51 @@
 PRAGMA foreign_keys = ON;
  
 --DROP TABLE IF EXISTS temperature_points;
+--DROP TABLE IF EXISTS sensors;
  
+CREATE TABLE IF NOT EXISTS sensors(
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL UNIQUE);
+ 
+-- record_time is in seconds since the epoch and temp_millicelcius is in
+-- thousandths of a degree Celcius
 CREATE TABLE IF NOT EXISTS temperature_points(
     id INTEGER PRIMARY KEY,
-    thermometer_serial CHAR(64),
-    record_time TIMESTAMP,
-    temp_celcius DECIMAL(6,3));
+    sensor_id INTEGER NOT NULL REFERENCES sensors(id),
+    record_time INTEGER NOT NULL,
+    temp_millicelcius INTEGER NOT NULL);
+ 
+-- Covers per-sensor time range queries without touching the table
+CREATE INDEX IF NOT EXISTS temperature_points_sensor_time
+    ON temperature_points(sensor_id, record_time, temp_millicelcius);
+ 
+-- Per-sensor aggregates of temperature_points over buckets of resolution
+-- seconds starting at bucket_time, maintained as the points are inserted
+CREATE TABLE IF NOT EXISTS temperature_rollups(
+    sensor_id INTEGER NOT NULL REFERENCES sensors(id),
+    resolution INTEGER NOT NULL,
+    bucket_time INTEGER NOT NULL,
+    min_millicelcius INTEGER NOT NULL,
+    max_millicelcius INTEGER NOT NULL,
+    sum_millicelcius INTEGER NOT NULL,
+    point_count INTEGER NOT NULL,
+    PRIMARY KEY (sensor_id, resolution, bucket_time));
+ 
+-- Runs of one TempController state, from the first to the last event logged
+-- in it.  state is a TempController.States value and the thresholds are in
+-- thousandths of a degree Fahrenheit
+CREATE TABLE IF NOT EXISTS controller_intervals(
+    id INTEGER PRIMARY KEY,
+    sensor_id INTEGER NOT NULL REFERENCES sensors(id),
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    max_temp_millifahrenheit INTEGER NOT NULL,
+    temp_band_millifahrenheit INTEGER NOT NULL);
+ 
+-- Covers the intervals of a sensor overlapping a time range, found by the
+-- range of end times after its start
+CREATE INDEX IF NOT EXISTS controller_intervals_sensor_end
+    ON controller_intervals(sensor_id, end_time, start_time, state);
+ 
+PRAGMA user_version = 5;
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Counters, gauges and histograms exported in the Prometheus text format for
+# the node exporter's textfile collector.  Recording a value takes a lock
+# and a few arithmetic operations, so the instrumentation stays on in
+# production.
+import os, bisect, threading
+
+# Histogram bucket upper bounds in seconds, from a cached sysfs read up to a
+# stalled DS18B20 conversion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+def _escape_label_value(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+def _format_labels(names, values, extra=""):
+    pairs = ["%s=\"%s\"" % (name, _escape_label_value(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, label_names=()):
+        """Create a metric with a value for each tuple of label values.
+        Use the MetricsRegistry methods to create one"""
+        self._name = name
+        self._help = help
+        self._label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    # Name property
+    @property
+    def name(self):
+        return self._name
+
+    # Property holding the names of the labels
+    @property
+    def label_names(self):
+        return self._label_names
+
+    def value(self, labels=()):
+        """Return the value for the tuple of label values labels, or None if
+        nothing has been recorded for them"""
+        with self._lock:
+            return self._values.get(tuple(labels))
+
+    def _samples(self):
+        """Return a list of (suffix, labels text, value) to render"""
+        with self._lock:
+            values = sorted(self._values.items())
+        return [("", _format_labels(self._label_names, labels), value)
+                for labels, value in values]
+
+    def render(self):
+        """Return the metric in the Prometheus text format"""
+        lines = ["# HELP %s %s" % (self._name, self._help),
+                 "# TYPE %s %s" % (self._name, self.TYPE)]
+        for suffix, labels, value in self._samples():
+            lines.append("%s%s%s %s" % (self._name, suffix, labels,
+                                        _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, labels=()):
+        """Add amount, which mustn't be negative, to the count for labels"""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, label_names)
+        self._buckets = tuple(sorted(buckets))
+
+    # Property holding the bucket upper bounds, excluding +Inf
+    @property
+    def buckets(self):
+        return self._buckets
+
+    def observe(self, value, labels=()):
+        """Count value in the smallest bucket holding it"""
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts == None:
+                # A count per bucket, the +Inf bucket, then the sum
+                counts = [0] * (len(self._buckets) + 2)
+                self._values[labels] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+    def value(self, labels=()):
+        """Return (count, sum) of the values observed for labels, or None"""
+        with self._lock:
+            counts = self._values.get(tuple(labels))
+            if counts == None:
+                return None
+            return (sum(counts[:-1]), counts[-1])
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts))
+                            for labels, counts in self._values.items())
+        samples = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),),
+                                    counts[:-1]):
+                cumulative += count
+                samples.append(("_bucket", _format_labels(
+                    self._label_names, labels,
+                    "le=\"%s\"" % _format_value(float(bound))), cumulative))
+            label_text = _format_labels(self._label_names, labels)
+            samples.append(("_sum", label_text, counts[-1]))
+            samples.append(("_count", label_text, cumulative))
+        return samples
+
+class MetricsRegistry(object):
+    def __init__(self):
+        """Create an empty set of metrics"""
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    # Property holding the registered metrics in registration order
+    @property
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics)
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in [m.name for m in self._metrics]:
+                raise ValueError("Metric '" + metric.name +
+                                 "' is already registered")
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()):
+        return self._register(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def render(self, kinds=None):
+        """Return every metric, or only those that are instances of the
+        classes in the tuple kinds, in the Prometheus text format"""
+        return "".join(metric.render() for metric in self.metrics
+                       if kinds == None or isinstance(metric, kinds))
+
+    def write_textfile(self, file_name, kinds=None):
+        """Write every metric, or only those of kinds as for render, to
+        file_name for the node exporter's textfile collector
+
+        The metrics are written to a temporary file in the same directory
+        which is then renamed over file_name, so the collector never sees a
+        partly written file.
+        """
+        temp_file_name = "%s.%d.tmp" % (file_name, os.getpid())
+        try:
+            with open(temp_file_name, "w") as f:
+                f.write(self.render(kinds))
+            os.rename(temp_file_name, file_name)
+        except EnvironmentError:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+
+# The registry holding the metrics of thermo and fermbot_thermo
+REGISTRY = MetricsRegistry()
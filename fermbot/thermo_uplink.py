@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Uploads the readings and controller intervals stored in a fermbot's thermo
+# logger database to a central collector, thermo_collector.py, so several
+# fermbots can be watched from one database.  Readings are sent in id order,
+# in batches of compressed, delta encoded JSON, and the id of the last one
+# the collector acknowledged is kept on the fermbot, so uploads pick up where
+# they left off after a failure or a restart and nothing is stored twice.
+import os, time, json, zlib, logging, urllib2, collections, itertools
+import thermo
+import thermo_metrics as metrics
+
+# Path the collector accepts uploads on
+UPLOAD_PATH = "/upload"
+
+UPLINK_RECORDS = metrics.REGISTRY.counter(
+    "fermbot_uplink_records_total",
+    "Readings acknowledged by the collector")
+UPLINK_FAILURES = metrics.REGISTRY.counter(
+    "fermbot_uplink_failures_total", "Uploads to the collector that failed")
+UPLINK_CURSOR = metrics.REGISTRY.gauge(
+    "fermbot_uplink_cursor",
+    "Id of the last reading acknowledged by the collector")
+
+def _delta_encode(values):
+    return [value - previous
+            for previous, value in zip([0] + values[:-1], values)]
+
+def _delta_decode(deltas):
+    values = []
+    total = 0
+    for delta in deltas:
+        total += delta
+        values.append(total)
+    return values
+
+def encode_payload(node, points, intervals):
+    """Return the compressed body of an upload from node of points, a list
+    of (id, serial, record_time, temp_millicelcius) tuples in id order as
+    yielded by SQLThermoReader.iter_points, and intervals, a list of
+    controller interval tuples yielded by
+    SQLThermoReader.iter_controller_intervals
+
+    The points of each thermometer are sent as columns of ids, times and
+    temperatures, each delta encoded, so a reading taken at the usual
+    interval and barely changed costs a few bytes before compression.
+    """
+    readings = collections.OrderedDict()
+    for point in points:
+        columns = readings.setdefault(point[1], ([], [], []))
+        for column, value in zip(columns, (point[0], point[2], point[3])):
+            column.append(value)
+
+    payload = {"node": node,
+               "readings": [[serial] + [_delta_encode(column)
+                                        for column in columns]
+                            for serial, columns in readings.iteritems()],
+               "intervals": [list(interval) for interval in intervals]}
+    return zlib.compress(json.dumps(payload, separators=(",", ":")))
+
+def decode_payload(data):
+    """Return a tuple of the node, the list of points in id order and the
+    list of controller intervals of an upload made by encode_payload
+
+    Raises ValueError if data isn't a valid upload.
+    """
+    try:
+        payload = json.loads(zlib.decompress(data))
+        points = []
+        for serial, ids, times, temps in payload["readings"]:
+            points.extend((point_id, str(serial), record_time, temp)
+                          for point_id, record_time, temp
+                          in zip(_delta_decode(ids), _delta_decode(times),
+                                 _delta_decode(temps)))
+        points.sort()
+        intervals = [(interval_id, str(serial), start_time, end_time, state,
+                      max_mf, band_mf)
+                     for (interval_id, serial, start_time, end_time, state,
+                          max_mf, band_mf) in payload["intervals"]]
+        return (str(payload["node"]), points, intervals)
+    except (zlib.error, KeyError, TypeError) as exc:
+        raise ValueError("Invalid upload: " + str(exc))
+
+def read_state(state_file):
+    """Return the id of the last acknowledged reading and the end time of
+    the last acknowledged controller intervals stored in state_file, or
+    zeros if it doesn't exist"""
+    if not os.path.exists(state_file):
+        return (0, 0)
+    with open(state_file) as f:
+        state = json.load(f)
+    return (int(state["id"]), int(state["interval_time"]))
+
+def write_state(state_file, last_id, interval_time):
+    """Store last_id and interval_time in state_file, replacing it in one
+    step"""
+    temp_file = state_file + ".tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"id": last_id, "interval_time": interval_time}, f)
+    os.rename(temp_file, state_file)
+
+class UplinkThermoLogger(thermo.ThermoLogger):
+    def __init__(self, url, node, db_file, state_file, batch_size=1000,
+                 flush_secs=None, timeout_secs=10, retry_secs=5,
+                 max_retry_secs=300):
+        """Create a logger uploading what a SQLThermoLogger stores in the
+        database file db_file to the collector at url, the base URL of a
+        thermo_collector.py server, as node
+
+        The readings and controller events logged here only prompt an
+        upload once flush_secs seconds have passed since the last, while
+        what is uploaded is read from the database.  Readings are uploaded
+        batch_size at a time after the last one the collector acknowledged,
+        whose id is kept in state_file, so nothing is lost while the
+        collector can't be reached or the fermbot restarts.  After a failed
+        upload the next attempt waits retry_secs, doubling with each further
+        failure up to max_retry_secs.  Uploads block, so add the logger to a
+        ThermoLoggerPipeline.
+        """
+        super(UplinkThermoLogger, self).__init__()
+        self._url = url.rstrip("/") + UPLOAD_PATH
+        self._node = node
+        self._db_file = db_file
+        self._state_file = state_file
+        self._batch_size = batch_size
+        self._flush_secs = flush_secs
+        self._timeout_secs = timeout_secs
+        self._retry_secs = retry_secs
+        self._max_retry_secs = max_retry_secs
+
+        self._cursor, self._interval_time = read_state(state_file)
+        # Opened on first use, by the pipeline's worker thread
+        self._reader = None
+        self._last_flush_time = time.time()
+        self._failures = 0
+        self._retry_time = None
+
+    # Property holding the name the collector knows this node by
+    @property
+    def node(self):
+        return self._node
+
+    # Property holding the id of the last reading the collector acknowledged
+    @property
+    def cursor(self):
+        return self._cursor
+
+    def _flush_if_due(self):
+        if (self._flush_secs != None and
+            time.time() - self._last_flush_time >= self._flush_secs):
+            self._flush_without_chain()
+
+    def _log_thermo_without_chain(self, thermo_reading):
+        self._flush_if_due()
+
+    def _log_temp_controller_without_chain(self, temp_controller):
+        self._flush_if_due()
+
+    def _upload(self, points, intervals):
+        """Send points and intervals to the collector and return its cursor"""
+        request = urllib2.Request(
+            self._url, encode_payload(self._node, points, intervals),
+            {"Content-Type": "application/json",
+             "Content-Encoding": "deflate"})
+        response = urllib2.urlopen(request, timeout=self._timeout_secs)
+        try:
+            return int(json.load(response)["id"])
+        finally:
+            response.close()
+
+    def _flush_without_chain(self):
+        """Upload the readings stored since the last one acknowledged a
+        batch at a time, along with the controller intervals changed since,
+        stopping at the first failure until the retry delay has passed"""
+        self._last_flush_time = time.time()
+        if (self._retry_time != None and
+            self._last_flush_time < self._retry_time):
+            return
+        if self._reader == None:
+            self._reader = thermo.SQLThermoReader(self._db_file,
+                                                  self._batch_size)
+
+        points = self._reader.iter_points(after_id=self._cursor)
+        # The collector updates the intervals it already has, so those
+        # ending shortly before the last acknowledged one are sent again in
+        # case they were committed late, from a stale reading
+        intervals = list(self._reader.iter_controller_intervals(
+            self._interval_time - thermo.CONTROLLER_INTERVAL_MAX_GAP_SECS))
+        while True:
+            batch = list(itertools.islice(points, self._batch_size))
+            if not batch and not intervals:
+                return
+            try:
+                cursor = self._upload(batch, intervals)
+                if batch and cursor < batch[-1][0]:
+                    raise ValueError("Collector stopped at reading " +
+                                     str(cursor) + " of " +
+                                     str(batch[-1][0]))
+            except (EnvironmentError, ValueError, KeyError) as exc:
+                # urllib2's errors and socket timeouts are EnvironmentErrors
+                self._failures += 1
+                self._retry_time = time.time() + min(
+                    self._max_retry_secs,
+                    self._retry_secs * 2 ** (self._failures - 1))
+                UPLINK_FAILURES.inc()
+                logging.getLogger(__name__).warning(
+                    "Upload to %s failed: %s" % (self._url, exc))
+                return
+
+            self._failures = 0
+            self._retry_time = None
+            # The collector may be further on than this batch if an earlier
+            # upload was stored after it timed out here
+            self._cursor = max(self._cursor, cursor)
+            if intervals:
+                self._interval_time = max(
+                    [self._interval_time] +
+                    [interval[3] for interval in intervals])
+            write_state(self._state_file, self._cursor, self._interval_time)
+            UPLINK_RECORDS.inc(len(batch))
+            UPLINK_CURSOR.set(self._cursor)
+            intervals = []
+
+    def _close_without_chain(self):
+        """Make a last attempt to upload what is waiting and close the
+        database"""
+        self._retry_time = None
+        self._flush_without_chain()
+        if self._reader != None:
+            self._reader.close()
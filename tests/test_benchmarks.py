@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest, fermbot.thermo, os, time
+import benchmarks.synthetic_bus, benchmarks.bench_thermo
+
+def test_create_bus_sensor_count(tmpdir):
+    bus_path = benchmarks.synthetic_bus.create_bus(str(tmpdir), 300)
+    thermometers = fermbot.thermo.get_thermometers(bus_path)
+    assert len(thermometers) == 300
+    assert len(set(t.serial for t in thermometers)) == 300
+
+def test_create_bus_crc_failures_reproducible(tmpdir):
+    def failures(name):
+        bus_path = benchmarks.synthetic_bus.create_bus(
+            str(tmpdir), 200, crc_failure_rate=0.25, seed=7, name=name)
+        readings = fermbot.thermo.read_thermometers(
+            fermbot.thermo.get_thermometers(bus_path))
+        return sorted(s for s, r in readings.iteritems() if r == None)
+
+    first = failures("w1_bus_master1")
+    assert 20 < len(first) < 80
+    assert failures("w1_bus_master2") == first
+
+def test_create_bus_temp_range(tmpdir):
+    bus_path = benchmarks.synthetic_bus.create_bus(str(tmpdir), 50)
+    for thermometer in fermbot.thermo.get_thermometers(bus_path):
+        assert 10000 <= thermometer.read().temp_millicelcius <= 25000
+
+def test_read_latency(tmpdir):
+    bus_path = benchmarks.synthetic_bus.create_bus(str(tmpdir), 1)
+    thermometer = fermbot.thermo.get_thermometers(bus_path)[0]
+    start_time = time.time()
+    with benchmarks.synthetic_bus.read_latency(0.05):
+        thermometer.read()
+    assert time.time() - start_time >= 0.05
+    start_time = time.time()
+    thermometer.read()
+    assert time.time() - start_time < 0.05
+
+def test_run_benchmarks(tmpdir):
+    results = benchmarks.bench_thermo.run_benchmarks(
+        sensor_count=10, crc_failure_rate=0.2, repeat=2, root=str(tmpdir))
+    assert set(results["results"]) == set([
+        "import_thermo", "get_thermometers", "thermometer_temp_c",
+        "thermometer_temp_f", "read_thermometers", "logger_chain", "sql_inserts",
+        "temp_controller_process", "cycle"])
+    assert results["parameters"]["sensor_count"] == 10
+    assert tmpdir.listdir() == []
+
+def test_compare_results():
+    baseline = {"results": {"a": {"min": 1.0}, "b": {"min": 1.0}}}
+    current = {"results": {"a": {"min": 1.1}, "b": {"min": 1.5},
+                           "c": {"min": 9.0}}}
+    assert benchmarks.bench_thermo.compare_results(
+        baseline, current, 0.25) == [("b", 1.0, 1.5)]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import pytest, fermbot.thermo, fermbot.export_thermo_db, gzip, json, sys
+
+SERIAL = "28-0000041481e8"
+
+def create_database(db_file, count):
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file, batch_size=100)
+    for minute in range(count):
+        thermo_logger.log_thermo(fermbot.thermo.TempReading(
+            SERIAL, 18000 + minute, 1400000400 + minute * 60))
+    thermo_logger.close()
+
+def test_export_points_csv(tmpdir):
+    db_file = str(tmpdir.join("export.db"))
+    create_database(db_file, 250)
+    out_path = str(tmpdir.join("export.csv.gz"))
+    thermo_reader = fermbot.thermo.SQLThermoReader(db_file, chunk_size=64)
+    
+    with gzip.open(out_path, "wb") as out_file:
+        assert fermbot.export_thermo_db.export_points(
+            thermo_reader, out_file) == (250, 250)
+    thermo_reader.close()
+    
+    with gzip.open(out_path) as out_file:
+        lines = out_file.read().splitlines()
+    assert lines[0] == "id,serial,record_time,temp_millicelcius"
+    assert lines[1] == "1,28-0000041481e8,1400000400,18000"
+    assert len(lines) == 251
+
+def test_export_points_jsonl_resumes(tmpdir):
+    db_file = str(tmpdir.join("export.db"))
+    create_database(db_file, 10)
+    out_path = str(tmpdir.join("export.jsonl.gz"))
+    thermo_reader = fermbot.thermo.SQLThermoReader(db_file, chunk_size=4)
+    
+    with gzip.open(out_path, "wb") as out_file:
+        assert fermbot.export_thermo_db.export_points(
+            thermo_reader, out_file, "jsonl", after_id=7) == (3, 10)
+    with gzip.open(out_path, "wb") as out_file:
+        assert fermbot.export_thermo_db.export_points(
+            thermo_reader, out_file, "jsonl", after_id=10) == (0, 10)
+    thermo_reader.close()
+
+def test_main_incremental(tmpdir, monkeypatch):
+    db_file = str(tmpdir.join("export.db"))
+    create_database(db_file, 5)
+    state_file = str(tmpdir.join("export.state"))
+    
+    def export(name):
+        out_path = str(tmpdir.join(name))
+        monkeypatch.setattr(sys, "argv", [
+            "export_thermo_db.py", out_path, "--db", db_file, "--format",
+            "jsonl", "--state", state_file, "--chunk-size", "2"])
+        fermbot.export_thermo_db.main()
+        with gzip.open(out_path) as out_file:
+            return [json.loads(line) for line in out_file]
+    
+    points = export("first.jsonl.gz")
+    assert len(points) == 5
+    assert points[0] == {"id": 1, "serial": SERIAL,
+                         "record_time": 1400000400,
+                         "temp_millicelcius": 18000}
+    assert fermbot.export_thermo_db.read_state(state_file) == 5
+    
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file)
+    thermo_logger.log_thermo(fermbot.thermo.TempReading(SERIAL, 19000,
+                                                        1400001000))
+    thermo_logger.close()
+    
+    assert [point["id"] for point in export("second.jsonl.gz")] == [6]
+    assert export("third.jsonl.gz") == []
+    assert fermbot.export_thermo_db.read_state(state_file) == 6
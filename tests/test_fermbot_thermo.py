@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import pytest, fermbot.fermbot_thermo, fermbot.thermo, inspect, os, time
+import fermbot.display_temps
+import sqlite3 as lite
+
+cwd = os.path.dirname(os.path.abspath(inspect.getfile(
+                   inspect.currentframe())))
+DUAL_THERMO_BUS_PATH = os.path.join(cwd, "data/thermo/dual_thermo_bus_master")
+LOGGING_APP_NAME = "fermbotThermoTest"
+
+def test_fermbot_thermo_run_cycles(tmpdir):
+    db_file = str(tmpdir.join("fermbot_thermo.db"))
+    fermbot_thermo = fermbot.fermbot_thermo.FermbotThermo(
+        DUAL_THERMO_BUS_PATH, LOGGING_APP_NAME, db_file)
+    
+    try:
+        fermbot_thermo.run_cycle()
+        fermbot_thermo.run_cycle()
+    finally:
+        fermbot_thermo.close()
+    
+    temp_controller = fermbot_thermo.temp_controllers.temp_controllers[0]
+    assert temp_controller.reading != None
+    with lite.connect(db_file) as conn:
+        assert conn.execute(
+            "SELECT COUNT(*) FROM temperature_points").fetchone()[0] == 4
+
+def test_fermbot_thermo_exports_metrics(tmpdir):
+    metrics_file = str(tmpdir.join("fermbot_thermo.prom"))
+    fermbot_thermo = fermbot.fermbot_thermo.FermbotThermo(
+        DUAL_THERMO_BUS_PATH, LOGGING_APP_NAME,
+        str(tmpdir.join("fermbot_thermo.db")), metrics_file)
+    
+    try:
+        fermbot_thermo.run_cycle()
+    finally:
+        fermbot_thermo.close()
+    
+    assert tmpdir.listdir(lambda p: p.ext == ".tmp") == []
+    with open(metrics_file) as f:
+        text = f.read()
+    assert "fermbot_cycle_seconds_count" in text
+    assert 'fermbot_cycle_stage_seconds_count{stage="read"}' in text
+    assert 'fermbot_thermometer_read_seconds_count{serial="28-' in text
+
+def test_fermbot_thermo_exports_only_gauges_once(tmpdir):
+    metrics_file = str(tmpdir.join("fermbot_thermo.prom"))
+    fermbot_thermo = fermbot.fermbot_thermo.FermbotThermo(
+        DUAL_THERMO_BUS_PATH, LOGGING_APP_NAME,
+        str(tmpdir.join("fermbot_thermo.db")), metrics_file, resident=False)
+    
+    try:
+        fermbot_thermo.run_cycle()
+    finally:
+        fermbot_thermo.close()
+    
+    with open(metrics_file) as f:
+        text = f.read()
+    assert "fermbot_last_cycle_timestamp_seconds " in text
+    assert "fermbot_cycle_seconds" not in text
+    assert "fermbot_controller_cooling_seconds_total" not in text
+
+def test_fermbot_thermo_publishes_snapshot(tmpdir):
+    snapshot_file = str(tmpdir.join("snapshot.json"))
+    fermbot_thermo = fermbot.fermbot_thermo.FermbotThermo(
+        DUAL_THERMO_BUS_PATH, LOGGING_APP_NAME,
+        str(tmpdir.join("fermbot_thermo.db")), snapshot_file=snapshot_file)
+    
+    try:
+        fermbot_thermo.run_cycle()
+        fermbot_thermo.run_cycle()
+    finally:
+        fermbot_thermo.close()
+    
+    snapshot = fermbot.thermo.read_snapshot(snapshot_file)
+    assert snapshot.readings["28-0000041462fa"].temp_millicelcius == 18125
+    assert snapshot.slopes["28-0000041462fa"] == 0
+    assert len(snapshot.controller_states) == 1
+
+def test_display_temps_format_temperature():
+    reading = fermbot.thermo.TempReading("28-0000041462fa", 18125,
+                                         time.time() - 90)
+    
+    assert (fermbot.display_temps.format_temperature(reading, None) ==
+            "64.6° F")
+    assert (fermbot.display_temps.format_temperature(reading.as_stale(),
+                                                     -500) ==
+            "64.6° F (90s old) -0.9° F/h")
+    assert (fermbot.display_temps.format_temperature(None, None) ==
+            "Failed to read temperature")
+
+def test_run_periodically():
+    cycle_times = []
+    
+    fermbot.fermbot_thermo.run_periodically(
+        lambda: cycle_times.append(fermbot.fermbot_thermo.time.time()), 0.05,
+        lambda: len(cycle_times) >= 4)
+    
+    assert len(cycle_times) == 4
+    assert cycle_times[-1] - cycle_times[0] == pytest.approx(0.15, abs=0.04)
+
+def test_run_periodically_survives_failed_cycle():
+    cycles = []
+    def cycle():
+        cycles.append(1)
+        raise fermbot.thermo.TempReadingError("Bad reading")
+    
+    fermbot.fermbot_thermo.run_periodically(cycle, 0.01,
+                                            lambda: len(cycles) >= 2)
+    
+    assert len(cycles) == 2
+
+def test_run_periodically_idle():
+    idle_times = []
+    
+    fermbot.fermbot_thermo.run_periodically(
+        lambda: None, 0.05, lambda: len(idle_times) >= 2, idle_times.append)
+    
+    assert len(idle_times) == 2
+    assert 0 < idle_times[0] <= 0.05
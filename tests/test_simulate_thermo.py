@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import pytest, fermbot.thermo, fermbot.simulate_thermo, math, sys
+from decimal import Decimal
+
+SERIAL = "28-0000041481e8"
+
+def wavy_readings(count):
+    """Readings a minute apart swinging between about 62 F and 70 F"""
+    return [fermbot.thermo.TempReading(
+                SERIAL, 18500 + int(2300 * math.sin(minute / 40.0)) +
+                (minute * 37) % 200, 1400000400 + minute * 60)
+            for minute in range(count)]
+
+def test_replay():
+    # Above 66 F (18.889 C) from the second reading until the last
+    readings = [fermbot.thermo.TempReading(SERIAL, temp, minute * 60)
+                for minute, temp in enumerate([18000, 19000, 19000, 18500,
+                                               18000, 19000])]
+    
+    result = fermbot.simulate_thermo.replay(readings, Decimal("66.0"),
+                                            Decimal("1.0"))
+    
+    # On at 60, still on at 180 within the band, off at 240, on at 300
+    assert result == (2, 180.0 / 300, 120, 300)
+    assert fermbot.simulate_thermo.replay([], Decimal("66.0"),
+                                          Decimal("1.0")) == (0, 0.0, 0, 0)
+
+def test_sweep_matches_replay(monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    monkeypatch.setattr(fermbot.simulate_thermo, "SWEEP_CHUNK_SIZE", 97)
+    readings = wavy_readings(1000)
+    max_temps_f = [Decimal("64.0"), Decimal("65.5"), Decimal("66.0"),
+                   Decimal("68.0")]
+    temp_bands_f = [Decimal("0.5"), Decimal("1.0"), Decimal("2.0"),
+                    Decimal("0.25")]
+    
+    results = fermbot.simulate_thermo.sweep(
+        numpy.array([r.timestamp for r in readings]),
+        numpy.array([r.temp_millicelcius for r in readings]),
+        max_temps_f, temp_bands_f)
+    
+    for max_temp_f, band_f, result in zip(max_temps_f, temp_bands_f,
+                                          results):
+        assert result == fermbot.simulate_thermo.replay(readings, max_temp_f,
+                                                        band_f)
+    assert results[0].cycles > 1
+    assert 0 < results[0].duty_cycle < 1
+
+def test_main(tmpdir, monkeypatch, capsys):
+    pytest.importorskip("numpy")
+    db_file = str(tmpdir.join("simulate.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file, batch_size=500)
+    for reading in wavy_readings(500):
+        thermo_logger.log_thermo(reading)
+    thermo_logger.close()
+    
+    outputs = []
+    for exact in ([], ["--exact"]):
+        monkeypatch.setattr(sys, "argv", [
+            "simulate_thermo.py", SERIAL, "--db", db_file,
+            "--max-temps", "65,66", "--bands", "0.5,1"] + exact)
+        fermbot.simulate_thermo.main()
+        outputs.append(capsys.readouterr()[0])
+    
+    assert len(outputs[0].splitlines()) == 5
+    assert outputs[0] == outputs[1]
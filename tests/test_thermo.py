@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-import pytest, fermbot.thermo, logging.config, inspect, os
+import pytest, fermbot.thermo, logging.config, inspect, os, shutil, time
+import threading, datetime, subprocess, sys, gzip
+import benchmarks.synthetic_bus
+from multiprocessing.pool import ThreadPool
 import sqlite3 as lite
 from decimal import Decimal
 
@@ -8,6 +11,7 @@ cwd = os.path.dirname(os.path.abspath(inspect.getfile(
 SINGLE_THERMO_BUS_PATH = os.path.join(cwd,
                                       "data/thermo/single_thermo_bus_master")
 DUAL_THERMO_BUS_PATH = os.path.join(cwd, "data/thermo/dual_thermo_bus_master")
+MULTI_BUS_PATH = os.path.join(cwd, "data/thermo/multi_bus_master")
 BAD_CRC_THERMO_BUS_PATH = os.path.join(cwd,
                                        "data/thermo/bad_crc_thermo_bus_master")
 
@@ -63,6 +67,18 @@ def test_thermometer_temp_f_bad_crc():
     with pytest.raises(fermbot.thermo.TempReadingError):  # @UndefinedVariable
         thermometers[0].temp_f
 
+def test_thermometer_read_instrumented():
+    thermometer = fermbot.thermo.get_thermometers(BAD_CRC_THERMO_BUS_PATH)[0]
+    labels = (thermometer.serial,)
+    errors = fermbot.thermo.READ_ERRORS.value(labels) or 0
+    count = (fermbot.thermo.READ_SECONDS.value(labels) or (0, 0))[0]
+    
+    with pytest.raises(fermbot.thermo.TempReadingError):  # @UndefinedVariable
+        thermometer.read()
+    
+    assert fermbot.thermo.READ_ERRORS.value(labels) == errors + 1
+    assert fermbot.thermo.READ_SECONDS.value(labels)[0] == count + 1
+
 class ListThermoLogger(fermbot.thermo.ThermoLogger):
     """Simple ThermoLogger implementation that stores the temperatures in
     a list"""
@@ -117,14 +133,15 @@ def test_logger_sql_log():
                       detect_types=lite.PARSE_DECLTYPES) as conn:
         conn.row_factory = lite.Row
         cur = conn.cursor()
-        cur.execute("""SELECT * FROM temperature_points
-                    ORDER BY record_time DESC""")
+        cur.execute("""SELECT * FROM temperature_points p
+                    JOIN sensors s ON s.id = p.sensor_id
+                    ORDER BY p.id DESC""")
         r = cur.fetchone()
-        assert r['temp_celcius'] == Decimal("18.125")
-        assert r['thermometer_serial'] == "28-0000041462fa"
+        assert r['temp_millicelcius'] == 18125
+        assert r['serial'] == "28-0000041462fa"
         r = cur.fetchone()
-        assert r['temp_celcius'] == Decimal("19.562")
-        assert r['thermometer_serial'] == "28-0000041481e8"
+        assert r['temp_millicelcius'] == 19562
+        assert r['serial'] == "28-0000041481e8"
  
 def test_logger_chained_log():
     thermo_logger_1 = ListThermoLogger()
@@ -203,3 +220,1218 @@ def test_temp_controller_not_cooling_file_log():
         
         assert (" ".join(last_line.split()[-12:]) == 
                 "28-0000041481e8 at 67.2° F, target is 70.0° F so TC is OFF")
+
+def test_thermometer_read():
+    thermometers = fermbot.thermo.get_thermometers(SINGLE_THERMO_BUS_PATH)
+    reading = thermometers[0].read()
+    
+    assert reading.serial == "28-0000041481e8"
+    assert reading.temp_c == Decimal("19.562")
+    assert reading.temp_f == Decimal("67.212")
+    assert reading.timestamp > 0
+    assert thermometers[0].last_reading is reading
+
+def test_logger_chained_log_reads_once():
+    thermo_logger_1 = ListThermoLogger()
+    thermo_logger_1.add_logger(ListThermoLogger())
+    thermometer = fermbot.thermo.get_thermometers(SINGLE_THERMO_BUS_PATH)[0]
+    
+    thermo_logger_1.log_thermo(thermometer)
+    reading = thermometer.last_reading
+    thermo_logger_1.log_thermo(thermometer)
+    
+    # The chain shares one snapshot per log_thermo call
+    assert thermometer.last_reading is not reading
+    assert thermo_logger_1.next.log_entries == thermo_logger_1.log_entries
+
+def test_temp_controller_uses_given_reading():
+    temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+        SINGLE_THERMO_BUS_PATH, Decimal("65.0"), Decimal("1"))
+    reading = fermbot.thermo.TempReading("28-0000041481e8", 10000, 0)
+    temp_controller.process(reading)
+    
+    assert temp_controller.reading is reading
+    assert temp_controller.state == fermbot.thermo.TempController.States.OFF
+
+def test_read_thermometers():
+    readings = fermbot.thermo.sample_bus(DUAL_THERMO_BUS_PATH)
+    
+    assert len(readings) == 2
+    assert readings["28-0000041481e8"].temp_c == Decimal("19.562")
+    assert readings["28-0000041462fa"].temp_c == Decimal("18.125")
+
+def test_read_thermometers_bad_crc():
+    readings = fermbot.thermo.sample_bus(BAD_CRC_THERMO_BUS_PATH)
+    
+    assert readings == {"28-0000041481e8": None}
+
+def test_read_thermometers_triggers_bulk_read(tmpdir):
+    bus_path = str(tmpdir.join("bus_master"))
+    shutil.copytree(DUAL_THERMO_BUS_PATH, bus_path)
+    bulk_read_path = os.path.join(bus_path, "therm_bulk_read")
+    with open(bulk_read_path, "w") as bulk_read_file:
+        bulk_read_file.write("0\n")
+    
+    readings = fermbot.thermo.sample_bus(bus_path)
+    
+    assert len(readings) == 2
+    with open(bulk_read_path) as bulk_read_file:
+        assert bulk_read_file.read() == "trigger\n"
+
+def test_trigger_bulk_read_unsupported():
+    assert not fermbot.thermo.trigger_bulk_read(DUAL_THERMO_BUS_PATH)
+
+class FlakyThermometer(fermbot.thermo.Thermometer):
+    """Thermometer that fails its first failures reads, and hangs in read
+    while hang is set until release is set"""
+    def __init__(self, bus_master_path, serial, failures=0):
+        super(FlakyThermometer, self).__init__(bus_master_path, serial)
+        self.failures = failures
+        self.reads = 0
+        self.hang = False
+        self.release = threading.Event()
+    
+    def read(self):
+        self.reads += 1
+        if self.hang:
+            self.release.wait()
+        if self.reads <= self.failures:
+            raise fermbot.thermo.TempReadingError("Flaky")
+        return super(FlakyThermometer, self).read()
+
+def test_read_thermometers_retries_within_budget():
+    thermometer = FlakyThermometer(SINGLE_THERMO_BUS_PATH, "28-0000041481e8",
+                                   failures=2)
+    
+    readings = fermbot.thermo.read_thermometers([thermometer],
+                                                budget_secs=2)
+    
+    assert thermometer.reads == 3
+    assert readings["28-0000041481e8"].temp_c == Decimal("19.562")
+    assert not readings["28-0000041481e8"].stale
+
+def test_read_thermometers_no_retry_without_budget():
+    thermometer = FlakyThermometer(SINGLE_THERMO_BUS_PATH, "28-0000041481e8",
+                                   failures=1)
+    
+    assert fermbot.thermo.read_thermometers([thermometer]) == {
+        "28-0000041481e8": None}
+    assert thermometer.reads == 1
+
+def test_read_thermometers_falls_back_to_last_good_reading():
+    thermometer = FlakyThermometer(SINGLE_THERMO_BUS_PATH, "28-0000041481e8")
+    last_reading = thermometer.read()
+    thermometer.failures = 100
+    
+    reading = fermbot.thermo.read_thermometers(
+        [thermometer], budget_secs=0.3)["28-0000041481e8"]
+    
+    assert reading.stale
+    assert reading.timestamp == last_reading.timestamp
+    assert reading.temp_millicelcius == 19562
+    assert reading.age_secs >= 0.3
+    assert fermbot.thermo.read_thermometers(
+        [thermometer], max_fallback_age_secs=0.1) == {"28-0000041481e8": None}
+
+def test_read_thermometers_abandons_hung_read():
+    thermometers = [FlakyThermometer(DUAL_THERMO_BUS_PATH, "28-0000041481e8"),
+                    FlakyThermometer(DUAL_THERMO_BUS_PATH, "28-0000041462fa")]
+    thermometers[0].hang = True
+    pool = ThreadPool(2)
+    
+    try:
+        start_time = time.time()
+        readings = fermbot.thermo.read_thermometers(thermometers, pool, 0.2)
+        assert time.time() - start_time < 0.5
+        assert readings["28-0000041481e8"] == None
+        assert readings["28-0000041462fa"].temp_c == Decimal("18.125")
+        
+        # The hung read is left alone rather than started again
+        readings = fermbot.thermo.read_thermometers(thermometers, pool, 0.2)
+        assert readings["28-0000041481e8"] == None
+        assert thermometers[0].reads == 1
+    finally:
+        thermometers[0].release.set()
+        pool.close()
+        pool.join()
+
+def test_reading_history_matches_brute_force():
+    history = fermbot.thermo.ReadingHistory("28-0000041481e8", 7)
+    temps = [(index * 7919) % 1000 - 500 for index in range(50)]
+    
+    for index, temp in enumerate(temps):
+        history.add(fermbot.thermo.TempReading("28-0000041481e8", temp,
+                                               1400000000 + index * 60.5))
+        window = temps[max(0, index - 6):index + 1]
+        assert len(history) == len(window)
+        assert history.mean_millicelcius == float(sum(window)) / len(window)
+        assert history.min_millicelcius == min(window)
+        assert history.max_millicelcius == max(window)
+
+def test_reading_history_slope():
+    history = fermbot.thermo.ReadingHistory("28-0000041481e8", 5)
+    assert history.mean_millicelcius == None
+    assert history.slope_millicelcius_per_hour == None
+    
+    # Warming by 2 C per hour, then flat
+    for minute in range(10):
+        history.add(fermbot.thermo.TempReading(
+            "28-0000041481e8", 18000 + minute * 2000 // 60,
+            1400000000 + minute * 60))
+    assert abs(history.slope_millicelcius_per_hour - 2000) < 20
+    for minute in range(10, 15):
+        history.add(fermbot.thermo.TempReading(
+            "28-0000041481e8", 21000, 1400000000 + minute * 60))
+    assert history.slope_millicelcius_per_hour == 0
+
+def test_reading_histories_smooth_spike():
+    histories = fermbot.thermo.ReadingHistories(3)
+    serial = "28-0000041481e8"
+    temp_controller = fermbot.thermo.TempController(
+        CountingDevice(), fermbot.thermo.Thermometer(SINGLE_THERMO_BUS_PATH,
+                                                     serial),
+        Decimal("66.0"), Decimal("1"))
+    temp_controller_set = fermbot.thermo.TempControllerSet([temp_controller])
+    
+    # 17.5 C is 63.5 F, 21 C is 69.8 F and their smoothed 18.667 C 65.6 F
+    for minute, temp in enumerate([17500, 17500, 21000, 17500]):
+        readings = {serial: fermbot.thermo.TempReading(serial, temp,
+                                                       minute * 60)}
+        histories.add_readings(readings)
+        smoothed = histories.smoothed_readings(readings)
+        temp_controller_set.process(smoothed)
+        
+        assert temp_controller.device.actuations == []
+    assert smoothed[serial].temp_millicelcius == 18667
+    assert smoothed[serial].timestamp == 180
+    
+    stale = {serial: readings[serial].as_stale(), "28-000000000000": None}
+    histories.add_readings(stale)
+    assert len(histories.history(serial)) == 3
+    assert histories.smoothed_readings(stale) == stale
+
+def test_logger_sql_log_batched(tmpdir):
+    db_file = str(tmpdir.join("batched.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file, batch_size=3)
+    thermometers = fermbot.thermo.get_thermometers(DUAL_THERMO_BUS_PATH)
+    
+    for thermometer in thermometers:
+        thermo_logger.log_thermo(thermometer)
+    
+    with lite.connect(db_file) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute(
+            "SELECT COUNT(*) FROM temperature_points").fetchone()[0] == 0
+        assert thermo_logger.buffered_count == 2
+        
+        thermo_logger.log_thermo(thermometers[0])
+        assert conn.execute(
+            "SELECT COUNT(*) FROM temperature_points").fetchone()[0] == 3
+        assert thermo_logger.buffered_count == 0
+
+def test_logger_sql_log_close_flushes(tmpdir):
+    db_file = str(tmpdir.join("closed.db"))
+    thermo_logger = ListThermoLogger()
+    thermo_logger.add_logger(fermbot.thermo.SQLThermoLogger(db_file,
+                                                            batch_size=100))
+    
+    for thermometer in fermbot.thermo.get_thermometers(DUAL_THERMO_BUS_PATH):
+        thermo_logger.log_thermo(thermometer)
+    thermo_logger.close()
+    
+    with lite.connect(db_file) as conn:
+        assert conn.execute(
+            "SELECT COUNT(*) FROM temperature_points").fetchone()[0] == 2
+
+def create_v1_database(db_file):
+    # Version 1 stored Decimals through the adapters
+    fermbot.thermo.register_decimal_adapters()
+    with lite.connect(db_file) as conn:
+        conn.executescript("""CREATE TABLE temperature_points(
+                           id INTEGER PRIMARY KEY,
+                           thermometer_serial CHAR(64),
+                           record_time TIMESTAMP,
+                           temp_celcius DECIMAL(6,3));""")
+        conn.executemany("""INSERT INTO temperature_points(thermometer_serial,
+                         record_time, temp_celcius) VALUES (?, ?, ?)""",
+                         [("28-0000041481e8",
+                           datetime.datetime(2014, 3, 1, 12, 0, 0, 250000),
+                           Decimal("19.562")),
+                          ("28-0000041462fa",
+                           datetime.datetime(2014, 3, 1, 12, 0, 1),
+                           Decimal("-1.5")),
+                          ("28-0000041481e8",
+                           datetime.datetime(2014, 3, 1, 12, 1, 0),
+                           Decimal("19.625"))])
+
+def test_logger_sql_log_rejects_old_schema(tmpdir):
+    db_file = str(tmpdir.join("v1.db"))
+    create_v1_database(db_file)
+    
+    with pytest.raises(fermbot.thermo.ThermoDatabaseError):
+        fermbot.thermo.SQLThermoLogger(db_file)
+
+def test_migrate_database(tmpdir):
+    db_file = str(tmpdir.join("v1.db"))
+    create_v1_database(db_file)
+    
+    version = fermbot.thermo.THERMO_LOGGER_SCHEMA_VERSION
+    assert fermbot.thermo.migrate_database(db_file) == (1, version)
+    assert fermbot.thermo.migrate_database(db_file) == (version, version)
+    
+    with lite.connect(db_file) as conn:
+        rows = conn.execute("""SELECT s.serial, p.record_time,
+                            p.temp_millicelcius FROM temperature_points p
+                            JOIN sensors s ON s.id = p.sensor_id
+                            ORDER BY p.id""").fetchall()
+        assert rows == [
+            ("28-0000041481e8",
+             int(time.mktime((2014, 3, 1, 12, 0, 0, 0, 0, -1))), 19562),
+            ("28-0000041462fa",
+             int(time.mktime((2014, 3, 1, 12, 0, 1, 0, 0, -1))), -1500),
+            ("28-0000041481e8",
+             int(time.mktime((2014, 3, 1, 12, 1, 0, 0, 0, -1))), 19625)]
+        
+        plan = " ".join(str(row) for row in conn.execute(
+            """EXPLAIN QUERY PLAN SELECT record_time, temp_millicelcius
+            FROM temperature_points WHERE sensor_id = 1
+            AND record_time BETWEEN 0 AND 2000000000"""))
+        assert "COVERING INDEX temperature_points_sensor_time" in plan
+        
+        assert conn.execute("""SELECT min_millicelcius, max_millicelcius,
+                            sum_millicelcius, point_count
+                            FROM temperature_rollups
+                            WHERE sensor_id = 1 AND resolution = 3600
+                            """).fetchall() == [(19562, 19625, 39187, 2)]
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        assert conn.execute(
+            "SELECT COUNT(*) FROM controller_intervals").fetchone()[0] == 0
+    
+    # The migrated database can be logged to
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file)
+    thermo_logger.log_thermo(
+        fermbot.thermo.get_thermometers(SINGLE_THERMO_BUS_PATH)[0])
+    thermo_logger.close()
+
+def log_minute_readings(thermo_logger, serial, start_time, temps):
+    for minute, temp in enumerate(temps):
+        thermo_logger.log_thermo(fermbot.thermo.TempReading(
+            serial, temp, start_time + minute * 60))
+
+def test_logger_sql_rollups(tmpdir):
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        str(tmpdir.join("rollups.db")), batch_size=7)
+    start_time = 1400000400
+    log_minute_readings(thermo_logger, "28-0000041481e8", start_time,
+                        [18000 + minute for minute in range(600)])
+    
+    summary = thermo_logger.summarize("28-0000041481e8", start_time,
+                                      start_time + 36000, 1000)
+    assert len(summary) == 600
+    assert summary[0] == (start_time, 18000, 18000, 18000.0, 1)
+    
+    summary = thermo_logger.summarize("28-0000041481e8", start_time,
+                                      start_time + 36000, 100)
+    assert [row[0] for row in summary] == [start_time + hour * 3600
+                                           for hour in range(10)]
+    assert summary[0] == (start_time, 18000, 18059, 18029.5, 60)
+    assert sum(row[4] for row in summary) == 600
+    
+    summary = thermo_logger.summarize("28-0000041481e8", start_time + 60,
+                                      start_time + 180, 1)
+    assert summary == [(start_time, 18000, 18059, 18029.5, 60)]
+    thermo_logger.close()
+
+def test_logger_sql_summary_resolution(tmpdir):
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        str(tmpdir.join("resolution.db")))
+    serial = "28-0000041481e8"
+    
+    for second in range(0, 1800, 10):
+        thermo_logger.log_thermo(fermbot.thermo.TempReading(
+            serial, 18500, second))
+    
+    assert thermo_logger.summary_resolution(serial, 0, 1800, 200) == 0
+    assert thermo_logger.summary_resolution(serial, 0, 1800, 100) == 60
+    assert thermo_logger.summary_resolution(serial, 0, 86400, 500) == 3600
+    assert thermo_logger.summary_resolution(serial, 0, 10 ** 9, 10) == 3600
+    thermo_logger.close()
+
+def test_logger_sql_queries_unknown_serial(tmpdir):
+    db_file = str(tmpdir.join("unknown.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file)
+    
+    assert thermo_logger.summarize("28-000000000000", 0, 10 ** 9) == []
+    assert thermo_logger.summary_resolution("28-000000000000", 0, 60) == 60
+    assert thermo_logger.controller_intervals("28-000000000000", 0,
+                                              10 ** 9) == []
+    thermo_logger.close()
+    
+    # Queries don't add sensors
+    with lite.connect(db_file) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM sensors").fetchone()[0] == 0
+
+def log_controller_minutes(thermo_logger, temp_controller, start_time,
+                           temps):
+    for minute, temp in enumerate(temps):
+        temp_controller.process(fermbot.thermo.TempReading(
+            temp_controller.thermometer.serial, temp,
+            start_time + minute * 60))
+        thermo_logger.log_temp_controller(temp_controller)
+
+def test_logger_sql_controller_intervals_across_loggers(tmpdir):
+    db_file = str(tmpdir.join("intervals.db"))
+    start_time = 1400000400
+    # Each cycle of a fermbot run from cron logs with a new logger
+    for minute, temp in enumerate([19000] * 5 + [17000] * 3):
+        thermo_logger = fermbot.thermo.SQLThermoLogger(db_file)
+        temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+            SINGLE_THERMO_BUS_PATH, Decimal("65.0"), Decimal("1"))
+        log_controller_minutes(thermo_logger, temp_controller,
+                               start_time + minute * 60, [temp])
+        thermo_logger.close()
+
+    COOLING = fermbot.thermo.TempController.States.COOLING
+    OFF = fermbot.thermo.TempController.States.OFF
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file)
+    assert thermo_logger.controller_intervals(
+        "28-0000041481e8", 0, 2000000000) == [
+        (start_time, start_time + 300, COOLING),
+        (start_time + 300, start_time + 420, OFF)]
+    assert thermo_logger.duty_cycles("28-0000041481e8", 0, 2000000000) == [
+        (1399939200, 300 / 420.0, 420)]
+    thermo_logger.close()
+
+def test_logger_sql_controller_intervals(tmpdir):
+    db_file = str(tmpdir.join("intervals.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file, batch_size=100)
+    temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+        SINGLE_THERMO_BUS_PATH, Decimal("65.0"), Decimal("1"))
+    start_time = 1400000400
+    log_controller_minutes(thermo_logger, temp_controller, start_time,
+                           [19000] * 3 + [17000] * 5 + [19000] * 2)
+    # After a gap a new interval starts rather than extending the last one
+    log_controller_minutes(thermo_logger, temp_controller,
+                           start_time + 3600, [19000, 19000])
+
+    COOLING = fermbot.thermo.TempController.States.COOLING
+    OFF = fermbot.thermo.TempController.States.OFF
+    assert thermo_logger.controller_intervals(
+        "28-0000041481e8", 0, 2000000000) == [
+        (start_time, start_time + 180, COOLING),
+        (start_time + 180, start_time + 480, OFF),
+        (start_time + 480, start_time + 540, COOLING),
+        (start_time + 3600, start_time + 3660, COOLING)]
+    assert thermo_logger.duty_cycles("28-0000041481e8", start_time,
+                                     start_time + 7200, 3600) == [
+        (start_time, 240 / 540.0, 540), (start_time + 3600, 1.0, 60)]
+    thermo_logger.close()
+
+    with lite.connect(db_file) as conn:
+        assert conn.execute("""SELECT max_temp_millifahrenheit,
+                            temp_band_millifahrenheit
+                            FROM controller_intervals""").fetchall() == [
+            (65000, 1000)] * 4
+        plan = " ".join(str(row) for row in conn.execute(
+            """EXPLAIN QUERY PLAN SELECT start_time, end_time, state
+            FROM controller_intervals WHERE sensor_id = 1
+            AND end_time >= 0 AND start_time <= 2000000000"""))
+        assert "COVERING INDEX controller_intervals_sensor_end" in plan
+
+def test_reader_iter_readings(tmpdir):
+    db_file = str(tmpdir.join("reader.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file)
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 18010))
+    log_minute_readings(thermo_logger, "28-0000041462fa", 1400000400,
+                        [-500])
+    thermo_logger.close()
+    
+    thermo_reader = fermbot.thermo.SQLThermoReader(db_file, chunk_size=3)
+    readings = list(thermo_reader.iter_readings(
+        "28-0000041481e8", 1400000400 + 60, 1400000400 + 300))
+    
+    assert [reading.timestamp for reading in readings] == [
+        1400000400 + minute * 60 for minute in range(1, 6)]
+    assert readings[0].temp_c == Decimal("18.001")
+    assert readings[0].serial == "28-0000041481e8"
+    assert list(thermo_reader.iter_readings("28-0000041462fa", 0,
+                                            2000000000))[0].temp_c == \
+        Decimal("-0.5")
+    assert list(thermo_reader.iter_readings("28-000000000000", 0,
+                                            2000000000)) == []
+    thermo_reader.close()
+
+def test_reader_iter_points(tmpdir):
+    db_file = str(tmpdir.join("reader.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file, batch_size=10)
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 18010))
+    log_minute_readings(thermo_logger, "28-0000041462fa", 1400000400,
+                        [-500, -400])
+    thermo_logger.close()
+    
+    thermo_reader = fermbot.thermo.SQLThermoReader(db_file, chunk_size=3)
+    points = list(thermo_reader.iter_points())
+    assert [point[0] for point in points] == range(1, 13)
+    assert points[0] == (1, "28-0000041481e8", 1400000400, 18000)
+    assert points[-1] == (12, "28-0000041462fa", 1400000460, -400)
+    
+    assert list(thermo_reader.iter_points(after_id=9)) == points[9:]
+    assert list(thermo_reader.iter_points(
+        "28-0000041481e8", 1400000400 + 120, 1400000400 + 300)) == points[2:6]
+    assert list(thermo_reader.iter_points("28-000000000000")) == []
+    thermo_reader.close()
+
+def test_reader_read_arrays(tmpdir):
+    numpy = pytest.importorskip("numpy")
+    db_file = str(tmpdir.join("reader.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(db_file, batch_size=50)
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 18100))
+    thermo_logger.close()
+    
+    thermo_reader = fermbot.thermo.SQLThermoReader(db_file, chunk_size=7)
+    times, temps = thermo_reader.read_arrays("28-0000041481e8", 1400000400,
+                                             1400000400 + 60 * 49)
+    
+    assert times.dtype == numpy.int64 and temps.dtype == numpy.float64
+    assert times.flags["C_CONTIGUOUS"] and temps.flags["C_CONTIGUOUS"]
+    assert len(times) == 50
+    assert times[-1] == 1400000400 + 60 * 49
+    assert temps[0] == 18.0 and temps[-1] == 18.049
+    
+    times, temps = thermo_reader.read_arrays("28-000000000000", 0, 1)
+    assert len(times) == 0 and len(temps) == 0
+    thermo_reader.close()
+
+def count_rows(db_file, table, where="1"):
+    with lite.connect(db_file) as conn:
+        return conn.execute("SELECT COUNT(*) FROM " + table +
+                            " WHERE " + where).fetchone()[0]
+
+def test_logger_jsonl_rotates_and_compresses(tmpdir):
+    log_dir = str(tmpdir.join("jsonl"))
+    thermo_logger = fermbot.thermo.JSONLThermoLogger(log_dir, 500, 3)
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 18040))
+    temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+        SINGLE_THERMO_BUS_PATH, Decimal("65.0"), Decimal("1"))
+    temp_controller.process()
+    thermo_logger.log_temp_controller(temp_controller)
+    thermo_logger.close()
+
+    segments = thermo_logger.segments()
+    assert len(segments) == 3
+    assert all(segment.endswith(".jsonl.gz") for segment in segments)
+    records = []
+    for file_name in segments + [os.path.join(log_dir, "thermo.jsonl")]:
+        records.extend(fermbot.thermo.iter_jsonl_records(file_name))
+    # Only the oldest segments were deleted
+    assert [record["temp_millicelcius"] for record in records[:-1]] == range(
+        18040 - len(records) + 1, 18040)
+    assert records[-1] == {
+        "type": "controller", "serial": "28-0000041481e8",
+        "time": temp_controller.current_reading().timestamp,
+        "temp_millicelcius": 19562, "state": "COOLING",
+        "max_temp_millifahrenheit": 65000, "temp_band_millifahrenheit": 1000}
+
+def test_logger_jsonl_ingest(tmpdir):
+    log_dir = str(tmpdir.join("jsonl"))
+    thermo_logger = fermbot.thermo.JSONLThermoLogger(log_dir, 400)
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 18020))
+    thermo_logger.close()
+    # A line cut short by a crash is skipped
+    with open(os.path.join(log_dir, "thermo.jsonl"), "a") as f:
+        f.write('{"type":"reading","serial":"28-00')
+
+    db_file = str(tmpdir.join("ingest.db"))
+    sql_logger = fermbot.thermo.SQLThermoLogger(db_file, 100)
+    count = fermbot.thermo.ingest_jsonl_segments(
+        thermo_logger.segments() + [os.path.join(log_dir, "thermo.jsonl")],
+        sql_logger)
+    sql_logger.close()
+
+    assert count == 20
+    # Loading the segments again adds nothing
+    sql_logger = fermbot.thermo.SQLThermoLogger(db_file, 100)
+    assert fermbot.thermo.ingest_jsonl_segments(
+        thermo_logger.segments() * 2, sql_logger) == 0
+    sql_logger.close()
+    assert count_rows(db_file, "temperature_points") == 20
+    thermo_reader = fermbot.thermo.SQLThermoReader(db_file)
+    readings = list(thermo_reader.iter_readings("28-0000041481e8", 0,
+                                                2000000000))
+    thermo_reader.close()
+    assert [reading.temp_millicelcius for reading in readings] == range(
+        18000, 18020)
+    assert readings[0].timestamp == 1400000400
+
+def write_jsonl_segment(log_dir, name, temp):
+    record = ('{"type":"reading","serial":"28-0000041481e8","time":1400000400,'
+              '"temp_millicelcius":%d}\n' % temp)
+    if ".gz" in name:
+        segment = gzip.open(str(log_dir.join(name)), "wb")
+        segment.write(record)
+        segment.close()
+    else:
+        log_dir.join(name).write(record)
+
+def test_logger_jsonl_segments_counted_once(tmpdir):
+    log_dir = tmpdir.mkdir("jsonl")
+    thermo_logger = fermbot.thermo.JSONLThermoLogger(str(log_dir), 400, 1)
+    # One segment being compressed, one compressed and one compressed but
+    # not yet removed
+    write_jsonl_segment(log_dir, "thermo-1400000400000.jsonl", 18000)
+    write_jsonl_segment(log_dir, "thermo-1400000400000.jsonl.gz.tmp", 18000)
+    write_jsonl_segment(log_dir, "thermo-1400000460000.jsonl.gz", 18001)
+    write_jsonl_segment(log_dir, "thermo-1400000520000.jsonl", 18002)
+    write_jsonl_segment(log_dir, "thermo-1400000520000.jsonl.gz", 18002)
+
+    assert [os.path.basename(segment)
+            for segment in thermo_logger.segments()] == [
+        "thermo-1400000400000.jsonl", "thermo-1400000460000.jsonl.gz",
+        "thermo-1400000520000.jsonl.gz"]
+    # Only the oldest finished segment beyond max_segments is deleted
+    thermo_logger._remove_old_segments()
+    assert [os.path.basename(segment)
+            for segment in thermo_logger.segments()] == [
+        "thermo-1400000400000.jsonl", "thermo-1400000520000.jsonl.gz"]
+    thermo_logger.close()
+
+def test_logger_jsonl_compresses_leftover_segments(tmpdir):
+    log_dir = tmpdir.mkdir("jsonl")
+    write_jsonl_segment(log_dir, "thermo-1400000400000.jsonl", 18000)
+    write_jsonl_segment(log_dir, "thermo-1400000400000.jsonl.gz.tmp", 18000)
+    write_jsonl_segment(log_dir, "thermo-1400000460000.jsonl", 18001)
+    write_jsonl_segment(log_dir, "thermo-1400000460000.jsonl.gz", 18001)
+    thermo_logger = fermbot.thermo.JSONLThermoLogger(str(log_dir))
+    thermo_logger.close()
+
+    assert sorted(os.listdir(str(log_dir))) == [
+        "thermo-1400000400000.jsonl.gz", "thermo-1400000460000.jsonl.gz",
+        "thermo.jsonl"]
+    assert [list(fermbot.thermo.iter_jsonl_records(segment))[0][
+        "temp_millicelcius"] for segment in thermo_logger.segments()] == [
+        18000, 18001]
+
+def test_logger_sql_retention_raw_days(tmpdir):
+    db_file = str(tmpdir.join("retention.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        db_file, batch_size=100,
+        retention=fermbot.thermo.RetentionPolicy(raw_days=1, batch_size=20))
+    now = int(time.time())
+    log_minute_readings(thermo_logger, "28-0000041481e8", now - 3 * 86400,
+                        range(18000, 18100))
+    log_minute_readings(thermo_logger, "28-0000041481e8", now - 3600,
+                        range(18000, 18010))
+    
+    assert thermo_logger.maintain(5)
+    
+    assert count_rows(db_file, "temperature_points") == 10
+    assert count_rows(db_file, "temperature_rollups",
+                      "resolution = 60") == 110
+    with lite.connect(db_file) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    assert thermo_logger.maintain(5)
+    thermo_logger.close()
+
+def test_logger_sql_summarize_after_pruning(tmpdir):
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        str(tmpdir.join("retention.db")), batch_size=100,
+        retention=fermbot.thermo.RetentionPolicy(raw_days=1))
+    serial = "28-0000041481e8"
+    start_time = int(time.time()) - 10 * 86400
+    start_time -= start_time % 3600
+    log_minute_readings(thermo_logger, serial, start_time,
+                        range(18000, 18060))
+    
+    assert thermo_logger.maintain(5)
+    
+    # The pruned hour is summarized from its minute rollups
+    assert thermo_logger.summary_resolution(serial, start_time,
+                                            start_time + 3600) == 60
+    summary = thermo_logger.summarize(serial, start_time, start_time + 3600)
+    assert [row[1] for row in summary] == range(18000, 18060)
+    thermo_logger.close()
+
+def test_logger_sql_retention_minute_days(tmpdir):
+    db_file = str(tmpdir.join("retention.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        db_file, batch_size=100,
+        retention=fermbot.thermo.RetentionPolicy(raw_days=1, minute_days=2,
+                                                 batch_size=20))
+    serial = "28-0000041481e8"
+    now = int(time.time())
+    start_time = now - 3 * 86400
+    start_time -= start_time % 3600
+    log_minute_readings(thermo_logger, serial, start_time,
+                        range(18000, 18100))
+    log_minute_readings(thermo_logger, serial, now - 3600,
+                        range(18000, 18010))
+    
+    assert thermo_logger.maintain(5)
+    
+    assert count_rows(db_file, "temperature_points") == 10
+    assert count_rows(db_file, "temperature_rollups",
+                      "resolution = 60") == 10
+    # Beyond the minute rollups, summaries come from the hour rollups
+    assert thermo_logger.summary_resolution(serial, start_time,
+                                            start_time + 3600) == 3600
+    assert thermo_logger.summarize(serial, start_time,
+                                   start_time + 7200) == [
+        (start_time, 18000, 18059, 18029.5, 60),
+        (start_time + 3600, 18060, 18099, 18079.5, 40)]
+    thermo_logger.close()
+
+def test_logger_sql_retention_max_db_bytes(tmpdir):
+    db_file = str(tmpdir.join("retention.db"))
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        db_file, batch_size=1000,
+        retention=fermbot.thermo.RetentionPolicy(max_db_bytes=64 * 1024))
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 23000))
+    thermo_logger.flush()
+    assert thermo_logger.live_data_bytes() > 64 * 1024
+    
+    assert thermo_logger.maintain(5)
+    
+    assert thermo_logger.live_data_bytes() <= 64 * 1024
+    # The newest data is kept
+    assert count_rows(db_file, "temperature_rollups",
+                      "resolution = 3600") == 84
+    with lite.connect(db_file) as conn:
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    thermo_logger.close()
+
+def test_logger_sql_maintain_time_budget(tmpdir):
+    thermo_logger = fermbot.thermo.SQLThermoLogger(
+        str(tmpdir.join("retention.db")), batch_size=1000,
+        retention=fermbot.thermo.RetentionPolicy(raw_days=0, batch_size=1))
+    log_minute_readings(thermo_logger, "28-0000041481e8", 1400000400,
+                        range(18000, 19000))
+    
+    assert not thermo_logger.maintain(0.01)
+    thermo_logger.close()
+
+def test_temp_reading_fixed_point():
+    reading = fermbot.thermo.TempReading("28-0000041481e8", 19562, 0)
+    
+    assert reading.temp_millicelcius == 19562
+    assert reading.temp_millifahrenheit == 67212
+    assert reading.temp_c == Decimal("19.562")
+    assert reading.temp_f == Decimal("67.212")
+    assert str(fermbot.thermo.TempReading("", 20000, 0).temp_f) == "68.000"
+    with pytest.raises(AttributeError):
+        reading.extra = 1
+
+def test_temp_reading_fahrenheit_matches_decimal():
+    # Covers the DS18B20's -55 C to 125 C range
+    for temp_millicelcius in range(-55000, 125001, 37):
+        reading = fermbot.thermo.TempReading("", temp_millicelcius, 0)
+        
+        assert reading.temp_f == ((Decimal(temp_millicelcius) / 1000 * 9 / 5) +
+                                  32).quantize(Decimal("1.000"))
+
+def test_thermometer_read_garbled(tmpdir):
+    bus_path = str(tmpdir.join("bus_master"))
+    shutil.copytree(SINGLE_THERMO_BUS_PATH, bus_path)
+    with open(os.path.join(bus_path, "28-0000041481e8", "w1_slave"),
+              "w") as w1_slave:
+        w1_slave.write("39 01 4b 46 7f ff 07 10 43 : crc=43 YES\n")
+    
+    with pytest.raises(fermbot.thermo.TempReadingError):
+        fermbot.thermo.get_thermometers(bus_path)[0].read()
+
+def test_temp_controller_threshold_beyond_thousandths():
+    temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+        SINGLE_THERMO_BUS_PATH, Decimal("67.2115"), Decimal("1"))
+    temp_controller.process()
+    
+    assert temp_controller.state == fermbot.thermo.TempController.States.COOLING
+
+def test_thermometer_registry(tmpdir):
+    bus_path = str(tmpdir.join("bus_master"))
+    shutil.copytree(DUAL_THERMO_BUS_PATH, bus_path)
+    slaves_path = os.path.join(bus_path, "w1_master_slaves")
+    registry = fermbot.thermo.ThermometerRegistry(bus_path, poll_secs=3600)
+    events = []
+    registry.add_listener(lambda event, t: events.append((event, t.serial)))
+    thermometers = registry.thermometers
+    
+    assert [t.serial for t in thermometers] == ["28-0000041481e8",
+                                                "28-0000041462fa"]
+    assert not registry.refresh()
+    
+    with open(slaves_path, "w") as slaves_file:
+        slaves_file.write("28-0000041462fa\n")
+    os.utime(slaves_path, (1, 1))
+    
+    assert registry.refresh()
+    assert registry.thermometers == [thermometers[1]]
+    assert events == [(fermbot.thermo.ThermometerRegistry.Events.REMOVED,
+                       "28-0000041481e8")]
+
+def test_thermometer_registry_polls_unchanged_mtime(tmpdir):
+    bus_path = str(tmpdir.join("bus_master"))
+    shutil.copytree(SINGLE_THERMO_BUS_PATH, bus_path)
+    shutil.copytree(os.path.join(DUAL_THERMO_BUS_PATH, "28-0000041462fa"),
+                    os.path.join(bus_path, "28-0000041462fa"))
+    slaves_path = os.path.join(bus_path, "w1_master_slaves")
+    os.utime(slaves_path, (1, 1))
+    registry = fermbot.thermo.ThermometerRegistry(bus_path, poll_secs=0)
+    events = []
+    registry.add_listener(lambda event, t: events.append((event, t.serial)))
+    
+    with open(slaves_path, "a") as slaves_file:
+        slaves_file.write("28-0000041462fa\n")
+    os.utime(slaves_path, (1, 1))
+    
+    assert registry.refresh()
+    assert len(registry.thermometers) == 2
+    assert events == [(fermbot.thermo.ThermometerRegistry.Events.ADDED,
+                       "28-0000041462fa")]
+
+def test_get_bus_masters():
+    assert fermbot.thermo.get_bus_masters(MULTI_BUS_PATH) == [
+        os.path.join(MULTI_BUS_PATH, name) for name in
+        ["w1_bus_master1", "w1_bus_master2", "w1_bus_master10"]]
+    assert fermbot.thermo.get_bus_masters(DUAL_THERMO_BUS_PATH) == [
+        DUAL_THERMO_BUS_PATH]
+    assert [t.serial for t in fermbot.thermo.get_all_thermometers(
+        MULTI_BUS_PATH)] == ["28-0000041481e8", "28-0000041462fa",
+                             "28-00000414a0b1", "28-00000414c0d2"]
+
+def test_multi_bus_registry(tmpdir):
+    devices_path = str(tmpdir.join("devices"))
+    shutil.copytree(MULTI_BUS_PATH, devices_path)
+    registry = fermbot.thermo.MultiBusRegistry(devices_path, poll_secs=3600)
+    events = []
+    registry.add_listener(lambda event, t: events.append((event, t.serial)))
+    Events = fermbot.thermo.MultiBusRegistry.Events
+    
+    assert len(registry.bus_master_paths) == 3
+    assert not registry.refresh()
+    
+    # A bus master that goes is noticed straight away
+    bus_path = os.path.join(devices_path, "w1_bus_master10")
+    shutil.move(bus_path, str(tmpdir.join("unplugged")))
+    assert registry.refresh()
+    assert [t.serial for t in registry.thermometers] == [
+        "28-0000041481e8", "28-0000041462fa", "28-00000414a0b1"]
+    
+    # New bus masters are only looked for once poll_secs have passed
+    shutil.move(str(tmpdir.join("unplugged")), bus_path)
+    assert not registry.refresh()
+    assert registry.refresh(force=True)
+    assert registry.bus_master_paths[-1] == bus_path
+    assert events == [(Events.REMOVED, "28-00000414c0d2"),
+                      (Events.ADDED, "28-00000414c0d2")]
+
+def test_multi_bus_sampler():
+    sampler = fermbot.thermo.MultiBusSampler(
+        fermbot.thermo.MultiBusRegistry(MULTI_BUS_PATH))
+    try:
+        readings = sampler.sample()
+    finally:
+        sampler.close()
+    
+    assert dict((serial, reading.temp_millicelcius)
+                for serial, reading in readings.iteritems()) == {
+        "28-0000041481e8": 19562, "28-0000041462fa": 18125,
+        "28-00000414a0b1": 21000, "28-00000414c0d2": 17000}
+
+def test_multi_bus_sampler_reads_buses_in_parallel(tmpdir, monkeypatch):
+    for bus in range(1, 4):
+        benchmarks.synthetic_bus.create_bus(str(tmpdir), 2, seed=bus,
+                                            name="w1_bus_master%d" % bus)
+    sampler = fermbot.thermo.MultiBusSampler(
+        fermbot.thermo.MultiBusRegistry(str(tmpdir)))
+    original_read = fermbot.thermo.Thermometer.read
+    condition = threading.Condition()
+    active_reads = []
+    overlaps = []
+
+    # Each read waits a while for a read on another bus to start with it
+    def read(thermometer):
+        with condition:
+            active_reads.append(thermometer.bus_master_path)
+            overlaps.append(active_reads[:])
+            condition.notify_all()
+            if len(set(active_reads)) == 1:
+                condition.wait(1)
+        try:
+            return original_read(thermometer)
+        finally:
+            with condition:
+                active_reads.remove(thermometer.bus_master_path)
+
+    monkeypatch.setattr(fermbot.thermo.Thermometer, "read", read)
+    try:
+        readings = sampler.sample(budget_secs=10)
+    finally:
+        sampler.close()
+    
+    assert len(readings) == 6
+    assert all(reading != None for reading in readings.values())
+    # Buses were read at the same time, but never two reads on one bus
+    assert max(len(set(buses)) for buses in overlaps) > 1
+    assert all(len(set(buses)) == len(buses) for buses in overlaps)
+
+def test_multi_bus_sampler_reads_every_thermometer_before_retrying(tmpdir):
+    bus_path = benchmarks.synthetic_bus.create_bus(str(tmpdir), 2)
+    serials = [serial.strip() for serial in open(
+        os.path.join(bus_path, "w1_master_slaves"))]
+    benchmarks.synthetic_bus.write_w1_slave(
+        os.path.join(bus_path, serials[0], "w1_slave"), 18000, crc_ok=False)
+    benchmarks.synthetic_bus.write_w1_slave(
+        os.path.join(bus_path, serials[1], "w1_slave"), 19000)
+    sampler = fermbot.thermo.MultiBusSampler(
+        fermbot.thermo.MultiBusRegistry(str(tmpdir)))
+    try:
+        with benchmarks.synthetic_bus.read_latency(0.3):
+            readings = sampler.sample(budget_secs=1.5)
+    finally:
+        sampler.close()
+    
+    # The bad CRC is retried for the rest of the budget, but only once the
+    # healthy thermometer after it has been read
+    assert readings[serials[0]] == None
+    assert readings[serials[1]].temp_millicelcius == 19000
+
+class ListRegistry(object):
+    def __init__(self, thermometers):
+        self.thermometers = thermometers
+
+def test_multi_bus_sampler_isolates_hung_bus():
+    thermometers = [FlakyThermometer(SINGLE_THERMO_BUS_PATH,
+                                     "28-0000041481e8"),
+                    FlakyThermometer(DUAL_THERMO_BUS_PATH,
+                                     "28-0000041462fa")]
+    thermometers[0].read()
+    thermometers[0].hang = True
+    sampler = fermbot.thermo.MultiBusSampler(ListRegistry(thermometers))
+    
+    try:
+        start_time = time.time()
+        readings = sampler.sample(0.2)
+        assert time.time() - start_time < 0.5
+        assert readings["28-0000041481e8"].stale
+        assert readings["28-0000041462fa"].temp_c == Decimal("18.125")
+        
+        # The stuck bus isn't read again until its worker is free
+        readings = sampler.sample(0.2)
+        assert readings["28-0000041481e8"].stale
+        assert thermometers[0].reads == 2
+        assert not readings["28-0000041462fa"].stale
+    finally:
+        thermometers[0].release.set()
+        sampler.close()
+
+class SlowListThermoLogger(ListThermoLogger):
+    """ListThermoLogger that waits for an event before logging each reading,
+    setting started once it is waiting on the first"""
+    def __init__(self):
+        super(SlowListThermoLogger, self).__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+    
+    def _log_thermo_without_chain(self, thermo):
+        self.started.set()
+        self.release.wait()
+        super(SlowListThermoLogger, self)._log_thermo_without_chain(thermo)
+
+def test_pipeline_fans_out():
+    pipeline = fermbot.thermo.ThermoLoggerPipeline()
+    sink_1 = pipeline.add_sink(ListThermoLogger())
+    sink_2 = pipeline.add_sink(ListThermoLogger())
+    
+    for thermometer in fermbot.thermo.get_thermometers(DUAL_THERMO_BUS_PATH):
+        pipeline.log_thermo(thermometer)
+    pipeline.flush()
+    
+    for sink in (sink_1, sink_2):
+        assert sink.logger.log_entries == [Decimal("67.212"),
+                                           Decimal("64.625")]
+        assert sink.queue_depth == 0
+    pipeline.close()
+
+def test_pipeline_labels_sinks_by_name():
+    pipeline = fermbot.thermo.ThermoLoggerPipeline()
+    slow_sink = pipeline.add_sink(SlowListThermoLogger(), name="slow")
+    sink = pipeline.add_sink(SlowListThermoLogger(), name="fast")
+    default_sink = pipeline.add_sink(SlowListThermoLogger())
+    with pytest.raises(ValueError):
+        pipeline.add_sink(ListThermoLogger(), name="slow")
+    
+    sink.logger.release.set()
+    default_sink.logger.release.set()
+    pipeline.log_thermo(fermbot.thermo.TempReading("28-0000041481e8", 0, 0))
+    assert slow_sink.logger.started.wait(5)
+    pipeline.log_thermo(fermbot.thermo.TempReading("28-0000041481e8", 0, 0))
+    sink.join()
+    
+    # Sinks of the same class keep their own metrics
+    assert default_sink.name == "SlowListThermoLogger"
+    assert fermbot.thermo.LOGGER_QUEUE_DEPTH.value(("slow",)) == 1
+    assert fermbot.thermo.LOGGER_QUEUE_DEPTH.value(("fast",)) == 0
+    slow_sink.logger.release.set()
+    pipeline.close()
+
+def test_pipeline_slow_sink_drops_oldest():
+    pipeline = fermbot.thermo.ThermoLoggerPipeline()
+    fast_sink = pipeline.add_sink(ListThermoLogger())
+    slow_sink = pipeline.add_sink(SlowListThermoLogger(), max_queue=2)
+    
+    for temp in range(10):
+        pipeline.log_thermo(fermbot.thermo.TempReading("28-0000041481e8",
+                                                       temp * 1000, 0))
+        if temp == 0:
+            assert slow_sink.logger.started.wait(5)
+    # The fast sink isn't held up by the slow one
+    fast_sink.join()
+    assert len(fast_sink.logger.log_entries) == 10
+    
+    slow_sink.logger.release.set()
+    pipeline.close()
+    
+    assert len(fast_sink.logger.log_entries) == 10
+    # One reading was being logged and the two newest were queued
+    assert len(slow_sink.logger.log_entries) == 3
+    assert slow_sink.logger.log_entries == [Decimal("32.000"),
+                                            Decimal("46.400"),
+                                            Decimal("48.200")]
+    assert slow_sink.dropped_count == 7
+
+def test_pipeline_drop_newest():
+    pipeline = fermbot.thermo.ThermoLoggerPipeline()
+    sink = pipeline.add_sink(
+        SlowListThermoLogger(), max_queue=1,
+        overflow=fermbot.thermo.ThermoLoggerSink.OverflowPolicies.DROP_NEWEST)
+    
+    for temp in range(5):
+        pipeline.log_thermo(fermbot.thermo.TempReading("28-0000041481e8",
+                                                       temp * 1000, 0))
+        if temp == 0:
+            assert sink.logger.started.wait(5)
+    sink.logger.release.set()
+    pipeline.close()
+    
+    assert sink.logger.log_entries == [Decimal("32.000"), Decimal("33.800")]
+    assert sink.dropped_count == 3
+
+def test_pipeline_sink_ignores_messages_after_close():
+    pipeline = fermbot.thermo.ThermoLoggerPipeline()
+    sink = pipeline.add_sink(ListThermoLogger())
+    pipeline.close()
+    
+    pipeline.log_thermo(fermbot.thermo.TempReading("28-0000041481e8", 0, 0))
+    sink.submit(lambda: None)
+    # Neither waits for the stopped worker
+    pipeline.flush()
+    sink.join()
+    sink.close()
+    
+    assert sink.logger.log_entries == []
+    assert sink.dropped_count == 1
+
+def test_pipeline_logs_controller_snapshot():
+    pipeline = fermbot.thermo.ThermoLoggerPipeline()
+    sink = pipeline.add_sink(fermbot.thermo.FileThermoLogger(LOGGING_APP_NAME))
+    temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+        SINGLE_THERMO_BUS_PATH, Decimal("65.0"), Decimal("1"))
+    temp_controller.process()
+    
+    pipeline.log_temp_controller(temp_controller)
+    temp_controller.state = fermbot.thermo.TempController.States.OFF
+    pipeline.close()
+    
+    assert sink.error_count == 0
+    with open(FILE_LOGGER_LOG_FILE) as log_file:
+        assert (" ".join(log_file.readlines()[-1].split()[-12:]) == 
+                "28-0000041481e8 at 67.2° F, target is 65.0° F so TC is COOLING")
+
+def test_cooling_controller_set():
+    fermenters = [
+        {"serial": "28-0000041481e8", "pin": 91,
+         "max_temp_f": Decimal("65.0"), "temp_band_f": Decimal("1")},
+        {"serial": "28-0000041462fa", "pin": 92,
+         "max_temp_f": Decimal("70.0"), "temp_band_f": Decimal("1")},
+        {"serial": "28-000000000000", "pin": 93,
+         "max_temp_f": Decimal("70.0"), "temp_band_f": Decimal("1")}]
+    temp_controller_set = (
+        fermbot.thermo.TempControllerFactory.coolingControllerSet(
+            DUAL_THERMO_BUS_PATH, fermenters))
+    readings = fermbot.thermo.sample_bus(DUAL_THERMO_BUS_PATH)
+    
+    processed = temp_controller_set.process(readings)
+    
+    States = fermbot.thermo.TempController.States
+    assert [tc.state for tc in processed] == [States.COOLING, States.OFF]
+    assert processed[0].reading is readings["28-0000041481e8"]
+    assert processed[0].device is not processed[1].device
+    assert (processed[0].device is
+            fermbot.thermo.TempControllerFactory.device_for_pin(91))
+
+def test_cooling_controller_set_duplicate_pin():
+    fermenters = [{"serial": None, "pin": 12, "max_temp_f": Decimal("65.0"),
+                   "temp_band_f": Decimal("1")}] * 2
+    
+    with pytest.raises(ValueError):
+        fermbot.thermo.TempControllerFactory.coolingControllerSet(
+            DUAL_THERMO_BUS_PATH, fermenters)
+
+class CountingDevice(fermbot.thermo.ControlledDevice):
+    """ControlledDevice that counts how often it is actuated"""
+    def __init__(self, journal=None):
+        super(CountingDevice, self).__init__(journal)
+        self.actuations = []
+    
+    def _actuate(self, state):
+        self.actuations.append(state)
+
+def test_device_actuates_only_on_transitions(tmpdir):
+    journal = fermbot.thermo.DeviceJournal(str(tmpdir.join("device.journal")))
+    device = CountingDevice(journal)
+    States = fermbot.thermo.ControlledDevice.States
+    
+    assert not device.turn_off()
+    assert device.turn_on()
+    assert not device.turn_on()
+    assert device.turn_off()
+    
+    assert device.actuations == [States.ON, States.OFF]
+    assert device.last_actuation_secs >= 0
+    with open(journal.file_name) as journal_file:
+        assert len(journal_file.readlines()) == 2
+    assert journal.last_state() == States.OFF
+
+def test_temp_controller_steady_state_no_device_io():
+    device = CountingDevice()
+    thermometer = fermbot.thermo.get_thermometers(SINGLE_THERMO_BUS_PATH)[0]
+    temp_controller = fermbot.thermo.TempController(
+        device, thermometer, Decimal("65.0"), Decimal("1"))
+    
+    for cycle in range(5):
+        temp_controller.process()
+    
+    assert device.actuations == [fermbot.thermo.ControlledDevice.States.ON]
+
+def test_temp_controller_cooling_seconds():
+    thermometer = fermbot.thermo.get_thermometers(SINGLE_THERMO_BUS_PATH)[0]
+    labels = (thermometer.serial,)
+    temp_controller = fermbot.thermo.TempController(
+        CountingDevice(), thermometer, Decimal("65.0"), Decimal("1"))
+    cooling_secs = fermbot.thermo.COOLING_SECONDS.value(labels) or 0
+    
+    temp_controller.process()
+    time.sleep(0.05)
+    temp_controller.process()
+    
+    assert fermbot.thermo.COOLING.value(labels) == 1
+    assert (fermbot.thermo.COOLING_SECONDS.value(labels) - cooling_secs
+            >= 0.05)
+
+def test_mock_device_recovers_state(tmpdir):
+    file_name = str(tmpdir.join("mock_device"))
+    States = fermbot.thermo.ControlledDevice.States
+    
+    assert fermbot.thermo.MockDevice(file_name).state == States.OFF
+    fermbot.thermo.MockDevice(file_name).turn_on()
+    assert fermbot.thermo.MockDevice(file_name).state == States.ON
+    
+    # State files from before the journal hold a single digit
+    with open(file_name, "w") as f:
+        f.write("1")
+    assert fermbot.thermo.MockDevice(file_name).state == States.ON
+
+class FakeGPIO(object):
+    """Stands in for RPi.GPIO, holding the level of each pin"""
+    OUT = 0
+    
+    def __init__(self, levels):
+        self.levels = levels
+    
+    def setup(self, pin, mode):
+        self.levels.setdefault(pin, 0)
+    
+    def input(self, pin):
+        return self.levels[pin]
+    
+    def output(self, pin, value):
+        self.levels[pin] = int(value)
+
+def test_pi_device_recovers_state_from_journal(tmpdir, monkeypatch):
+    States = fermbot.thermo.ControlledDevice.States
+    journal = fermbot.thermo.DeviceJournal(str(tmpdir.join("device.journal")))
+    gpio = FakeGPIO({12: 1})
+    monkeypatch.setattr(fermbot.thermo, "_gpio", gpio)
+    
+    # Without a journal entry the pin is read
+    assert fermbot.thermo.PiDevice(12, journal).state == States.ON
+    
+    # The pin is low after a reboot, so it is driven to the journaled state
+    journal.record(States.ON, 1400000400, 0.001)
+    gpio.levels[12] = 0
+    assert fermbot.thermo.PiDevice(12, journal).state == States.ON
+    assert gpio.levels[12] == 1
+    
+    journal.record(States.OFF, 1400000460, 0.001)
+    assert fermbot.thermo.PiDevice(12, journal).state == States.OFF
+    assert gpio.levels[12] == 0
+
+def test_snapshot_round_trip(tmpdir):
+    snapshot_file = str(tmpdir.join("run", "snapshot.json"))
+    assert fermbot.thermo.read_snapshot(snapshot_file) == None
+    readings = fermbot.thermo.sample_bus(DUAL_THERMO_BUS_PATH)
+    readings["28-0000041481e8"] = readings["28-0000041481e8"].as_stale()
+    readings["28-000000000000"] = None
+    histories = fermbot.thermo.ReadingHistories()
+    histories.add_readings(readings)
+    temp_controller = fermbot.thermo.TempController(
+        CountingDevice(), fermbot.thermo.get_thermometers(
+            DUAL_THERMO_BUS_PATH)[1], Decimal("65.0"), Decimal("1"))
+    temp_controller.process(readings["28-0000041462fa"])
+    
+    fermbot.thermo.publish_snapshot(snapshot_file, readings, histories,
+                                    [temp_controller])
+    snapshot = fermbot.thermo.read_snapshot(snapshot_file)
+    
+    assert os.listdir(str(tmpdir.join("run"))) == ["snapshot.json"]
+    assert 0 <= snapshot.age_secs < 5
+    assert sorted(snapshot.readings) == sorted(readings)
+    assert snapshot.readings["28-000000000000"] == None
+    for serial in ("28-0000041481e8", "28-0000041462fa"):
+        assert snapshot.readings[serial].serial == serial
+        assert (snapshot.readings[serial].temp_millicelcius ==
+                readings[serial].temp_millicelcius)
+        assert (snapshot.readings[serial].timestamp ==
+                readings[serial].timestamp)
+        assert snapshot.readings[serial].stale == readings[serial].stale
+    assert snapshot.slopes == {"28-0000041481e8": None,
+                               "28-0000041462fa": None,
+                               "28-000000000000": None}
+    assert snapshot.controller_states == {
+        "28-0000041462fa": fermbot.thermo.TempController.States.OFF}
+
+def test_import_has_no_side_effects():
+    script = """
+import __builtin__, sys, sqlite3
+from decimal import Decimal
+opened = []
+real_open = __builtin__.open
+def recording_open(*args, **kwargs):
+    opened.append(args[0])
+    return real_open(*args, **kwargs)
+__builtin__.open = recording_open
+import fermbot.thermo
+print(sorted(set(["platform", "multiprocessing", "inspect", "RPi"]) &
+             set(sys.modules)))
+print(opened)
+print((Decimal, sqlite3.PrepareProtocol) in sqlite3.adapters)
+"""
+    output = subprocess.check_output([sys.executable, "-c", script],
+                                     cwd=os.path.join(cwd, ".."))
+    
+    assert output.splitlines() == ["[]", "[]", "False"]
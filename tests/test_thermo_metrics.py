@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import pytest, fermbot.thermo_metrics, os
+
+def test_counter_render():
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    counter = registry.counter("reads_total", "Reads", ("serial",))
+    counter.inc(labels=("28-b",))
+    counter.inc(2, ("28-a",))
+    
+    assert counter.value(("28-a",)) == 2
+    assert registry.render() == ("# HELP reads_total Reads\n"
+                                 "# TYPE reads_total counter\n"
+                                 'reads_total{serial="28-a"} 2\n'
+                                 'reads_total{serial="28-b"} 1\n')
+
+def test_gauge_set_and_escaping():
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    gauge = registry.gauge("depth", "Depth", ("logger",))
+    gauge.set(1.5, ('a"b\\c',))
+    
+    assert 'depth{logger="a\\"b\\\\c"} 1.5\n' in registry.render()
+
+def test_histogram_render():
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    histogram = registry.histogram("read_seconds", "Reads", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    
+    assert histogram.value() == (4, 3.65)
+    assert registry.render().splitlines()[2:] == [
+        'read_seconds_bucket{le="0.1"} 2',
+        'read_seconds_bucket{le="1.0"} 3',
+        'read_seconds_bucket{le="+Inf"} 4',
+        'read_seconds_sum 3.65',
+        'read_seconds_count 4']
+
+def test_duplicate_metric():
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    registry.counter("reads_total", "Reads")
+    with pytest.raises(ValueError):
+        registry.gauge("reads_total", "Reads")
+
+def test_write_textfile(tmpdir):
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    registry.gauge("depth", "Depth").set(3)
+    file_name = str(tmpdir.join("fermbot.prom"))
+    
+    registry.write_textfile(file_name)
+    registry.write_textfile(file_name)
+    
+    assert os.listdir(str(tmpdir)) == ["fermbot.prom"]
+    with open(file_name) as f:
+        assert f.read() == registry.render()
+
+def test_render_kinds():
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    registry.counter("reads_total", "Reads").inc()
+    registry.gauge("depth", "Depth").set(3)
+    
+    assert registry.render((fermbot.thermo_metrics.Gauge,)) == (
+        "# HELP depth Depth\n# TYPE depth gauge\ndepth 3\n")
+
+def test_write_textfile_missing_directory(tmpdir):
+    registry = fermbot.thermo_metrics.MetricsRegistry()
+    with pytest.raises(EnvironmentError):
+        registry.write_textfile(str(tmpdir.join("missing", "fermbot.prom")))
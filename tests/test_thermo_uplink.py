@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import pytest, fermbot.thermo, fermbot.thermo_uplink, fermbot.thermo_collector
+import json, threading, zlib, os
+import sqlite3 as lite
+from decimal import Decimal
+
+SINGLE_THERMO_BUS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data/thermo/single_thermo_bus_master")
+
+SERIAL = "28-0000041481e8"
+COOLING = fermbot.thermo.TempController.States.COOLING
+
+def points(count, first_id=1):
+    return [(first_id + i, SERIAL, 1400000400 + i * 60, 18000 + i % 3)
+            for i in range(count)]
+
+@pytest.fixture
+def collector(tmpdir):
+    collector = fermbot.thermo_collector.Collector(
+        str(tmpdir.join("collector.db")))
+    server = fermbot.thermo_collector.CollectorServer(("127.0.0.1", 0),
+                                                      collector)
+    collector.url = "http://127.0.0.1:%d/" % server.server_address[1]
+    collector.server = server
+    collector.serving = False
+    yield collector
+    # shutdown waits for serve_forever, so only call it once that started
+    if collector.serving:
+        server.shutdown()
+    server.server_close()
+    collector.close()
+
+def serve(collector):
+    thread = threading.Thread(target=collector.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    collector.serving = True
+
+def stored_temps(collector):
+    thermo_reader = fermbot.thermo.SQLThermoReader(collector.db_file)
+    try:
+        return [point[3] for point in thermo_reader.iter_points()]
+    finally:
+        thermo_reader.close()
+
+def stored_intervals(collector):
+    thermo_logger = fermbot.thermo.SQLThermoLogger(collector.db_file)
+    try:
+        return thermo_logger.controller_intervals(SERIAL, 0, 2000000000)
+    finally:
+        thermo_logger.close()
+
+def log_readings(sql_logger, count, first_time=1400000400):
+    for i in range(count):
+        sql_logger.log_thermo(fermbot.thermo.TempReading(
+            SERIAL, 18000 + i % 3, first_time + i * 60))
+    sql_logger.flush()
+
+def test_payload_round_trip():
+    payload_points = points(5)
+    payload_points.insert(2, (8, "28-0000041462fa", 1400000460, -500))
+    intervals = [(3, SERIAL, 1400000400, 1400000700, COOLING, 65000, 1000)]
+
+    assert fermbot.thermo_uplink.decode_payload(
+        fermbot.thermo_uplink.encode_payload("pi-1", payload_points,
+                                             intervals)) == (
+        "pi-1", sorted(payload_points), intervals)
+
+def test_payload_is_compact():
+    payload = fermbot.thermo_uplink.encode_payload("pi-1", points(1000), [])
+
+    assert len(payload) < 1000
+    assert len(payload) * 20 < len(json.dumps(points(1000)))
+
+def test_decode_payload_rejects_garbage():
+    with pytest.raises(ValueError):
+        fermbot.thermo_uplink.decode_payload("not an upload")
+    with pytest.raises(ValueError):
+        fermbot.thermo_uplink.decode_payload(zlib.compress('{"node":"a"}'))
+
+def test_uplink_uploads_batches(collector, tmpdir):
+    serve(collector)
+    db_file = str(tmpdir.join("node.db"))
+    state_file = str(tmpdir.join("node.db.uplink"))
+    sql_logger = fermbot.thermo.SQLThermoLogger(db_file, 100)
+    log_readings(sql_logger, 10)
+    temp_controller = fermbot.thermo.TempControllerFactory.simpleCoolingController(
+        SINGLE_THERMO_BUS_PATH, Decimal("65.0"), Decimal("1"))
+    temp_controller.process(fermbot.thermo.TempReading(SERIAL, 19000,
+                                                       1400001200))
+    sql_logger.log_temp_controller(temp_controller)
+    sql_logger.flush()
+
+    thermo_logger = fermbot.thermo_uplink.UplinkThermoLogger(
+        collector.url, "pi-1", db_file, state_file, batch_size=4)
+    thermo_logger.flush()
+
+    assert thermo_logger.cursor == 10
+    assert collector.cursor("pi-1") == 10
+    assert stored_temps(collector) == [18000 + i % 3 for i in range(10)]
+    assert stored_intervals(collector) == [(1400001200, 1400001200, COOLING)]
+    thermo_logger.close()
+
+    # A new logger resumes after the acknowledged readings, and the
+    # extended interval is updated rather than stored again
+    log_readings(sql_logger, 2, 1400003000)
+    temp_controller.process(fermbot.thermo.TempReading(SERIAL, 19000,
+                                                       1400001260))
+    sql_logger.log_temp_controller(temp_controller)
+    sql_logger.close()
+    thermo_logger = fermbot.thermo_uplink.UplinkThermoLogger(
+        collector.url, "pi-1", db_file, state_file, batch_size=4)
+    assert thermo_logger.cursor == 10
+    thermo_logger.close()
+
+    assert collector.cursor("pi-1") == 12
+    assert len(stored_temps(collector)) == 12
+    assert stored_intervals(collector) == [(1400001200, 1400001260, COOLING)]
+
+def test_collector_skips_points_already_stored(collector):
+    payload = fermbot.thermo_uplink.encode_payload("pi-1", points(5), [])
+
+    assert collector.store(payload) == 5
+    assert collector.store(payload) == 5
+    assert collector.store(fermbot.thermo_uplink.encode_payload(
+        "pi-1", points(4, 4), [])) == 7
+    # Each node has its own cursor
+    assert collector.store(fermbot.thermo_uplink.encode_payload(
+        "pi-2", points(1), [])) == 1
+    assert len(stored_temps(collector)) == 8
+
+def test_collector_stores_upload_in_one_transaction(collector):
+    collector.store(fermbot.thermo_uplink.encode_payload("pi-1", points(2),
+                                                         []))
+    # The interval refers to a state the schema rejects, after the points
+    # were inserted
+    payload = fermbot.thermo_uplink.encode_payload(
+        "pi-1", points(2, 3),
+        [(1, SERIAL, 1400000400, 1400000700, None, 65000, 1000)])
+
+    with pytest.raises(lite.IntegrityError):
+        collector.store(payload)
+    assert collector.cursor("pi-1") == 2
+    assert len(stored_temps(collector)) == 2
+
+def test_uplink_retries_after_failure(collector, tmpdir):
+    db_file = str(tmpdir.join("node.db"))
+    sql_logger = fermbot.thermo.SQLThermoLogger(db_file, 100)
+    log_readings(sql_logger, 3)
+    sql_logger.close()
+    # The server is listening but not yet answering, so the upload times out
+    thermo_logger = fermbot.thermo_uplink.UplinkThermoLogger(
+        collector.url, "pi-1", db_file, str(tmpdir.join("node.db.uplink")),
+        batch_size=100, timeout_secs=0.2, retry_secs=0)
+    thermo_logger.flush()
+    assert thermo_logger.cursor == 0
+
+    # The timed out upload is stored once the server answers, and the retry
+    # isn't stored again
+    serve(collector)
+    thermo_logger.flush()
+    assert thermo_logger.cursor == 3
+    assert stored_temps(collector) == [18000, 18001, 18002]
+    thermo_logger.close()